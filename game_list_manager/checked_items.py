@@ -3,6 +3,8 @@ import threading
 import xml.etree.ElementTree as ET
 from tkinter import messagebox
 
+from xml_handler import curated_xml_lock
+
 
 class CheckedItemsManager:
     def __init__(self, app, checked_dir):
@@ -133,23 +135,25 @@ class CheckedItemsManager:
             return
 
         try:
-            tree = ET.parse(self.app.curated_xml_path)
-            root = tree.getroot()
-            paths_to_exclude = set(self.checked_items)
-            games_to_remove = []
-
-            for game in root.findall('game'):
-                path_elem = game.find('path')
-                game_path = path_elem.text if path_elem is not None else ''
-                if game_path in paths_to_exclude:
-                    games_to_remove.append(game)
-
-            for game in games_to_remove:
-                root.remove(game)
-                removed_path = game.find('path').text if game.find('path') is not None else ''
-                print(f"Excluded game from curated XML: {removed_path}")
-
-            tree.write(self.app.curated_xml_path, encoding='utf-8', xml_declaration=True)
+            # Перевод в фоне может в это время дописывать описания в тот же файл
+            with curated_xml_lock:
+                tree = ET.parse(self.app.curated_xml_path)
+                root = tree.getroot()
+                paths_to_exclude = set(self.checked_items)
+                games_to_remove = []
+
+                for game in root.findall('game'):
+                    path_elem = game.find('path')
+                    game_path = path_elem.text if path_elem is not None else ''
+                    if game_path in paths_to_exclude:
+                        games_to_remove.append(game)
+
+                for game in games_to_remove:
+                    root.remove(game)
+                    removed_path = game.find('path').text if game.find('path') is not None else ''
+                    print(f"Excluded game from curated XML: {removed_path}")
+
+                tree.write(self.app.curated_xml_path, encoding='utf-8', xml_declaration=True)
             print(f"Updated curated XML: {self.app.curated_xml_path}")
 
             self.checked_items.difference_update(paths_to_exclude)
@@ -0,0 +1,582 @@
+import concurrent.futures
+import heapq
+import json
+import math
+import os
+import threading
+import time
+
+from export_engine import file_digest
+
+
+COMPRESS_MANIFEST_FILENAME = ".compress_manifest.json"
+COMPRESS_JOURNAL_FILENAME = ".compress_journal.jsonl"
+COMPRESS_SWAP_JOURNAL_FILENAME = ".compress_swaps.jsonl"
+# Короткие превью почти не ускоряются от потоков x264 сверх 2-4,
+# выгоднее запускать больше параллельных кодирований
+MAX_JOB_THREADS = 4
+LOAD_CHECK_INTERVAL = 1.0
+
+MIN_TARGET_HEIGHT = 240
+AUDIO_BITRATE = 64000
+# Грубая модель x264: бит на пиксель при CRF 23, каждые +6 CRF - примерно вдвое меньше
+X264_BPP_AT_CRF23 = 0.08
+# Перекодирование, которое экономит меньше этой доли, не запускается
+MIN_SAVING_RATIO = 0.15
+# Кодеки, которые можно обрезать без перекодирования в тот же MP4
+STREAM_COPY_CODECS = {"h264"}
+# В режиме "только обрезка" исходник с битрейтом до этой кратности от
+# ожидаемого после перекодирования на исходном разрешении остаётся как есть
+ACCEPTABLE_BITRATE_FACTOR = 2.0
+
+# Планировщик бюджета: пробные кодирования и набор ступеней качества
+SAMPLE_SECONDS = 3
+SAMPLES_PER_CLASS = 2
+SAMPLE_CRF_SPREAD = 8
+MAX_BUDGET_CRF = 40
+BUDGET_SCALE_STEPS = (1.0, 0.75, 0.5)
+# Классы роликов: по высоте кадра и по "плотности" исходного битрейта
+HEIGHT_CLASSES = (240, 360, 480, 720)
+SOURCE_BPP_CLASSES = (0.05, 0.15)
+
+
+def compression_params(scale_factor, crf_value, max_duration, trim_only=False, budget_bytes=0):
+    # Значения ползунков округляются, чтобы одинаковые настройки совпадали в манифесте
+    params = {
+        "scale": round(float(scale_factor), 2),
+        "crf": int(round(float(crf_value))),
+        "max_duration": int(max_duration),
+    }
+    # Ключ только для нового режима: записи старых манифестов остаются действительными
+    if trim_only:
+        params["trim_only"] = True
+    if budget_bytes:
+        params["budget"] = int(budget_bytes)
+    return params
+
+
+def target_dimensions(width, height, scale_factor):
+    new_width = int(width * scale_factor)
+    new_height = int(height * scale_factor)
+    # Слишком маленькие ролики не уменьшаем
+    if new_height < MIN_TARGET_HEIGHT:
+        new_width = width
+        new_height = height
+    return new_width // 2 * 2, new_height // 2 * 2
+
+
+def bits_per_pixel(crf_value):
+    return X264_BPP_AT_CRF23 * 2 ** ((23 - crf_value) / 6)
+
+
+def estimate_encoded_bytes(probe, params, size_model=None, size=0):
+    width, height = target_dimensions(probe["width"], probe["height"], params["scale"])
+    duration = min(probe["duration"], params["max_duration"])
+    if size_model is not None:
+        bpp = size_model.bits_per_pixel(probe, size, params["crf"])
+    else:
+        bpp = bits_per_pixel(params["crf"])
+    video_bitrate = bpp * width * height * probe["frame_rate"]
+    return int((video_bitrate + AUDIO_BITRATE) * duration / 8)
+
+
+def source_video_bitrate(probe, size):
+    if probe.get("video_bitrate"):
+        return probe["video_bitrate"]
+    # Битрейт потока указан не во всех контейнерах: оцениваем по размеру файла
+    audio_bitrate = probe.get("audio_bitrate") or 0
+    return max(0, size * 8 / probe["duration"] - audio_bitrate)
+
+
+def is_acceptable_source(probe, size, params):
+    """Можно ли оставить видеопоток как есть: подходящий кодек и не завышенный битрейт."""
+    if probe["video_codec"] not in STREAM_COPY_CODECS:
+        return False
+    limit = bits_per_pixel(params["crf"]) * probe["width"] * probe["height"] * probe["frame_rate"]
+    return source_video_bitrate(probe, size) <= limit * ACCEPTABLE_BITRATE_FACTOR
+
+
+def decide_compression(probe, size, params, size_model=None):
+    """Что делать с файлом: encode, copy (обрезка без перекодирования) или skip."""
+    if probe is None or probe["duration"] <= 0:
+        return {"action": "encode", "expected_bytes": size}
+
+    duration = probe["duration"]
+    needs_trim = duration > params["max_duration"]
+    # Размер оставшегося фрагмента, если его вырезать без перекодирования
+    kept_bytes = int(size * min(1.0, params["max_duration"] / duration))
+    encoded_bytes = estimate_encoded_bytes(probe, params, size_model, size)
+
+    if params.get("trim_only"):
+        if not is_acceptable_source(probe, size, params):
+            return {"action": "encode", "expected_bytes": min(encoded_bytes, kept_bytes)}
+        if needs_trim:
+            return {"action": "copy", "expected_bytes": kept_bytes}
+        return {"action": "skip", "expected_bytes": size}
+
+    if encoded_bytes < kept_bytes * (1 - MIN_SAVING_RATIO):
+        return {"action": "encode", "expected_bytes": encoded_bytes}
+    if needs_trim and probe["video_codec"] in STREAM_COPY_CODECS:
+        return {"action": "copy", "expected_bytes": kept_bytes}
+    if needs_trim:
+        return {"action": "encode", "expected_bytes": min(encoded_bytes, kept_bytes)}
+    return {"action": "skip", "expected_bytes": size}
+
+
+def size_class(probe, size):
+    """Класс ролика для модели размера: (ступень высоты, ступень битрейта исходника)."""
+    height_class = sum(1 for limit in HEIGHT_CLASSES if probe["height"] > limit)
+    pixel_rate = probe["width"] * probe["height"] * probe["frame_rate"]
+    source_bpp = source_video_bitrate(probe, size) / pixel_rate if pixel_rate else 0
+    bpp_class = sum(1 for limit in SOURCE_BPP_CLASSES if source_bpp > limit)
+    return height_class, bpp_class
+
+
+class SizeModel:
+    """Бит на пиксель по результатам пробных кодирований: log2(bpp) = a + b * crf для каждого класса."""
+
+    def __init__(self):
+        self.samples = {}
+        self.fits = {}
+
+    def add_sample(self, probe, size, params, output_bytes, seconds):
+        width, height = target_dimensions(probe["width"], probe["height"], params["scale"])
+        pixel_rate = width * height * probe["frame_rate"]
+        video_bitrate = output_bytes * 8 / seconds - AUDIO_BITRATE
+        if pixel_rate <= 0 or video_bitrate <= 0:
+            return
+        self.samples.setdefault(size_class(probe, size), []).append(
+            (params["crf"], math.log2(video_bitrate / pixel_rate))
+        )
+
+    def fit(self):
+        self.fits = {}
+        for key, points in self.samples.items():
+            mean_crf = sum(crf for crf, _ in points) / len(points)
+            mean_log = sum(value for _, value in points) / len(points)
+            spread = sum((crf - mean_crf) ** 2 for crf, _ in points)
+            if spread:
+                slope = sum((crf - mean_crf) * (value - mean_log) for crf, value in points) / spread
+                # Шум коротких проб не должен давать рост размера с ростом CRF
+                slope = min(slope, -0.05)
+            else:
+                slope = -1 / 6
+            self.fits[key] = (mean_log - slope * mean_crf, slope)
+        return self
+
+    def bits_per_pixel(self, probe, size, crf_value):
+        fit = self.fits.get(self._class_key(probe, size))
+        if fit is None:
+            return bits_per_pixel(crf_value)
+        intercept, slope = fit
+        return 2 ** (intercept + slope * crf_value)
+
+    def _class_key(self, probe, size):
+        key = size_class(probe, size)
+        if key in self.fits or not self.fits:
+            return key
+        # Для класса без проб берём ближайший по высоте и битрейту
+        return min(self.fits, key=lambda other: (abs(other[0] - key[0]), abs(other[1] - key[1])))
+
+
+def select_samples(video_files, per_class=SAMPLES_PER_CLASS):
+    """По несколько роликов из каждого класса, ближе к медиане по длительности."""
+    classes = {}
+    for video_file in video_files:
+        probe = video_file.get("probe")
+        if probe and probe["duration"] > 0:
+            classes.setdefault(size_class(probe, video_file["size"]), []).append(video_file)
+
+    selected = []
+    for members in classes.values():
+        members.sort(key=lambda video_file: video_file["probe"]["duration"])
+        middle = len(members) // 2
+        start = max(0, middle - per_class // 2)
+        selected.extend(members[start:start + per_class])
+    return selected
+
+
+def sample_params(params):
+    """Две точки CRF на класс, чтобы модель знала не только уровень, но и наклон."""
+    low_crf = params["crf"]
+    high_crf = min(51, low_crf + SAMPLE_CRF_SPREAD)
+    return [dict(params, crf=low_crf), dict(params, crf=high_crf)]
+
+
+def budget_ladder(params):
+    """Ступени настроек от исходных к более сжатым, по убыванию ожидаемого размера."""
+    ladder = []
+    for scale_step in BUDGET_SCALE_STEPS:
+        scale = round(max(0.1, params["scale"] * scale_step), 2)
+        for crf in range(params["crf"], max(params["crf"], MAX_BUDGET_CRF) + 1, 2):
+            candidate = dict(params, scale=scale, crf=crf)
+            if candidate not in ladder:
+                ladder.append(candidate)
+    ladder.sort(key=lambda candidate: candidate["scale"] ** 2 * 2 ** (-candidate["crf"] / 6), reverse=True)
+    return ladder
+
+
+def plan_budget(video_files, budget_bytes, params, size_model=None):
+    """Настройки для каждого файла, чтобы сумма уложилась в бюджет.
+
+    Жадно: на каждом шаге понижаем качество у файла, где следующая ступень
+    экономит больше всего байт. Возвращает [(параметры, решение)] и итоговый размер.
+    """
+    ladder = budget_ladder(params)
+    options = []
+    for video_file in video_files:
+        probe = video_file.get("probe")
+        choices = []
+        for candidate in ladder:
+            decision = decide_compression(probe, video_file["size"], candidate, size_model)
+            # Оставляем только ступени, которые действительно уменьшают файл
+            if not choices or decision["expected_bytes"] < choices[-1][1]["expected_bytes"]:
+                choices.append((candidate, decision))
+            if probe is None:
+                break
+        options.append(choices)
+
+    positions = [0] * len(video_files)
+    total = sum(choices[0][1]["expected_bytes"] for choices in options)
+    heap = []
+    for index, choices in enumerate(options):
+        if len(choices) > 1:
+            saving = choices[0][1]["expected_bytes"] - choices[1][1]["expected_bytes"]
+            heapq.heappush(heap, (-saving, index))
+
+    while total > budget_bytes and heap:
+        negative_saving, index = heapq.heappop(heap)
+        total += negative_saving
+        positions[index] += 1
+        choices = options[index]
+        position = positions[index]
+        if position + 1 < len(choices):
+            saving = choices[position][1]["expected_bytes"] - choices[position + 1][1]["expected_bytes"]
+            heapq.heappush(heap, (-saving, index))
+
+    return [options[index][position] for index, position in enumerate(positions)], total
+
+
+def collection_bytes(collection_dir):
+    total = 0
+    for root, dirs, files in os.walk(collection_dir):
+        if "backup" in dirs:
+            dirs.remove("backup")
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+def relative_key(collection_dir, path):
+    return os.path.relpath(path, collection_dir).replace(os.sep, "/")
+
+
+def file_signature(path, with_hash=False):
+    stat_result = os.stat(path)
+    signature = {"size": stat_result.st_size, "mtime": int(stat_result.st_mtime)}
+    if with_hash:
+        signature["sha1"] = file_digest(path)
+    return signature
+
+
+def load_compress_manifest(collection_dir):
+    files = {}
+    manifest_path = os.path.join(collection_dir, COMPRESS_MANIFEST_FILENAME)
+    journal_path = os.path.join(collection_dir, COMPRESS_JOURNAL_FILENAME)
+
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                files.update(json.load(f).get("files", {}))
+        except Exception as e:
+            print(f"Error reading compression manifest: {e}")
+
+    if os.path.exists(journal_path):
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла оборваться при аварийном завершении
+                    continue
+                files[record.pop("relative")] = record
+
+    return files
+
+
+def write_compress_manifest(collection_dir, files):
+    # Записи о файлах, которых больше нет в коллекции, не переносим
+    files = {
+        relative: record
+        for relative, record in files.items()
+        if os.path.exists(os.path.join(collection_dir, relative.replace("/", os.sep)))
+    }
+    manifest_path = os.path.join(collection_dir, COMPRESS_MANIFEST_FILENAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "files": files}, f, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+    journal_path = os.path.join(collection_dir, COMPRESS_JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def is_already_compressed(path, record, params):
+    """Файл уже сжат с этими параметрами и с тех пор не менялся."""
+    if not record or record.get("params") != params:
+        return False
+    return is_compressed_output(path, record)
+
+
+def is_compressed_output(path, record):
+    """На месте файла лежит наш прошлый результат из манифеста, а не новый оригинал."""
+    if not record or record.get("action") == "skip":
+        return False
+    output = record.get("output") or {}
+    try:
+        current = file_signature(path)
+    except OSError:
+        return False
+
+    if current["size"] != output.get("size"):
+        return False
+    if current["mtime"] == output.get("mtime"):
+        return True
+    # Дата могла смениться при копировании, содержимое сверяем по хэшу
+    if output.get("sha1") and file_digest(path) == output["sha1"]:
+        output["mtime"] = current["mtime"]
+        return True
+    return False
+
+
+def plan_compression(collection_dir, video_paths, params, manifest_files):
+    pending = []
+    skipped = []
+    for path in video_paths:
+        relative = relative_key(collection_dir, path)
+        if is_already_compressed(path, manifest_files.get(relative), params):
+            skipped.append(path)
+        else:
+            pending.append(path)
+    return pending, skipped
+
+
+class CompressionJournal:
+    """Журнал завершённых файлов: прерванный пакет продолжается с того же места."""
+
+    def __init__(self, collection_dir, manifest_files):
+        self.collection_dir = collection_dir
+        self.files = manifest_files
+        self._lock = threading.Lock()
+        self._journal = open(os.path.join(collection_dir, COMPRESS_JOURNAL_FILENAME), "a", encoding="utf-8")
+
+    def record(self, path, input_signature, params, extra=None):
+        relative = relative_key(self.collection_dir, path)
+        record = {
+            "input": input_signature,
+            "params": params,
+            "output": file_signature(path, with_hash=True),
+        }
+        if extra:
+            record.update(extra)
+        with self._lock:
+            self.files[relative] = record
+            self._journal.write(json.dumps(dict(record, relative=relative), ensure_ascii=False) + "\n")
+            self._journal.flush()
+        return record
+
+    def close(self, compact=True):
+        with self._lock:
+            self._journal.close()
+            if compact:
+                write_compress_manifest(self.collection_dir, self.files)
+
+
+class SwapJournal:
+    """Журнал замены файлов на месте: после сбоя незавершённые замены откатываются.
+
+    Запись begin делается до переименования оригинала в backup и
+    сбрасывается на диск, commit/rollback - после завершения замены.
+    """
+
+    def __init__(self, collection_dir):
+        self.path = os.path.join(collection_dir, COMPRESS_SWAP_JOURNAL_FILENAME)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def begin(self, target, backup, temp, renamed):
+        self._write({"state": "begin", "target": target, "backup": backup, "temp": temp, "renamed": renamed})
+
+    def end(self, target, state):
+        self._write({"state": state, "target": target})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            # Все замены завершены, журнал больше не нужен
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def recover_interrupted_swaps(collection_dir):
+    """Откат замен, прерванных сбоем: оригинал возвращается из backup.
+
+    Возвращает (число восстановленных оригиналов, множество путей, на месте
+    которых уже лежит наш результат, а в backup - оригинал).
+    """
+    path = os.path.join(collection_dir, COMPRESS_SWAP_JOURNAL_FILENAME)
+    if not os.path.exists(path):
+        return 0, set()
+
+    pending = {}
+    committed = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            target = record.get("target")
+            if record.get("state") == "begin":
+                pending[target] = record
+                committed.discard(target)
+            else:
+                pending.pop(target, None)
+                if record.get("state") == "commit":
+                    committed.add(target)
+                else:
+                    committed.discard(target)
+
+    restored = 0
+    for target, record in pending.items():
+        try:
+            if os.path.exists(record["temp"]):
+                os.remove(record["temp"])
+            if os.path.exists(target):
+                # Сбой уже после замены (или backup был от прошлого запуска):
+                # на месте лежит наш результат, оригинал - в backup
+                if os.path.exists(record["backup"]):
+                    committed.add(target)
+            elif record["renamed"] and os.path.exists(record["backup"]):
+                os.rename(record["backup"], target)
+                restored += 1
+                print(f"Восстановлен оригинал после сбоя: {target}")
+        except OSError as e:
+            print(f"Ошибка восстановления {target}: {e}")
+
+    os.remove(path)
+    return restored, {target for target in committed if os.path.exists(target)}
+
+
+def current_system_load():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        # На Windows средней загрузки нет, считаем, что процессор свободен
+        return None
+
+
+def encoder_layout(max_jobs=0, cpu_count=None, external_load=0.0):
+    """(число параллельных ffmpeg, потоков на каждый) под свободные ядра."""
+    cpus = cpu_count or os.cpu_count() or 2
+    available = max(1, int(round(cpus - (external_load or 0.0))))
+    if available < 4:
+        threads = 1
+    elif available < 16:
+        threads = 2
+    else:
+        threads = MAX_JOB_THREADS
+    jobs = max(1, available // threads)
+    if max_jobs and int(max_jobs) < jobs:
+        # Пользователь ограничил число задач: освободившиеся ядра отдаём потокам
+        jobs = int(max_jobs)
+        threads = max(threads, min(MAX_JOB_THREADS, available // jobs))
+    return jobs, threads
+
+
+class EncodeScheduler:
+    """Параллельное кодирование с учётом ядер и текущей загрузки.
+
+    Длинные ролики запускаются первыми, чтобы в конце пакета не ждать
+    одну долгую задачу. run_task(item, threads) возвращает словарь
+    со статистикой: frames, input_bytes, output_bytes.
+    """
+
+    def __init__(self, items, run_task, weight=None, max_jobs=0, cancel_event=None, event_callback=None):
+        self.items = sorted(items, key=weight, reverse=True) if weight else list(items)
+        self.run_task = run_task
+        self.max_jobs = max_jobs
+        self.cancel_event = cancel_event or threading.Event()
+        self.event_callback = event_callback
+        self.cpu_count = os.cpu_count() or 2
+        self.frames = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.completed = 0
+        self.failed = []
+        self.started_at = None
+
+    def emit(self, *event):
+        if self.event_callback:
+            self.event_callback(event)
+
+    def current_layout(self, running_threads):
+        load = current_system_load()
+        # loadavg включает и наши ffmpeg, их вычитаем, чтобы не душить собственный пакет
+        external_load = max(0.0, load - running_threads) if load is not None else 0.0
+        return encoder_layout(self.max_jobs, self.cpu_count, external_load)
+
+    def throughput(self):
+        elapsed = max(time.monotonic() - (self.started_at or time.monotonic()), 0.001)
+        return {
+            "completed": self.completed,
+            "failed": len(self.failed),
+            "frames_per_second": self.frames / elapsed,
+            "mb_per_second": self.input_bytes / elapsed / (1024 * 1024),
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "elapsed_seconds": elapsed,
+        }
+
+    def run(self):
+        self.started_at = time.monotonic()
+        pending = list(self.items)
+        pending.reverse()
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cpu_count) as executor:
+            while running or (pending and not self.cancel_event.is_set()):
+                jobs, threads = self.current_layout(sum(threads for _, threads in running.values()))
+                while pending and len(running) < jobs and not self.cancel_event.is_set():
+                    item = pending.pop()
+                    running[executor.submit(self.run_task, item, threads)] = (item, threads)
+                    self.emit("start", item, len(running), jobs, threads)
+
+                done, _ = concurrent.futures.wait(
+                    running, timeout=LOAD_CHECK_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    item, _ = running.pop(future)
+                    try:
+                        stats = future.result() or {}
+                    except Exception as e:
+                        self.failed.append((item, str(e)))
+                        self.emit("failed", item, str(e))
+                        continue
+                    self.completed += 1
+                    self.frames += stats.get("frames", 0)
+                    self.input_bytes += stats.get("input_bytes", 0)
+                    self.output_bytes += stats.get("output_bytes", 0)
+                    self.emit("done", item, stats, self.throughput())
+
+        return self.throughput()
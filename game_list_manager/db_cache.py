@@ -3,6 +3,8 @@ import sqlite3
 import xml.etree.ElementTree as ET
 from pathlib import Path
 
+from media_index import index_key, normalize_reference, scan_directory, stat_skipped_reference
+
 
 NON_GROUPABLE_FIELDS = {
     "db_id",
@@ -57,8 +59,12 @@ FIELD_LABELS = {
     "base_key": "Семейство версии",
     "releasedate": "Дата релиза",
     "rating": "Рейтинг",
+    "media_missing": "Отсутствующие медиа",
 }
 
+# Поля, которые load_tree_rows добавляет из инвентаря медиа
+MEDIA_TREE_FIELDS = ["media_missing"]
+
 
 def normalize_rom_stem(path_value):
     path_value = (path_value or "").strip()
@@ -214,17 +220,23 @@ def _create_schema(conn, xml_fields):
 
 
 def rebuild_cache(curated_xml_path, db_path, support_root):
+    # Файл не удаляется: кроме таблиц дерева в нём живут долгоживущие кэши
+    # (например, хэши файлов), а games и metadata пересоздаются в _create_schema
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    if os.path.exists(db_path):
-        os.remove(db_path)
     xml_fields = _collect_xml_tag_names(curated_xml_path)
     support = load_support_metadata(support_root)
 
     conn = sqlite3.connect(db_path)
     try:
-        conn.execute("PRAGMA journal_mode=MEMORY")
-        conn.execute("PRAGMA synchronous=OFF")
+        # В том же файле хэши, пробы видео, инвентарь медиа и незаписанные переводы:
+        # журнал на диске обязателен, WAL с NORMAL сохраняет большую часть скорости
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
         conn.execute("PRAGMA temp_store=MEMORY")
+        _ensure_media_tables(conn)
+        # Одна транзакция на всю пересборку: при сбое остаются прежние таблицы
+        conn.execute("BEGIN")
+        _stash_media_files(conn)
         _create_schema(conn, xml_fields)
         tree = ET.parse(curated_xml_path)
         root = tree.getroot()
@@ -275,13 +287,32 @@ def rebuild_cache(curated_xml_path, db_path, support_root):
             rows.append(row)
 
         conn.executemany(insert_sql, rows)
+        if "desc" in xml_fields:
+            # Переводы, ещё не записанные в XML фоновым переводом, не откатываем к старым описаниям
+            _ensure_pending_description_table(conn)
+            conn.execute(
+                """
+                UPDATE games SET "desc" = (
+                    SELECT pending."desc" FROM pending_descriptions AS pending WHERE pending.path = games.path
+                )
+                WHERE path IN (SELECT path FROM pending_descriptions)
+                """
+            )
+        _restore_media_files(conn)
         conn.commit()
     finally:
         conn.close()
 
 
 def cache_exists(db_path):
-    return os.path.exists(db_path)
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'games'").fetchone()
+        return row is not None
+    finally:
+        conn.close()
 
 
 def ensure_cache(curated_xml_path, db_path, support_root):
@@ -307,15 +338,30 @@ def get_all_columns(db_path):
 def get_groupable_fields(db_path):
     columns = get_all_columns(db_path)
     fields = [col for col in columns if col not in NON_GROUPABLE_FIELDS]
-    return fields
+    return fields + MEDIA_TREE_FIELDS
 
 
 def get_field_label(field_name):
     return FIELD_LABELS.get(field_name, field_name)
 
 
+TREE_ROWS_SELECT = """
+    SELECT games.*,
+           COALESCE(media.media_missing, '') AS media_missing,
+           COALESCE(media.media_bytes, 0) AS media_bytes
+    FROM games
+    LEFT JOIN (
+        SELECT db_id,
+               GROUP_CONCAT(CASE WHEN exists_flag = 0 THEN tag END, ', ') AS media_missing,
+               SUM(size) AS media_bytes
+        FROM media_files
+        GROUP BY db_id
+    ) AS media ON media.db_id = games.db_id
+"""
+
+
 def _validate_order_fields(db_path, field_names):
-    available = set(get_all_columns(db_path))
+    available = set(get_all_columns(db_path)) | set(MEDIA_TREE_FIELDS)
     return [field for field in field_names if field in available]
 
 
@@ -352,12 +398,55 @@ def load_tree_rows(db_path, grouping_fields):
 
     conn = get_connection(db_path)
     try:
-        rows = conn.execute(f"SELECT * FROM games ORDER BY {order_clause}").fetchall()
+        _ensure_media_tables(conn)
+        rows = conn.execute(f"{TREE_ROWS_SELECT} ORDER BY {order_clause}").fetchall()
         return [dict(row) for row in rows]
     finally:
         conn.close()
 
 
+def load_group_disk_usage(db_path, grouping_fields):
+    """Байты существующих медиафайлов по группам дерева.
+
+    Возвращает {(значение поля 1, ..., значение поля N): байты} для каждого
+    уровня группировки. Файл, на который ссылаются несколько игр группы,
+    учитывается один раз."""
+    fields = _validate_order_fields(db_path, grouping_fields)
+    usage = {}
+    if not fields:
+        return usage
+
+    # Производные поля инвентаря нужны только при группировке по ним
+    if any(field in MEDIA_TREE_FIELDS for field in fields):
+        source = f"({TREE_ROWS_SELECT})"
+    else:
+        source = "games"
+
+    conn = get_connection(db_path)
+    try:
+        _ensure_media_tables(conn)
+        for depth in range(1, len(fields) + 1):
+            columns = ", ".join(f"tree.{_quote_identifier(field)}" for field in fields[:depth])
+            group_columns = ", ".join(_quote_identifier(field) for field in fields[:depth])
+            rows = conn.execute(
+                f"""
+                SELECT {group_columns}, SUM(size)
+                FROM (
+                    SELECT DISTINCT {columns}, media_files.relative_path, media_files.size
+                    FROM {source} AS tree
+                    JOIN media_files ON media_files.db_id = tree.db_id
+                    WHERE media_files.exists_flag = 1
+                )
+                GROUP BY {group_columns}
+                """
+            ).fetchall()
+            for row in rows:
+                usage[tuple(row[:depth])] = row[depth] or 0
+        return usage
+    finally:
+        conn.close()
+
+
 def get_game_details(db_path, db_id):
     conn = get_connection(db_path)
     try:
@@ -382,3 +471,379 @@ def get_version_candidates(db_path, base_key):
         return [dict(row) for row in rows]
     finally:
         conn.close()
+
+
+def _ensure_file_hash_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            sha1 TEXT NOT NULL
+        )
+        """
+    )
+
+
+def load_file_hashes(db_path, paths):
+    paths = list(paths)
+    found = {}
+    conn = sqlite3.connect(db_path)
+    try:
+        _ensure_file_hash_table(conn)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = conn.execute(
+                f"SELECT path, size, mtime, sha1 FROM file_hashes WHERE path IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for path, size, mtime, sha1 in rows:
+                found[path] = (size, mtime, sha1)
+        return found
+    finally:
+        conn.close()
+
+
+def store_file_hashes(db_path, rows):
+    if not rows:
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        _ensure_file_hash_table(conn)
+        conn.executemany(
+            "INSERT OR REPLACE INTO file_hashes(path, size, mtime, sha1) VALUES(?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _ensure_pending_description_table(conn):
+    # Переведённые описания, которые уже есть в games, но ещё не записаны в curated XML
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pending_descriptions (
+            path TEXT PRIMARY KEY,
+            "desc" TEXT NOT NULL
+        )
+        """
+    )
+
+
+def store_game_descriptions(db_path, rows):
+    """rows: [(path, desc)]; одной транзакцией обновляет games и очередь записи в XML."""
+    if not rows:
+        return
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_pending_description_table(conn)
+        with conn:
+            conn.executemany('UPDATE games SET "desc" = ? WHERE path = ?', [(desc, path) for path, desc in rows])
+            conn.executemany('INSERT OR REPLACE INTO pending_descriptions(path, "desc") VALUES(?, ?)', rows)
+    finally:
+        conn.close()
+
+
+def load_pending_descriptions(db_path):
+    if not os.path.exists(db_path):
+        return {}
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_pending_description_table(conn)
+        return dict(conn.execute('SELECT path, "desc" FROM pending_descriptions').fetchall())
+    finally:
+        conn.close()
+
+
+def clear_pending_descriptions(db_path, descriptions):
+    """Снимает с очереди записанные в XML описания; более новые значения остаются."""
+    if not descriptions:
+        return
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            conn.executemany(
+                'DELETE FROM pending_descriptions WHERE path = ? AND "desc" = ?',
+                list(descriptions.items()),
+            )
+    finally:
+        conn.close()
+
+
+VIDEO_PROBE_FIELDS = (
+    "duration",
+    "width",
+    "height",
+    "frame_rate",
+    "video_codec",
+    "video_bitrate",
+    "audio_bitrate",
+)
+
+
+def _ensure_video_probe_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS video_probes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            frame_rate REAL NOT NULL,
+            video_codec TEXT NOT NULL,
+            video_bitrate INTEGER NOT NULL,
+            audio_bitrate INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def load_video_probes(db_path, paths):
+    paths = list(paths)
+    found = {}
+    conn = get_connection(db_path)
+    try:
+        _ensure_video_probe_table(conn)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = conn.execute(
+                f"SELECT * FROM video_probes WHERE path IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for row in rows:
+                found[row["path"]] = dict(row)
+        return found
+    finally:
+        conn.close()
+
+
+def store_video_probes(db_path, probes):
+    rows = [
+        (path, probe["size"], probe["mtime"]) + tuple(probe[field] for field in VIDEO_PROBE_FIELDS)
+        for path, probe in probes.items()
+    ]
+    if not rows:
+        return
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_video_probe_table(conn)
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO video_probes(path, size, mtime, {", ".join(VIDEO_PROBE_FIELDS)})
+            VALUES({", ".join("?" for _ in range(len(VIDEO_PROBE_FIELDS) + 3))})
+            """,
+            rows,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _ensure_media_tables(conn):
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS collection_dirs (
+            relative_dir TEXT PRIMARY KEY,
+            parent_dir TEXT,
+            mtime_ns INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS collection_files (
+            relative_path TEXT PRIMARY KEY,
+            relative_dir TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_collection_files_dir ON collection_files(relative_dir);
+        CREATE TABLE IF NOT EXISTS media_files (
+            db_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            relative_path TEXT NOT NULL,
+            exists_flag INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL
+        );
+        DROP INDEX IF EXISTS idx_media_files_db_id;
+        -- Покрывающий индекс: агрегаты по играм не читают саму таблицу
+        CREATE INDEX IF NOT EXISTS idx_media_files_usage
+            ON media_files(db_id, exists_flag, relative_path, size);
+        CREATE INDEX IF NOT EXISTS idx_media_files_path ON media_files(relative_path);
+        """
+    )
+
+
+def _stash_media_files(conn):
+    conn.execute("DROP TABLE IF EXISTS temp.media_files_by_path")
+    games_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'games'"
+    ).fetchone()
+    if not games_exists:
+        return
+    conn.execute(
+        """
+        CREATE TEMP TABLE media_files_by_path AS
+        SELECT games.path AS game_path, media_files.tag, media_files.relative_path,
+               media_files.exists_flag, media_files.size, media_files.mtime
+        FROM media_files
+        JOIN games ON games.db_id = media_files.db_id
+        """
+    )
+
+
+def _restore_media_files(conn):
+    # db_id пересоздаются вместе с таблицей games: переносим инвентарь по пути игры,
+    # чтобы после исключения игр размеры групп были доступны сразу, без пересканирования
+    conn.execute("DELETE FROM media_files")
+    stashed = conn.execute(
+        "SELECT 1 FROM sqlite_temp_master WHERE type = 'table' AND name = 'media_files_by_path'"
+    ).fetchone()
+    if not stashed:
+        return
+    conn.execute(
+        """
+        INSERT INTO media_files(db_id, tag, relative_path, exists_flag, size, mtime)
+        SELECT games.db_id, stash.tag, stash.relative_path, stash.exists_flag, stash.size, stash.mtime
+        FROM temp.media_files_by_path AS stash
+        JOIN games ON games.path = stash.game_path
+        """
+    )
+    conn.execute("DROP TABLE temp.media_files_by_path")
+
+
+def _refresh_collection_files(conn, collection_root):
+    collection_root = os.path.abspath(collection_root)
+    known_dirs = {}
+    children = {}
+    for relative_dir, parent_dir, mtime_ns in conn.execute(
+        "SELECT relative_dir, parent_dir, mtime_ns FROM collection_dirs"
+    ):
+        known_dirs[relative_dir] = mtime_ns
+        if parent_dir is not None:
+            children.setdefault(parent_dir, []).append(relative_dir)
+
+    seen_dirs = set()
+    rescanned_dirs = 0
+    stack = [("", None)]
+    while stack:
+        relative_dir, parent_dir = stack.pop()
+        directory = os.path.join(collection_root, relative_dir.replace("/", os.sep)) if relative_dir else collection_root
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        seen_dirs.add(relative_dir)
+
+        # Каталог не менялся: его файлы и подкаталоги берём из кэша
+        if known_dirs.get(relative_dir) == mtime_ns:
+            stack.extend((child, relative_dir) for child in children.get(relative_dir, []))
+            continue
+
+        try:
+            files, subdirs = scan_directory(directory, is_root=not relative_dir)
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+            continue
+
+        prefix = relative_dir + "/" if relative_dir else ""
+        conn.execute("DELETE FROM collection_files WHERE relative_dir = ?", (relative_dir,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO collection_files(relative_path, relative_dir, size, mtime) VALUES(?, ?, ?, ?)",
+            [(prefix + name, relative_dir, size, mtime) for name, size, mtime in files],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO collection_dirs(relative_dir, parent_dir, mtime_ns) VALUES(?, ?, ?)",
+            (relative_dir, parent_dir, mtime_ns),
+        )
+        stack.extend((prefix + name, relative_dir) for name in subdirs)
+        rescanned_dirs += 1
+
+    removed_dirs = [(relative_dir,) for relative_dir in known_dirs if relative_dir not in seen_dirs]
+    conn.executemany("DELETE FROM collection_files WHERE relative_dir = ?", removed_dirs)
+    conn.executemany("DELETE FROM collection_dirs WHERE relative_dir = ?", removed_dirs)
+    return rescanned_dirs
+
+
+def _collection_index(conn):
+    return {
+        index_key(relative_path): (relative_path, size, mtime)
+        for relative_path, size, mtime in conn.execute(
+            "SELECT relative_path, size, mtime FROM collection_files"
+        )
+    }
+
+
+def _rebuild_media_files(conn, reference_tags, collection_root):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(games)")]
+    tags = [column for column in columns if column.lower() in reference_tags]
+    index = _collection_index(conn)
+
+    rows = []
+    if tags:
+        select_sql = "SELECT db_id, " + ", ".join(_quote_identifier(tag) for tag in tags) + " FROM games"
+        for game_row in conn.execute(select_sql):
+            db_id = game_row[0]
+            for tag, value in zip(tags, game_row[1:]):
+                reference = normalize_reference(value)
+                if reference is None:
+                    continue
+                record = index.get(index_key(reference)) or stat_skipped_reference(collection_root, reference)
+                if record is None:
+                    rows.append((db_id, tag, reference, 0, 0, 0))
+                else:
+                    rows.append((db_id, tag, record[0], 1, record[1], record[2]))
+
+    conn.execute("DELETE FROM media_files")
+    conn.executemany(
+        """
+        INSERT INTO media_files(db_id, tag, relative_path, exists_flag, size, mtime)
+        VALUES(?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    return len(rows)
+
+
+def refresh_media_inventory(db_path, collection_root, reference_tags):
+    """Инкрементально обновляет индекс файлов коллекции по mtime каталогов
+    и пересобирает таблицу media_files (ссылки игр на файлы)."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_media_tables(conn)
+        rescanned_dirs = _refresh_collection_files(conn, collection_root)
+        media_count = _rebuild_media_files(conn, {tag.lower() for tag in reference_tags}, collection_root)
+        conn.commit()
+        return {"rescanned_dirs": rescanned_dirs, "media_files": media_count}
+    finally:
+        conn.close()
+
+
+def load_media_index(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_media_tables(conn)
+        return _collection_index(conn)
+    finally:
+        conn.close()
+
+
+def load_media_presence(db_path):
+    """Ключи index_key всех существующих файлов коллекции для проверок в потоке интерфейса.
+
+    Кроме просканированных файлов сюда попадают найденные ссылки в пропущенные каталоги.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _ensure_media_tables(conn)
+        presence = set(_collection_index(conn))
+        presence.update(
+            index_key(relative_path)
+            for (relative_path,) in conn.execute("SELECT relative_path FROM media_files WHERE exists_flag = 1")
+        )
+        return presence
+    finally:
+        conn.close()
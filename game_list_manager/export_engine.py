@@ -0,0 +1,837 @@
+import concurrent.futures
+import errno
+import hashlib
+import io
+import json
+import os
+import queue
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+from db_cache import load_file_hashes, store_file_hashes
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+EXPORT_MANIFEST_FILENAME = ".export_manifest.json"
+EXPORT_JOURNAL_FILENAME = ".export_journal.jsonl"
+DEFAULT_EXPORT_WORKERS = 4
+COPY_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.5
+COPY_FILE_RANGE_CHUNK = 64 * 1024 * 1024
+FICLONE = 0x40049409
+
+EXPORT_STRATEGIES = ("auto", "hardlink", "reflink", "copy_file_range", "copy")
+DEFAULT_EXPORT_STRATEGY = "auto"
+DEDUP_MODES = ("off", "link", "reference")
+
+ARCHIVE_FORMATS = ("zip", "tar")
+# Эти форматы уже сжаты: повторный deflate только тратит CPU
+STORED_EXTENSIONS = {
+    '.zip', '.7z', '.rar', '.chd', '.gz', '.xz', '.bz2', '.cso', '.pbp',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.mp4', '.avi', '.mkv', '.webm', '.flv',
+    '.mp3', '.ogg', '.flac', '.opus',
+    '.pdf',
+}
+ARCHIVE_ENTRY_OVERHEAD = 512
+# Ошибки, означающие "файловая система так не умеет", а не сбой копирования
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EMLINK,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def format_bytes(size):
+    size = float(size or 0)
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(max(seconds, 0))
+    return f"{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+def build_copy_plan(source_root, export_root, files):
+    """files: {относительный posix-путь: (размер, mtime)} из индекса коллекции."""
+    source_root = str(source_root)
+    export_root = str(export_root)
+    entries = []
+    for relative_path, (size, mtime) in files.items():
+        native_path = relative_path.replace("/", os.sep)
+        entries.append({
+            "source": os.path.join(source_root, native_path),
+            "destination": os.path.join(export_root, native_path),
+            "relative": relative_path,
+            "size": size,
+            "mtime": mtime,
+        })
+
+    # Крупные файлы первыми: хвост из одного большого видео не растягивает экспорт
+    entries.sort(key=lambda entry: (-entry["size"], entry["relative"]))
+    return {
+        "entries": entries,
+        "total_bytes": sum(entry["size"] for entry in entries),
+    }
+
+
+def load_export_manifest(export_root):
+    files = {}
+    manifest_path = os.path.join(export_root, EXPORT_MANIFEST_FILENAME)
+    journal_path = os.path.join(export_root, EXPORT_JOURNAL_FILENAME)
+
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                files.update(json.load(f).get("files", {}))
+        except Exception as e:
+            print(f"Error reading export manifest: {e}")
+
+    if os.path.exists(journal_path):
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла оборваться при аварийном завершении
+                    continue
+                files[record.pop("relative")] = record
+
+    return files
+
+
+def write_export_manifest(export_root, files):
+    manifest_path = os.path.join(export_root, EXPORT_MANIFEST_FILENAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "files": files}, f, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+    journal_path = os.path.join(export_root, EXPORT_JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_record(entry):
+    record = {"size": entry["size"], "mtime": entry["mtime"]}
+    # Параметры сжатия при экспорте: с другими настройками видео кодируется заново
+    if entry.get("transcode"):
+        record["transcode"] = entry["transcode"]
+    return record
+
+
+def classify_entry(entry, manifest_files, verify_hash=False):
+    """Возвращает "skip", "verify" или "copy" для файла плана."""
+    try:
+        destination_stat = os.stat(entry["destination"])
+    except OSError:
+        return "copy"
+
+    # Файл из манифеста уже экспортирован из того же исходника, даже если
+    # его потом пережали в каталоге экспорта
+    record = manifest_files.get(entry["relative"])
+    if (
+        record
+        and record.get("size") == entry["size"]
+        and record.get("mtime") == entry["mtime"]
+        and record.get("transcode") == entry.get("transcode")
+    ):
+        return "skip"
+
+    if destination_stat.st_size == entry["size"]:
+        if int(destination_stat.st_mtime) == entry["mtime"]:
+            return "skip"
+        if verify_hash:
+            return "verify"
+    return "copy"
+
+
+def export_path(export_root, relative_path):
+    parts = relative_path.split("/")
+    if not relative_path or ".." in parts or os.path.isabs(relative_path):
+        return None
+    return os.path.join(export_root, *parts)
+
+
+def remove_empty_parents(path, export_root):
+    export_root = os.path.abspath(export_root)
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != export_root and directory.startswith(export_root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def prune_orphaned_files(export_root, manifest_files, planned_relatives):
+    """Удаляет из экспорта файлы прошлого экспорта, которых больше нет в плане."""
+    removed_files = 0
+    removed_bytes = 0
+    for relative_path in sorted(set(manifest_files) - planned_relatives):
+        manifest_files.pop(relative_path, None)
+        path = export_path(export_root, relative_path)
+        if path is None:
+            continue
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            print(f"Error removing orphaned export file {path}: {e}")
+            continue
+        removed_files += 1
+        removed_bytes += size
+        remove_empty_parents(path, export_root)
+    return removed_files, removed_bytes
+
+
+def find_duplicate_files(files, workers=DEFAULT_EXPORT_WORKERS, cache_db_path=None):
+    """Находит файлы с одинаковым содержимым: {дубликат: канонический файл}.
+
+    files - {путь: (размер, mtime)}. Хэшируются только файлы с совпадающим
+    размером; хэши кэшируются в SQLite по пути, размеру и mtime.
+    """
+    stats = dict(files)
+    by_size = {}
+    for path, (size, _) in stats.items():
+        by_size.setdefault(size, []).append(path)
+
+    candidates = [path for size, group in by_size.items() if size > 0 and len(group) > 1 for path in group]
+    cached = load_file_hashes(cache_db_path, candidates) if cache_db_path else {}
+
+    hashes = {}
+    to_hash = []
+    for path in candidates:
+        size, mtime = stats[path]
+        record = cached.get(path)
+        if record and record[0] == size and record[1] == mtime:
+            hashes[path] = record[2]
+        else:
+            to_hash.append(path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(workers), 1)) as executor:
+        for path, digest in zip(to_hash, executor.map(file_digest, to_hash)):
+            hashes[path] = digest
+
+    if cache_db_path:
+        store_file_hashes(cache_db_path, [(path, *stats[path], hashes[path]) for path in to_hash])
+
+    groups = {}
+    for path in sorted(hashes):
+        groups.setdefault((stats[path][0], hashes[path]), []).append(path)
+
+    duplicates = {}
+    for group in groups.values():
+        canonical = group[0]
+        for path in group[1:]:
+            duplicates[path] = canonical
+    return duplicates, sum(stats[path][0] for path in duplicates)
+
+
+def link_duplicate_file(entry, progress, cancel_event):
+    """Дубликат становится жёсткой ссылкой на уже экспортированную каноническую копию."""
+    if cancel_event.is_set():
+        raise ExportCancelled()
+    try:
+        _write_via_temp(entry["destination"], lambda temp_path: os.link(entry["link_to"], temp_path))
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS and e.errno != errno.ENOENT:
+            raise
+        copy_file_chunked(entry["source"], entry["destination"], progress, cancel_event)
+        return False
+    return True
+
+
+class CopyProgress:
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.copied_bytes = 0
+        self.linked_bytes = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.done_bytes += count
+            self.copied_bytes += count
+
+    def link_bytes(self, count):
+        # reflink и hardlink не переносят данные: в скорость и ETA их не считаем
+        with self._lock:
+            self.done_bytes += count
+            self.linked_bytes += count
+
+    def skip_file(self, size):
+        with self._lock:
+            self.done_files += 1
+            self.done_bytes += size
+
+    def finish_file(self):
+        with self._lock:
+            self.done_files += 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started_at, 1e-6)
+            bytes_per_second = self.copied_bytes / elapsed
+            remaining = self.total_bytes - self.done_bytes
+            eta = remaining / bytes_per_second if bytes_per_second > 0 else None
+            return {
+                "done_files": self.done_files,
+                "total_files": self.total_files,
+                "done_bytes": self.done_bytes,
+                "total_bytes": self.total_bytes,
+                "linked_bytes": self.linked_bytes,
+                "bytes_per_second": bytes_per_second,
+                "eta_seconds": eta,
+            }
+
+
+def _write_via_temp(destination_path, write_temp):
+    temp_path = destination_path + ".part"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        write_temp(temp_path)
+        os.replace(temp_path, destination_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _write_with_progress(destination_path, write_temp, progress):
+    """Как _write_via_temp, но байты недописанного файла вычитаются из прогресса.
+
+    Иначе после отката на другой способ копирования они считались бы дважды.
+    """
+    reported = [0]
+
+    def add_bytes(count):
+        reported[0] += count
+        progress.add_bytes(count)
+
+    try:
+        _write_via_temp(destination_path, lambda temp_path: write_temp(temp_path, add_bytes))
+    except BaseException:
+        progress.add_bytes(-reported[0])
+        raise
+
+
+def copy_file_chunked(source_path, destination_path, progress, cancel_event):
+    def write_temp(temp_path, add_bytes):
+        with open(source_path, "rb") as src, open(temp_path, "wb") as dst:
+            while True:
+                if cancel_event.is_set():
+                    raise ExportCancelled()
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                add_bytes(len(chunk))
+        shutil.copystat(source_path, temp_path)
+
+    _write_with_progress(destination_path, write_temp, progress)
+
+
+def copy_file_kernel(source_path, destination_path, progress, cancel_event):
+    def write_temp(temp_path, add_bytes):
+        with open(source_path, "rb") as src, open(temp_path, "wb") as dst:
+            while True:
+                if cancel_event.is_set():
+                    raise ExportCancelled()
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), COPY_FILE_RANGE_CHUNK)
+                if copied == 0:
+                    break
+                add_bytes(copied)
+        shutil.copystat(source_path, temp_path)
+
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    _write_with_progress(destination_path, write_temp, progress)
+
+
+def reflink_file(source_path, destination_path, progress, cancel_event):
+    def write_temp(temp_path):
+        with open(source_path, "rb") as src, open(temp_path, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source_path, temp_path)
+
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "FICLONE is not available")
+    _write_via_temp(destination_path, write_temp)
+    progress.link_bytes(os.path.getsize(destination_path))
+
+
+def hardlink_file(source_path, destination_path, progress, cancel_event):
+    _write_via_temp(destination_path, lambda temp_path: os.link(source_path, temp_path))
+    progress.link_bytes(os.path.getsize(destination_path))
+
+
+TRANSFER_METHODS = {
+    "reflink": reflink_file,
+    "hardlink": hardlink_file,
+    "copy_file_range": copy_file_kernel,
+    "copy": copy_file_chunked,
+}
+
+
+class FileTransfer:
+    """Выбирает способ переноса файла и запоминает рабочий вариант для пары устройств."""
+
+    def __init__(self, strategy=DEFAULT_EXPORT_STRATEGY):
+        if strategy not in EXPORT_STRATEGIES:
+            raise ValueError(f"Unknown export strategy: {strategy}")
+        self.strategy = strategy
+        self.method_counts = {}
+        self._device_methods = {}
+        self._lock = threading.Lock()
+
+    def candidate_methods(self, same_device):
+        if self.strategy == "auto":
+            # Жёсткая ссылка делит inode с коллекцией: правка файла в экспорте изменила бы
+            # оригинал, поэтому hardlink только по явному выбору
+            if same_device:
+                return ["reflink", "copy_file_range", "copy"]
+            return ["copy_file_range", "copy"]
+        if self.strategy == "copy":
+            return ["copy"]
+        return [self.strategy, "copy"]
+
+    def transfer(self, source_path, destination_path, progress, cancel_event):
+        source_device = os.stat(source_path).st_dev
+        destination_device = os.stat(os.path.dirname(destination_path)).st_dev
+        device_key = (source_device, destination_device)
+
+        with self._lock:
+            methods = self._device_methods.get(device_key)
+            if methods is None:
+                methods = self.candidate_methods(source_device == destination_device)
+
+        for method in methods:
+            try:
+                TRANSFER_METHODS[method](source_path, destination_path, progress, cancel_event)
+            except OSError as e:
+                if method == "copy" or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                with self._lock:
+                    current = self._device_methods.get(device_key, methods)
+                    if method in current:
+                        self._device_methods[device_key] = [m for m in current if m != method]
+                print(f"Export method {method} is not supported here ({e}), falling back")
+                continue
+
+            with self._lock:
+                self._device_methods.setdefault(device_key, methods[methods.index(method):])
+                self.method_counts[method] = self.method_counts.get(method, 0) + 1
+            return method
+
+        raise OSError(errno.EIO, f"No export method worked for {source_path}")
+
+
+def run_copy_plan(
+    plan,
+    export_root,
+    workers=DEFAULT_EXPORT_WORKERS,
+    progress_callback=None,
+    cancel_event=None,
+    prune=False,
+    verify_hash=False,
+    strategy=DEFAULT_EXPORT_STRATEGY,
+    transcoder=None,
+    transcode_jobs=1,
+):
+    """Копирует план в каталог экспорта.
+
+    transcoder(source, output, cancel_event) кодирует файлы с пометкой "transcode"
+    прямо из исходной коллекции; None в ответ означает обычное копирование.
+    """
+    export_root = str(export_root)
+    cancel_event = cancel_event or threading.Event()
+    file_transfer = FileTransfer(strategy)
+    workers = max(int(workers), 1)
+    entries = plan["entries"]
+    progress = CopyProgress(len(entries), plan["total_bytes"])
+
+    os.makedirs(export_root, exist_ok=True)
+    manifest_files = load_export_manifest(export_root)
+    for directory in {os.path.dirname(entry["destination"]) for entry in entries}:
+        os.makedirs(directory, exist_ok=True)
+
+    removed_files, removed_bytes = 0, 0
+    if prune:
+        removed_files, removed_bytes = prune_orphaned_files(
+            export_root, manifest_files, {entry["relative"] for entry in entries}
+        )
+
+    pending = []
+    pending_links = []
+    skipped_files = 0
+    for entry in entries:
+        action = classify_entry(entry, manifest_files, verify_hash)
+        if action == "skip":
+            manifest_files[entry["relative"]] = manifest_record(entry)
+            progress.skip_file(entry["size"])
+            skipped_files += 1
+        elif entry.get("link_to"):
+            pending_links.append(entry)
+        else:
+            pending.append((entry, action))
+
+    copied_files = 0
+    transcoded_files = 0
+    failed_files = []
+    journal_path = os.path.join(export_root, EXPORT_JOURNAL_FILENAME)
+    last_report = 0.0
+
+    def report(force=False):
+        nonlocal last_report
+        now = time.monotonic()
+        if progress_callback and (force or now - last_report >= PROGRESS_INTERVAL):
+            last_report = now
+            progress_callback(progress.snapshot())
+
+    def copy_entry(entry, action):
+        if action == "verify" and file_digest(entry["source"]) == file_digest(entry["destination"]):
+            shutil.copystat(entry["source"], entry["destination"])
+            progress.skip_file(entry["size"])
+            return "skipped"
+        file_transfer.transfer(entry["source"], entry["destination"], progress, cancel_event)
+        progress.finish_file()
+        return "copied"
+
+    def transcode_entry(entry, action):
+        # ffmpeg выбирает формат по расширению, поэтому не ".part"
+        temp_path = entry["destination"] + ".part.mp4"
+        try:
+            stats = transcoder(entry["source"], temp_path, cancel_event)
+            if stats is not None:
+                os.replace(temp_path, entry["destination"])
+        except Exception as e:
+            if cancel_event.is_set():
+                raise ExportCancelled()
+            # Экспорт без видео хуже, чем экспорт несжатого видео
+            print(f"Error transcoding {entry['source']}, copying original: {e}")
+            stats = None
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+        if stats is None:
+            # Сжатие не уменьшит файл: обычное копирование
+            return copy_entry(entry, action)
+        progress.add_bytes(entry["size"])
+        progress.finish_file()
+        return "transcoded"
+
+    # Конвейер: раздатчик -> ограниченные очереди копирования и кодирования -> очередь
+    # результатов, которую разбирает только этот поток (журнал пишет один писатель)
+    transcode_jobs = max(int(transcode_jobs), 1) if transcoder else 0
+    copy_queue = queue.Queue(maxsize=workers * 2)
+    transcode_queue = queue.Queue(maxsize=transcode_jobs * 2 or 1)
+    results = queue.Queue(maxsize=(workers + transcode_jobs) * 2)
+
+    def put_checked(target_queue, item):
+        while not cancel_event.is_set():
+            try:
+                target_queue.put(item, timeout=PROGRESS_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    feeder_errors = []
+
+    def feeder():
+        try:
+            for entry, action in pending:
+                target_queue = transcode_queue if transcoder and entry.get("transcode") else copy_queue
+                if not put_checked(target_queue, (entry, action)):
+                    break
+        except Exception as e:
+            feeder_errors.append(e)
+            cancel_event.set()
+        finally:
+            # Без маркеров конца рабочие потоки и цикл результатов ждали бы вечно
+            for _ in range(workers):
+                copy_queue.put(None)
+            for _ in range(transcode_jobs):
+                transcode_queue.put(None)
+
+    def stage_worker(source_queue, handle):
+        try:
+            while True:
+                item = source_queue.get()
+                if item is None:
+                    break
+                entry, action = item
+                if cancel_event.is_set():
+                    continue
+                try:
+                    results.put((entry, handle(entry, action), None))
+                except ExportCancelled:
+                    pass
+                except Exception as e:
+                    # ffmpeg при отмене завершается своей ошибкой
+                    if not cancel_event.is_set():
+                        results.put((entry, "failed", e))
+        finally:
+            results.put(None)
+
+    threads = [threading.Thread(target=feeder, daemon=True)]
+    threads += [threading.Thread(target=stage_worker, args=(copy_queue, copy_entry), daemon=True)
+                for _ in range(workers)]
+    threads += [threading.Thread(target=stage_worker, args=(transcode_queue, transcode_entry), daemon=True)
+                for _ in range(transcode_jobs)]
+    for thread in threads:
+        thread.start()
+
+    with open(journal_path, "a", encoding="utf-8") as journal:
+        def record_done(entry):
+            record = manifest_record(entry)
+            manifest_files[entry["relative"]] = record
+            journal.write(json.dumps(dict(record, relative=entry["relative"]), ensure_ascii=False) + "\n")
+
+        running_workers = workers + transcode_jobs
+        while running_workers:
+            try:
+                item = results.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                journal.flush()
+                report()
+                continue
+            if item is None:
+                running_workers -= 1
+                continue
+            entry, outcome, error = item
+            if outcome == "failed":
+                print(f"Error copying {entry['source']}: {error}")
+                failed_files.append(entry["source"])
+                continue
+            if outcome == "copied":
+                copied_files += 1
+            elif outcome == "transcoded":
+                transcoded_files += 1
+            else:
+                skipped_files += 1
+            record_done(entry)
+            report()
+        journal.flush()
+        if feeder_errors:
+            raise feeder_errors[0]
+
+        # Дубликаты связываются после того, как скопированы канонические файлы
+        linked_files = 0
+        for entry in pending_links:
+            if cancel_event.is_set():
+                break
+            try:
+                if link_duplicate_file(entry, progress, cancel_event):
+                    linked_files += 1
+                    progress.skip_file(entry["size"])
+                else:
+                    copied_files += 1
+                    progress.finish_file()
+                record_done(entry)
+            except ExportCancelled:
+                break
+            except Exception as e:
+                print(f"Error linking duplicate {entry['source']}: {e}")
+                failed_files.append(entry["source"])
+            report()
+        journal.flush()
+
+    cancelled = cancel_event.is_set()
+    if not cancelled:
+        write_export_manifest(export_root, manifest_files)
+    report(force=True)
+
+    return {
+        "copied_files": copied_files,
+        "transcoded_files": transcoded_files,
+        "skipped_files": skipped_files,
+        "linked_files": linked_files,
+        "removed_files": removed_files,
+        "removed_bytes": removed_bytes,
+        "failed_files": failed_files,
+        "transfer_methods": dict(file_transfer.method_counts),
+        "copied_bytes": progress.copied_bytes,
+        "total_bytes": plan["total_bytes"],
+        "elapsed_seconds": time.monotonic() - progress.started_at,
+        "cancelled": cancelled,
+    }
+
+
+class ProgressReader:
+    """Файловый объект для tarfile: чтение с учётом прогресса и отмены."""
+
+    def __init__(self, fileobj, progress, cancel_event):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.cancel_event = cancel_event
+
+    def read(self, size=-1):
+        if self.cancel_event.is_set():
+            raise ExportCancelled()
+        data = self.fileobj.read(size)
+        self.progress.add_bytes(len(data))
+        return data
+
+
+def split_archive_parts(entries, part_size):
+    if not part_size:
+        return [list(entries)]
+
+    parts = [[]]
+    current_size = 0
+    for entry in entries:
+        entry_size = entry["size"] + ARCHIVE_ENTRY_OVERHEAD
+        if parts[-1] and current_size + entry_size > part_size:
+            parts.append([])
+            current_size = 0
+        parts[-1].append(entry)
+        current_size += entry_size
+    return parts
+
+
+def archive_part_paths(archive_base, archive_format, parts_count):
+    if parts_count == 1:
+        return [f"{archive_base}.{archive_format}"]
+    return [f"{archive_base}.part{index:02d}.{archive_format}" for index in range(1, parts_count + 1)]
+
+
+def _write_zip_part(part_path, entries, extra_files, progress, cancel_event):
+    with zipfile.ZipFile(part_path, "w", allowZip64=True) as archive:
+        for arcname, data in extra_files:
+            archive.writestr(arcname, data, compress_type=zipfile.ZIP_DEFLATED)
+        for entry in entries:
+            extension = os.path.splitext(entry["relative"])[1].lower()
+            zip_info = zipfile.ZipInfo.from_file(entry["source"], entry["relative"], strict_timestamps=False)
+            zip_info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with open(entry["source"], "rb") as src, archive.open(zip_info, "w", force_zip64=True) as dst:
+                while True:
+                    if cancel_event.is_set():
+                        raise ExportCancelled()
+                    chunk = src.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    progress.add_bytes(len(chunk))
+            progress.finish_file()
+
+
+def _write_tar_part(part_path, entries, extra_files, progress, cancel_event):
+    with tarfile.open(part_path, "w", format=tarfile.PAX_FORMAT) as archive:
+        for arcname, data in extra_files:
+            tar_info = tarfile.TarInfo(arcname)
+            tar_info.size = len(data)
+            tar_info.mtime = int(time.time())
+            archive.addfile(tar_info, io.BytesIO(data))
+        for entry in entries:
+            tar_info = archive.gettarinfo(entry["source"], arcname=entry["relative"])
+            with open(entry["source"], "rb") as src:
+                archive.addfile(tar_info, ProgressReader(src, progress, cancel_event))
+            progress.finish_file()
+
+
+def run_archive_plan(
+    plan,
+    archive_base,
+    archive_format="zip",
+    part_size=0,
+    extra_files=(),
+    progress_callback=None,
+    cancel_event=None,
+):
+    """Пишет файлы плана прямо в архив (или несколько частей) без промежуточной папки."""
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+
+    cancel_event = cancel_event or threading.Event()
+    entries = sorted(plan["entries"], key=lambda entry: entry["relative"])
+    progress = CopyProgress(len(entries), plan["total_bytes"])
+    parts = split_archive_parts(entries, part_size)
+    part_paths = archive_part_paths(archive_base, archive_format, len(parts))
+    write_part = _write_zip_part if archive_format == "zip" else _write_tar_part
+    os.makedirs(os.path.dirname(archive_base), exist_ok=True)
+
+    stop_reporting = threading.Event()
+
+    def report_loop():
+        while not stop_reporting.wait(PROGRESS_INTERVAL):
+            progress_callback(progress.snapshot())
+
+    reporter = None
+    if progress_callback:
+        reporter = threading.Thread(target=report_loop, daemon=True)
+        reporter.start()
+
+    written_paths = []
+    cancelled = False
+    try:
+        for index, (part_entries, part_path) in enumerate(zip(parts, part_paths)):
+            temp_path = part_path + ".tmp"
+            try:
+                write_part(temp_path, part_entries, extra_files if index == 0 else (), progress, cancel_event)
+                os.replace(temp_path, part_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                # Без остальных частей готовые выглядят целым архивом, но половины файлов в них нет
+                for written_path in written_paths:
+                    if os.path.exists(written_path):
+                        os.remove(written_path)
+                written_paths = []
+                raise
+            written_paths.append(part_path)
+    except ExportCancelled:
+        cancelled = True
+    finally:
+        stop_reporting.set()
+        if reporter is not None:
+            reporter.join()
+        if progress_callback:
+            progress_callback(progress.snapshot())
+
+    return {
+        "archive_paths": written_paths,
+        "archived_files": progress.done_files,
+        "copied_bytes": progress.copied_bytes,
+        "total_bytes": plan["total_bytes"],
+        "elapsed_seconds": time.monotonic() - progress.started_at,
+        "cancelled": cancelled,
+    }
@@ -0,0 +1,249 @@
+import concurrent.futures
+import json
+import os
+import time
+import uuid
+
+from PIL import Image
+
+from compression_engine import file_signature
+from export_engine import export_path
+from media_index import SKIPPED_DIR_NAMES, index_key
+from xml_handler import rewrite_file_references
+
+
+IMAGE_MANIFEST_FILENAME = ".image_manifest.json"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+IMAGE_FORMATS = ("keep", "png", "jpeg", "webp")
+FORMAT_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+EXTENSION_FORMATS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp", ".bmp": "png"}
+DEFAULT_MAX_DIMENSION = 640
+DEFAULT_IMAGE_QUALITY = 85
+
+
+def image_params(max_dimension, image_format, quality):
+    return {
+        "max_dimension": int(max_dimension),
+        "format": image_format if image_format in IMAGE_FORMATS else "keep",
+        "quality": int(quality),
+    }
+
+
+def has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def target_format(source_path, image, params):
+    """Формат и путь результата; JPEG без альфа-канала, занятое имя не перезаписываем."""
+    stem, extension = os.path.splitext(source_path)
+    source_format = EXTENSION_FORMATS[extension.lower()]
+    image_format = source_format if params["format"] == "keep" else params["format"]
+    if image_format == "jpeg" and has_alpha(image):
+        image_format = source_format if source_format != "jpeg" else "png"
+
+    if image_format == source_format and extension.lower() != ".bmp":
+        return image_format, source_path
+    target_path = stem + FORMAT_EXTENSIONS[image_format]
+    if os.path.exists(target_path):
+        return source_format, source_path
+    return image_format, target_path
+
+
+def optimize_image(source_path, params):
+    """Уменьшает и пережимает одно изображение. Выполняется в отдельном процессе."""
+    input_bytes = os.path.getsize(source_path)
+    with Image.open(source_path) as image:
+        image.load()
+        image_format, target_path = target_format(source_path, image, params)
+
+        resized = max(image.size) > params["max_dimension"]
+        if resized:
+            image.thumbnail((params["max_dimension"], params["max_dimension"]), Image.LANCZOS)
+
+        if image_format == "jpeg":
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            save_options = {"quality": params["quality"], "optimize": True, "progressive": True}
+        elif image_format == "webp":
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if has_alpha(image) else "RGB")
+            save_options = {"quality": params["quality"], "method": 6}
+        else:
+            if image.mode == "CMYK":
+                image = image.convert("RGB")
+            save_options = {"optimize": True}
+
+        temp_path = f"{target_path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            image.save(temp_path, format=image_format.upper(), **save_options)
+            output_bytes = os.path.getsize(temp_path)
+            # Пережатие без уменьшения, которое не выиграло в размере, не применяем
+            if not resized and target_path == source_path and output_bytes >= input_bytes:
+                os.remove(temp_path)
+                return {"output": source_path, "input_bytes": input_bytes, "output_bytes": input_bytes}
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    if target_path != source_path:
+        os.remove(source_path)
+    return {"output": target_path, "input_bytes": input_bytes, "output_bytes": output_bytes}
+
+
+def load_image_manifest(export_root):
+    manifest_path = os.path.join(export_root, IMAGE_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("files", {})
+    except Exception as e:
+        print(f"Error reading image manifest: {e}")
+        return {}
+
+
+def write_image_manifest(export_root, files):
+    manifest_path = os.path.join(export_root, IMAGE_MANIFEST_FILENAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "files": files}, f, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+
+def is_already_optimized(export_root, relative, record, params):
+    """Файл уже обработан с этими настройками и результат на месте.
+
+    Если экспорт заново скопировал исходник, который при оптимизации сменил
+    расширение, пережимать его не нужно: достаточно удалить копию.
+    """
+    if not record or record.get("params") != params:
+        return False
+    output_path = export_path(export_root, record["output_relative"])
+    try:
+        if file_signature(output_path) != record["output"]:
+            return False
+    except OSError:
+        return False
+    if record["output_relative"] == relative:
+        return True
+    source_path = export_path(export_root, relative)
+    if not os.path.exists(source_path):
+        return True
+    if file_signature(source_path) == record["input"]:
+        os.remove(source_path)
+        return True
+    return False
+
+
+def list_export_images(export_root):
+    relatives = []
+    for root, dirs, files in os.walk(export_root):
+        dirs[:] = [name for name in dirs if name.lower() not in SKIPPED_DIR_NAMES and not name.startswith(".")]
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                relatives.append(os.path.relpath(os.path.join(root, name), export_root).replace(os.sep, "/"))
+    return relatives
+
+
+def run_image_optimization(export_root, params, workers=None, progress_callback=None, cancel_event=None):
+    """Оптимизирует изображения экспорта в пуле процессов и правит пути в gamelist.xml."""
+    export_root = os.path.abspath(export_root)
+    started_at = time.monotonic()
+    manifest_files = load_image_manifest(export_root)
+    relatives = list_export_images(export_root)
+
+    # Результаты со сменой расширения сами являются изображениями, но повторно их не пережимаем
+    output_sources = {
+        record["output_relative"]: relative
+        for relative, record in manifest_files.items()
+        if record["output_relative"] != relative
+    }
+    pending = []
+    skipped = set()
+    for listed in relatives:
+        relative = listed
+        record = manifest_files.get(listed)
+        if record is None and listed in output_sources:
+            relative = output_sources[listed]
+            record = manifest_files[relative]
+        if relative in skipped:
+            continue
+        if is_already_optimized(export_root, relative, record, params):
+            skipped.add(relative)
+        else:
+            pending.append(listed)
+
+    result = {
+        "total_files": len(pending),
+        "done_files": 0,
+        "skipped_files": len(skipped),
+        "failed_files": [],
+        "input_bytes": 0,
+        "output_bytes": 0,
+        "renamed_references": 0,
+        "cancelled": False,
+    }
+
+    def report():
+        if progress_callback:
+            snapshot = dict(result)
+            snapshot["failed_files"] = len(result["failed_files"])
+            progress_callback(snapshot)
+
+    # Изображения кодируются на CPU и упираются в GIL, поэтому процессы, а не потоки
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    try:
+        futures = {}
+        for relative in pending:
+            source_path = export_path(export_root, relative)
+            input_signature = file_signature(source_path)
+            futures[executor.submit(optimize_image, source_path, params)] = (relative, input_signature)
+
+        for future in concurrent.futures.as_completed(futures):
+            relative, input_signature = futures[future]
+            try:
+                stats = future.result()
+            except concurrent.futures.CancelledError:
+                continue
+            except Exception as e:
+                print(f"Error optimizing image {relative}: {e}")
+                result["failed_files"].append(relative)
+            else:
+                manifest_files[relative] = {
+                    "params": params,
+                    "input": input_signature,
+                    "output_relative": os.path.relpath(stats["output"], export_root).replace(os.sep, "/"),
+                    "output": file_signature(stats["output"]),
+                }
+                result["done_files"] += 1
+                result["input_bytes"] += stats["input_bytes"]
+                result["output_bytes"] += stats["output_bytes"]
+            report()
+
+            if cancel_event is not None and cancel_event.is_set() and not result["cancelled"]:
+                result["cancelled"] = True
+                executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Записи о файлах, которых больше нет в экспорте, не переносим
+        manifest_files = {
+            relative: record
+            for relative, record in manifest_files.items()
+            if os.path.exists(export_path(export_root, record["output_relative"]))
+        }
+        write_image_manifest(export_root, manifest_files)
+
+    # Переименования из прошлых запусков тоже применяются: экспорт мог заново записать gamelist.xml
+    renames = {
+        index_key(relative): record["output_relative"]
+        for relative, record in manifest_files.items()
+        if record["output_relative"] != relative
+    }
+    xml_path = os.path.join(export_root, "gamelist.xml")
+    if renames and os.path.exists(xml_path):
+        result["renamed_references"] = rewrite_file_references(xml_path, renames)
+
+    result["elapsed_seconds"] = time.monotonic() - started_at
+    report()
+    return result
@@ -0,0 +1,97 @@
+import os
+import posixpath
+import stat
+
+
+# Рабочая папка проекта и backup-копии сжатия не являются частью коллекции
+SKIPPED_ROOT_DIR_NAMES = {"checked"}
+SKIPPED_DIR_NAMES = {"backup"}
+
+
+def index_key(relative_path):
+    return relative_path.lower() if os.name == "nt" else relative_path
+
+
+def normalize_reference(value):
+    """Строковая нормализация ссылки из XML в относительный posix-путь или None."""
+    value = (value or "").strip().replace("\\", "/")
+    if not value or value.startswith("/") or (len(value) > 1 and value[1] == ":"):
+        return None
+
+    normalized = posixpath.normpath(value)
+    if normalized in {".", ".."} or normalized.startswith("../"):
+        return None
+    return normalized
+
+
+def in_skipped_directory(relative_path):
+    directories = [name.lower() for name in relative_path.split("/")[:-1]]
+    if directories and directories[0] in SKIPPED_ROOT_DIR_NAMES:
+        return True
+    return any(name in SKIPPED_DIR_NAMES for name in directories)
+
+
+def stat_skipped_reference(collection_root, relative_path):
+    """Файл из пропущенного сканированием каталога, на который XML всё-таки ссылается.
+
+    Возвращает (относительный путь, размер, mtime) или None. Для обычных путей
+    сразу None: отсутствующие в индексе файлы там действительно отсутствуют.
+    """
+    if not in_skipped_directory(relative_path):
+        return None
+    return stat_collection_file(collection_root, relative_path)
+
+
+def stat_collection_file(collection_root, relative_path):
+    """(относительный путь, размер, mtime) файла коллекции по os.stat или None."""
+    try:
+        stat_result = os.stat(os.path.join(collection_root, *relative_path.split("/")))
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return relative_path, stat_result.st_size, int(stat_result.st_mtime)
+
+
+def scan_directory(directory, is_root=False):
+    """Содержимое одного каталога без рекурсии: ([(имя, размер, mtime)], [подкаталоги])."""
+    files = []
+    subdirs = []
+    skipped = SKIPPED_DIR_NAMES | SKIPPED_ROOT_DIR_NAMES if is_root else SKIPPED_DIR_NAMES
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if entry.name.lower() not in skipped:
+                        subdirs.append(entry.name)
+                    continue
+                if not entry.is_file():
+                    continue
+                stat_result = entry.stat()
+            except OSError:
+                continue
+            files.append((entry.name, stat_result.st_size, int(stat_result.st_mtime)))
+    return files, subdirs
+
+
+def scan_collection(collection_root):
+    """Один проход os.scandir: {ключ: (относительный путь, размер, mtime)}."""
+    collection_root = os.path.abspath(collection_root)
+    index = {}
+    stack = [("", collection_root)]
+
+    while stack:
+        prefix, directory = stack.pop()
+        try:
+            files, subdirs = scan_directory(directory, is_root=not prefix)
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+            continue
+
+        for name, size, mtime in files:
+            relative_path = prefix + name
+            index[index_key(relative_path)] = (relative_path, size, mtime)
+        for name in subdirs:
+            stack.append((prefix + name + "/", os.path.join(directory, name)))
+
+    return index
@@ -1,12 +1,26 @@
 import time
 import threading
 import shutil
-from googletrans import Translator
+import queue
 import tkinter as tk
 from tkinter import ttk, messagebox
-import xml.etree.ElementTree as ET
 import os
 
+from db_cache import store_game_descriptions
+from translation_engine import TranslationEngine, create_backend
+from translation_memory import (
+    lookup_translation, lookup_translations, normalize_source, store_translation, store_translations,
+)
+from xml_handler import flush_pending_descriptions
+
+TRANSLATION_POLL_MS = 200
+# Переводы фиксируются в кэше и памяти переводов транзакциями по FLUSH_SIZE описаний
+FLUSH_SIZE = 50
+
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
 def needs_translation(text):
     if not text or not text.strip():
         return False
@@ -14,23 +28,186 @@ def needs_translation(text):
     has_cyrillic = any(char.lower() in cyrillic_chars for char in text)
     return not has_cyrillic
 
-def translate_text(text, retries=3, delay=1):
-    translator = Translator()
-    for _ in range(retries):
-        try:
-            return translator.translate(text, src='en', dest='ru').text
-        except Exception:
-            time.sleep(delay)
-    return text
+
+def shared_engine():
+    """Один движок на процесс: клиент googletrans и ограничение частоты общие для всех переводов."""
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = TranslationEngine(create_backend())
+        return _shared_engine
+
+
+def translate_text(text):
+    try:
+        return shared_engine().translate(text)
+    except Exception as e:
+        print(f"Error translating text: {e}")
+        return text
+
+
+class PreviewTranslationWorker:
+    """Фоновый перевод описаний для preview с сохранением в translation memory."""
+
+    def __init__(self, memory_path):
+        self.memory_path = memory_path
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self._thread = None
+
+    def submit(self, key, text):
+        self.requests.put((key, text))
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def poll(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def _latest_request(self):
+        key, text = self.requests.get()
+        while True:
+            try:
+                key, text = self.requests.get_nowait()
+            except queue.Empty:
+                return key, text
+
+    def _run(self):
+        while True:
+            key, text = self._latest_request()
+            try:
+                translated = lookup_translation(self.memory_path, text)
+                if translated is None:
+                    translated = translate_text(text)
+                    store_translation(self.memory_path, text, translated)
+            except Exception as e:
+                print(f"Error translating preview description: {e}")
+                translated = text
+            self.results.put((key, text, translated))
+
+
+def translate_descriptions(xml_path, games, memory_path, cache_db_path, engine=None,
+                           progress_callback=None, cancel_event=None):
+    """Переводит описания игр: память переводов, затем пакеты в несколько потоков;
+    неразобранная часть пакета делится и отправляется заново. Без обращений к Tk.
+
+    Переводы небольшими транзакциями пишутся в кэш и память переводов, а в XML
+    попадают одним проходом в конце, поэтому прерванный перевод не теряется.
+    """
+    engine = engine or shared_engine()
+    engine.reset_stats()
+    changed = {}
+    pending_rows = []
+    memory_pairs = []
+
+    def flush_rows():
+        store_game_descriptions(cache_db_path, pending_rows)
+        store_translations(memory_path, memory_pairs)
+        pending_rows.clear()
+        memory_pairs.clear()
+
+    def apply_translation(game, translated_text):
+        changed[game['path']] = translated_text
+        pending_rows.append((game['path'], translated_text))
+        if len(pending_rows) >= FLUSH_SIZE:
+            flush_rows()
+
+    games_to_translate = [game for game in games if game['desc'] and needs_translation(game['desc'])]
+    total_to_translate = len(games_to_translate)
+    result = {
+        "total": total_to_translate, "unique_texts": 0, "translated": 0, "memory_hits": 0, "failed": 0,
+        "throughput": None, "changed": changed,
+    }
+    if not games_to_translate:
+        return result
+
+    # Клоны и переиздания часто делят одно описание: в сеть уходит только один экземпляр текста
+    groups = {}
+    for game in games_to_translate:
+        groups.setdefault(normalize_source(game['desc']), []).append(game)
+    result["unique_texts"] = len(groups)
+    print(f"Unique descriptions: {len(groups)} of {total_to_translate}")
+
+    remembered = lookup_translations(memory_path, [members[0]['desc'] for members in groups.values()])
+    units = []
+    for members in groups.values():
+        translated_text = remembered.get(members[0]['desc'])
+        if translated_text:
+            for game in members:
+                apply_translation(game, translated_text)
+            result["memory_hits"] += len(members)
+        else:
+            units.append(members)
+    if result["memory_hits"]:
+        print(f"Translation memory hits: {result['memory_hits']}")
+
+    started_at = time.monotonic()
+    processed = result["memory_hits"]
+
+    def report(throughput):
+        if progress_callback is None:
+            return
+        elapsed = max(time.monotonic() - started_at, 1e-6)
+        progress_callback({
+            "done": processed,
+            "total": total_to_translate,
+            "descriptions_per_second": (processed - result["memory_hits"]) / elapsed,
+            "chars_per_second": throughput["chars_per_second"],
+            "requests": throughput["requests"],
+            "retried": throughput["retried"],
+        })
+
+    def apply_unit(unit_index, translated_text):
+        nonlocal processed
+        members = units[unit_index]
+        for game in members:
+            apply_translation(game, translated_text)
+        processed += len(members)
+        result["translated"] += len(members)
+
+    def on_result(unit_index, translated, error):
+        nonlocal processed
+        if error is not None:
+            print(f"Error translating description: {error}")
+            processed += len(units[unit_index])
+            result["failed"] += len(units[unit_index])
+            return
+        memory_pairs.append((units[unit_index][0]['desc'], translated))
+        apply_unit(unit_index, translated)
+
+    try:
+        engine.run_batched(
+            [(unit_index, members[0]['desc']) for unit_index, members in enumerate(units)],
+            on_result, cancel_event, report,
+        )
+    finally:
+        flush_rows()
+
+    flush_pending_descriptions(xml_path, cache_db_path)
+    result["throughput"] = engine.throughput()
+    result["elapsed_seconds"] = time.monotonic() - started_at
+    return result
+
 
 def translate_all(app):
     if not app.games:
         messagebox.showinfo("Info", "Нет игр для перевода")
         return
 
+    if not any(game['desc'] and needs_translation(game['desc']) for game in app.games):
+        messagebox.showinfo("Info", "Все описания уже переведены или пустые")
+        return
+
     xml_path = app.curated_xml_path
     backup_xml(xml_path)
     app.progress["value"] = 0
+    # Два прохода одновременно писали бы одни и те же строки кэша и XML
+    app.translate_button.state(["disabled"])
 
     stats_frame = ttk.Frame(app.root)
     stats_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -44,185 +221,75 @@ def translate_all(app):
     remaining_label = ttk.Label(stats_frame, text="Осталось: 0")
     remaining_label.pack(side=tk.LEFT, padx=5)
 
+    events = queue.Queue()
+
     def worker():
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        
-        xml_elements_by_key = {}
-        for game_elem in root.findall('game'):
-            game_id = game_elem.get('id')
-            if game_id:
-                xml_elements_by_key[game_id] = game_elem
-            path_elem = game_elem.find("path")
-            if path_elem is not None and path_elem.text:
-                xml_elements_by_key[path_elem.text] = game_elem
-        
-        games_to_translate = []
-        for game in app.games:
-            if game['desc'] and needs_translation(game['desc']):
-                games_to_translate.append(game)
-        
-        total_to_translate = len(games_to_translate)
-        app.progress["maximum"] = total_to_translate
-        
-        if not games_to_translate:
-            messagebox.showinfo("Info", "Все описания уже переведены или пустые")
-            stats_frame.destroy()
-            return
+        try:
+            result = translate_descriptions(
+                xml_path,
+                app.games,
+                app.translation_memory_path,
+                app.cache_db_path,
+                progress_callback=lambda snapshot: events.put(("progress", snapshot)),
+            )
+            events.put(("done", result))
+        except Exception as e:
+            events.put(("error", e))
+
+    def update_stats(snapshot):
+        speed = snapshot["descriptions_per_second"]
+        speed_label.config(
+            text=f"Скорость: {speed:.2f}/сек ({snapshot['chars_per_second']:.0f} симв./сек, "
+                 f"запросов: {snapshot['requests']}, повторов: {snapshot['retried']})"
+        )
 
-        start_time = time.time()
-        translated_count = 0
-        last_update_time = start_time
-        last_translated_count = 0
-        
-        def update_stats(current_count):
-            nonlocal last_update_time, last_translated_count
-            
-            current_time = time.time()
-            time_diff = current_time - last_update_time
-            count_diff = current_count - last_translated_count
-            
-            if time_diff > 30:
-                last_update_time = current_time
-                last_translated_count = current_count
-                time_diff = 30
-            
-            if time_diff > 0:
-                speed = count_diff / time_diff
-            else:
-                speed = 0
-            
-            speed_label.config(text=f"Скорость: {speed:.2f}/сек")
-            
-            remaining = total_to_translate - current_count
-            remaining_label.config(text=f"Осталось: {remaining}")
-            
-            if speed > 0 and remaining > 0:
-                eta_seconds = remaining / speed
-                hours = int(eta_seconds // 3600)
-                minutes = int((eta_seconds % 3600) // 60)
-                seconds = int(eta_seconds % 60)
-                eta_label.config(text=f"ETA: {hours:02d}:{minutes:02d}:{seconds:02d}")
-            else:
-                eta_label.config(text="ETA: --:--:--")
-            
-            app.progress["value"] = current_count
-            app.root.update_idletasks()
-
-        def save_progress():
-            tree.write(xml_path, encoding='utf-8', xml_declaration=True)
-
-        batches = []
-        current_batch = []
-        current_chars = 0
-        max_chars = 5000
-
-        for game in games_to_translate:
-            text_length = len(game['desc'])
-            if current_chars + text_length < max_chars and len(current_batch) < 10:
-                current_batch.append(game)
-                current_chars += text_length
-            else:
-                batches.append(current_batch)
-                current_batch = [game]
-                current_chars = text_length
-        
-        if current_batch:
-            batches.append(current_batch)
-
-        save_interval = 50
-        
-        for i, batch in enumerate(batches):
+        remaining = snapshot["total"] - snapshot["done"]
+        remaining_label.config(text=f"Осталось: {remaining}")
+
+        if speed > 0 and remaining > 0:
+            eta_seconds = remaining / speed
+            hours = int(eta_seconds // 3600)
+            minutes = int((eta_seconds % 3600) // 60)
+            seconds = int(eta_seconds % 60)
+            eta_label.config(text=f"ETA: {hours:02d}:{minutes:02d}:{seconds:02d}")
+        else:
+            eta_label.config(text="ETA: --:--:--")
+
+        app.progress["maximum"] = max(snapshot["total"], 1)
+        app.progress["value"] = snapshot["done"]
+
+    def poll_events():
+        latest = None
+        while True:
             try:
-                batch_texts = []
-                for game in batch:
-                    game_key = game.get('id') or game.get('game_id') or game.get('path', '')
-                    batch_texts.append(f"---{game_key}---")
-                    batch_texts.append(game.get('desc', ''))
-                
-                combined_text = "\n".join(batch_texts)
-                
-                translated = translate_text(combined_text)
-                
-                translated_parts = {}
-                current_id = None
-                current_text = []
-                
-                for line in translated.split('\n'):
-                    line = line.strip()
-                    if line.startswith('---') and line.endswith('---'):
-                        if current_id is not None and current_text:
-                            translated_parts[current_id] = '\n'.join(current_text).strip()
-                        
-                        current_id = line.strip('-').strip()
-                        current_text = []
-                    elif current_id is not None and line:
-                        current_text.append(line)
-                
-                if current_id is not None and current_text:
-                    translated_parts[current_id] = '\n'.join(current_text).strip()
-                
-                for game in batch:
-                    game_id = game.get('id') or game.get('game_id') or game.get('path', '')
-                    found_id = None
-                    for key in translated_parts.keys():
-                        if key.strip() == game_id:
-                            found_id = key
-                            break
-                    
-                    if found_id:
-                        translated_text = translated_parts[found_id]
-                        game['desc'] = translated_text
-                        xml_elem = xml_elements_by_key.get(game_id)
-                        if xml_elem is not None:
-                            desc_elem = xml_elem.find("desc")
-                            if desc_elem is not None:
-                                desc_elem.text = translated_text
-                            else:
-                                new_desc = ET.SubElement(xml_elem, "desc")
-                                new_desc.text = translated_text
-                
-                translated_count += len(batch)
-                update_stats(translated_count)
-                
-                if (i + 1) % save_interval == 0:
-                    save_progress()
-                
-                if i < len(batches) - 1:
-                    time.sleep(0.5)
-                    
-            except Exception:
-                for game in batch:
-                    try:
-                        translated = translate_text(game.get('desc', ''))
-                        game['desc'] = translated
-                        game_id = game.get('id') or game.get('game_id') or game.get('path', '')
-                        xml_elem = xml_elements_by_key.get(game_id)
-                        if xml_elem is not None:
-                            desc_elem = xml_elem.find("desc")
-                            if desc_elem is not None:
-                                desc_elem.text = translated
-                            else:
-                                new_desc = ET.SubElement(xml_elem, "desc")
-                                new_desc.text = translated
-                        
-                        translated_count += 1
-                        update_stats(translated_count)
-                        time.sleep(1)
-                    except Exception:
-                        translated_count += 1
-                        update_stats(translated_count)
-                
-                save_progress()
-
-        save_progress()
-        stats_frame.destroy()
-        
-        app.root.after(0, app.reload_games_from_active_xml)
-        
-        messagebox.showinfo("Готово", f"Переведено {translated_count} из {total_to_translate} описаний")
+                kind, payload = events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                latest = payload
+                continue
+            stats_frame.destroy()
+            app.translate_button.state(["!disabled"])
+            if kind == "error":
+                print(f"Error translating descriptions: {payload}")
+                messagebox.showerror("Ошибка", f"Не удалось перевести описания: {payload}")
+                return
+            app.apply_description_updates(payload["changed"])
+            translated = payload["translated"] + payload["memory_hits"]
+            message = f"Переведено {translated} из {payload['total']} описаний"
+            if payload["unique_texts"] < payload["total"]:
+                message += f"\nУникальных текстов: {payload['unique_texts']}"
+            if payload["failed"]:
+                message += f"\nНе удалось перевести: {payload['failed']}"
+            messagebox.showinfo("Готово", message)
+            return
+        # Между опросами приходят десятки снимков, показываем последний
+        if latest is not None:
+            update_stats(latest)
+        app.root.after(TRANSLATION_POLL_MS, poll_events)
 
     threading.Thread(target=worker, daemon=True).start()
+    app.root.after(TRANSLATION_POLL_MS, poll_events)
 
 def backup_xml(xml_path):
     base, ext = os.path.splitext(xml_path)
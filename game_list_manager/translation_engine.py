@@ -0,0 +1,364 @@
+import bisect
+import queue
+import random
+import re
+import threading
+import time
+
+try:
+    from googletrans import Translator
+except ImportError:
+    Translator = None
+
+
+DEFAULT_TRANSLATION_WORKERS = 4
+# Бесплатный endpoint Google быстро отвечает 429 при всплесках запросов
+DEFAULT_REQUESTS_PER_SECOND = 2.0
+DEFAULT_BURST = 4
+DEFAULT_RETRIES = 5
+BACKOFF_BASE_DELAY = 1.0
+BACKOFF_MAX_DELAY = 60.0
+BATCH_MAX_ITEMS = 10
+# Перевод с маркерами, который длиннее исходника в разы, почти наверняка склеил соседние тексты
+MAX_TRANSLATION_RATIO = 3.0
+MARKER_PATTERN = re.compile(r"^-{2,}\s*(\d+)\s*-{2,}$")
+
+
+class TranslationCancelled(Exception):
+    pass
+
+
+class TranslationBackend:
+    """Интерфейс движка перевода: translate(text, src, dest) -> переведённый текст."""
+
+    name = "base"
+    # Наибольший размер одного запроса в символах
+    max_chars = 5000
+
+    def translate(self, text, src, dest):
+        raise NotImplementedError
+
+
+class GoogleTransBackend(TranslationBackend):
+    """googletrans с одним клиентом на поток: соединения переиспользуются между запросами."""
+
+    name = "googletrans"
+
+    def __init__(self):
+        if Translator is None:
+            raise RuntimeError("googletrans не установлен")
+        self._local = threading.local()
+
+    def translate(self, text, src, dest):
+        translator = getattr(self._local, "translator", None)
+        if translator is None:
+            translator = Translator()
+            self._local.translator = translator
+        return translator.translate(text, src=src, dest=dest).text
+
+
+class EchoBackend(TranslationBackend):
+    """Офлайн-заглушка для проверки конвейера без сети: возвращает текст без изменений."""
+
+    name = "echo"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def translate(self, text, src, dest):
+        if self.delay:
+            time.sleep(self.delay)
+        return text
+
+
+BACKENDS = {
+    GoogleTransBackend.name: GoogleTransBackend,
+    EchoBackend.name: EchoBackend,
+}
+
+
+def create_backend(name=GoogleTransBackend.name):
+    return BACKENDS[name]()
+
+
+class TokenBucket:
+    """Ограничение частоты запросов общее для всех потоков."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel_event=None):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if cancel_event is not None and cancel_event.wait(wait):
+                raise TranslationCancelled()
+            if cancel_event is None:
+                time.sleep(wait)
+
+
+def backoff_delay(attempt, base_delay=BACKOFF_BASE_DELAY, max_delay=BACKOFF_MAX_DELAY):
+    # Полный джиттер: потоки, получившие отказ одновременно, не повторяют запрос хором
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def batch_marker(index):
+    return f"---{index}---"
+
+
+def pack_batches(items, max_chars, max_items=BATCH_MAX_ITEMS):
+    """Раскладывает [(ключ, текст)] по пакетам методом best fit decreasing.
+
+    Каждый текст уходит в самый заполненный пакет, где он ещё помещается вместе с
+    маркером, поэтому запросы получаются близкими к max_chars. Текст длиннее лимита
+    отправляется отдельным запросом.
+    """
+    batches = []
+    # (свободное место, номер пакета) открытых пакетов, по возрастанию свободного места
+    free_space = []
+    marker_cost = len(batch_marker(max_items)) + 2
+    for key, text in sorted(items, key=lambda item: len(item[1]), reverse=True):
+        cost = len(text) + marker_cost
+        position = bisect.bisect_left(free_space, (cost, -1))
+        if position < len(free_space):
+            remaining, batch_index = free_space.pop(position)
+        else:
+            batch_index = len(batches)
+            batches.append([])
+            remaining = max_chars
+        batches[batch_index].append((key, text))
+        remaining -= cost
+        if len(batches[batch_index]) < max_items and remaining > 0:
+            bisect.insort(free_space, (remaining, batch_index))
+    return batches
+
+
+def format_batch(batch):
+    if len(batch) == 1:
+        return batch[0][1]
+    lines = []
+    for index, (_, text) in enumerate(batch):
+        lines.append(batch_marker(index))
+        lines.append(text)
+    return "\n".join(lines)
+
+
+def parse_batch(batch, translated):
+    """Разбирает ответ на пакет: {ключ: перевод} только для текстов с целыми маркерами.
+
+    Пропавший, повторившийся или переставленный маркер делает недействительными
+    затронутые тексты; остальные тексты пакета принимаются.
+    """
+    if len(batch) == 1:
+        return {batch[0][0]: translated.strip()} if translated and translated.strip() else {}
+
+    sections = {}
+    counts = {}
+    previous_index = -1
+    out_of_order = set()
+    current_index = None
+    for line in (translated or "").split("\n"):
+        line = line.strip()
+        match = MARKER_PATTERN.match(line)
+        if match:
+            current_index = int(match.group(1))
+            counts[current_index] = counts.get(current_index, 0) + 1
+            if current_index <= previous_index:
+                out_of_order.add(current_index)
+            previous_index = current_index
+            sections.setdefault(current_index, [])
+        elif current_index is not None and line:
+            sections[current_index].append(line)
+
+    # Чужой номер значит, что разметка поехала и границы соседних текстов ненадёжны
+    if any(index >= len(batch) for index in counts):
+        return {}
+
+    # Без маркера текст сливается с предыдущим разделом, поэтому тот тоже не принимаем
+    rejected = set(out_of_order)
+    last_present = None
+    for index in range(len(batch)):
+        if index in counts:
+            last_present = index
+        elif last_present is not None:
+            rejected.add(last_present)
+
+    parsed = {}
+    for index, (key, text) in enumerate(batch):
+        if counts.get(index) != 1 or index in rejected:
+            continue
+        translated_text = "\n".join(sections[index]).strip()
+        if translated_text and len(translated_text) <= MAX_TRANSLATION_RATIO * len(text) + 50:
+            parsed[key] = translated_text
+    return parsed
+
+
+class TranslationEngine:
+    """N потоков перевода за общим ограничителем частоты с повторами и экспоненциальной паузой.
+
+    Результаты отдаются в поток, вызвавший run(): там их можно записывать без блокировок.
+    """
+
+    def __init__(self, backend, workers=DEFAULT_TRANSLATION_WORKERS,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST,
+                 retries=DEFAULT_RETRIES, src="en", dest="ru"):
+        self.backend = backend
+        self.workers = max(int(workers), 1)
+        self.limiter = TokenBucket(requests_per_second, burst)
+        self.retries = retries
+        self.src = src
+        self.dest = dest
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Статистика копится между вызовами run(): пакетный и поштучный проходы считаются вместе
+        self.started_at = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.requests = 0
+        self.retried = 0
+        self.characters = 0
+        self.split_batches = 0
+
+    def translate(self, text, cancel_event=None):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(cancel_event)
+            with self._lock:
+                self.requests += 1
+            try:
+                return self.backend.translate(text, self.src, self.dest)
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                with self._lock:
+                    self.retried += 1
+                delay = backoff_delay(attempt)
+                print(f"Translation request failed ({e}), retry in {delay:.1f}s")
+                if cancel_event is not None and cancel_event.wait(delay):
+                    raise TranslationCancelled()
+                if cancel_event is None:
+                    time.sleep(delay)
+
+    def throughput(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started_at, 1e-6)
+            return {
+                "completed": self.completed,
+                "failed": self.failed,
+                "requests": self.requests,
+                "retried": self.retried,
+                "characters": self.characters,
+                "split_batches": self.split_batches,
+                "elapsed_seconds": elapsed,
+                "items_per_second": self.completed / elapsed,
+                "chars_per_second": self.characters / elapsed,
+            }
+
+    def run(self, tasks, on_result, cancel_event=None, progress_callback=None):
+        """tasks: [(ключ, текст)]; on_result(ключ, перевод или None, ошибка) в текущем потоке."""
+        cancel_event = cancel_event or threading.Event()
+        # Ограниченные очереди: не держим в памяти десятки тысяч готовых задач и ответов
+        task_queue = queue.Queue(maxsize=self.workers * 2)
+        results = queue.Queue(maxsize=self.workers * 4)
+
+        def feeder():
+            for task in tasks:
+                while not cancel_event.is_set():
+                    try:
+                        task_queue.put(task, timeout=0.2)
+                        break
+                    except queue.Full:
+                        continue
+                if cancel_event.is_set():
+                    break
+            for _ in range(self.workers):
+                task_queue.put(None)
+
+        def worker():
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                key, text = task
+                if cancel_event.is_set():
+                    continue
+                try:
+                    translated = self.translate(text, cancel_event)
+                except TranslationCancelled:
+                    continue
+                except Exception as e:
+                    results.put((key, text, None, e))
+                else:
+                    results.put((key, text, translated, None))
+            results.put(None)
+
+        threads = [threading.Thread(target=feeder, daemon=True)]
+        threads += [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        running_workers = self.workers
+        while running_workers:
+            item = results.get()
+            if item is None:
+                running_workers -= 1
+                continue
+            key, text, translated, error = item
+            with self._lock:
+                if error is None:
+                    self.completed += 1
+                    self.characters += len(text)
+                else:
+                    self.failed += 1
+            on_result(key, translated, error)
+            if progress_callback:
+                progress_callback(self.throughput())
+
+        return self.throughput()
+
+    def run_batched(self, items, on_result, cancel_event=None, progress_callback=None,
+                    max_items=BATCH_MAX_ITEMS):
+        """Переводит [(ключ, текст)] пакетами, on_result(ключ, перевод или None, ошибка) на каждый текст.
+
+        Тексты пакета, у которых ответ не прошёл проверку маркеров, делятся пополам
+        и отправляются заново; одиночный текст идёт без маркеров.
+        """
+        cancel_event = cancel_event or threading.Event()
+        batches = pack_batches(items, self.backend.max_chars, max_items)
+        while batches and not cancel_event.is_set():
+            retry_batches = []
+
+            def on_batch(batch_index, translated, error):
+                batch = batches[batch_index]
+                parsed = {} if error is not None else parse_batch(batch, translated)
+                failed = [item for item in batch if item[0] not in parsed]
+                for key, _ in batch:
+                    if key in parsed:
+                        on_result(key, parsed[key], None)
+                if not failed:
+                    return
+                if len(failed) == 1 and len(batch) == 1:
+                    on_result(failed[0][0], None, error or ValueError("empty translation"))
+                    return
+                with self._lock:
+                    self.split_batches += 1
+                middle = (len(failed) + 1) // 2
+                retry_batches.extend(part for part in (failed[:middle], failed[middle:]) if part)
+
+            self.run(
+                ((batch_index, format_batch(batch)) for batch_index, batch in enumerate(batches)),
+                on_batch, cancel_event, progress_callback,
+            )
+            batches = retry_batches
+        return self.throughput()
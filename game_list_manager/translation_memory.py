@@ -0,0 +1,195 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+
+
+# 1: ключ по нормализованному тексту вместо исходного
+MEMORY_SCHEMA_VERSION = 1
+
+# Схема и миграция проверяются один раз на файл за запуск, а не при каждом запросе
+_prepared_paths = set()
+_prepared_lock = threading.Lock()
+
+
+def normalize_source(text):
+    """Одинаковые описания клонов часто отличаются только пробелами и переводами строк."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+def source_hash(text):
+    return hashlib.sha1(normalize_source(text).encode("utf-8")).hexdigest()
+
+
+def _create_schema(conn, table="translations"):
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            source_hash TEXT NOT NULL,
+            src TEXT NOT NULL,
+            dest TEXT NOT NULL,
+            source_text TEXT NOT NULL,
+            translated_text TEXT NOT NULL,
+            PRIMARY KEY (source_hash, src, dest)
+        )
+        """
+    )
+
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= MEMORY_SCHEMA_VERSION:
+        return
+
+    # Старые ключи - sha1 от сырого текста: пересчитываем по source_text,
+    # совпавшие после нормализации записи схлопываются в одну
+    with conn:
+        _create_schema(conn, "translations_migrated")
+        rows = conn.execute("SELECT src, dest, source_text, translated_text FROM translations").fetchall()
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO translations_migrated(source_hash, src, dest, source_text, translated_text)
+            VALUES(?, ?, ?, ?, ?)
+            """,
+            [(source_hash(source_text), src, dest, source_text, translated) for src, dest, source_text, translated in rows],
+        )
+        conn.execute("DROP TABLE translations")
+        conn.execute("ALTER TABLE translations_migrated RENAME TO translations")
+        conn.execute(f"PRAGMA user_version = {MEMORY_SCHEMA_VERSION}")
+    if rows:
+        print(f"Translation memory migrated: {len(rows)} records")
+
+
+def _connect(db_path):
+    key = os.path.abspath(db_path)
+    if key in _prepared_paths and os.path.exists(db_path):
+        return sqlite3.connect(db_path, timeout=30)
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    _create_schema(conn)
+    _migrate(conn)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imported_memories (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL
+        )
+        """
+    )
+    conn.commit()
+    with _prepared_lock:
+        _prepared_paths.add(key)
+    return conn
+
+
+def import_translation_memory(db_path, other_path):
+    """Переносит записи памяти переводов другой коллекции в общую, повторно только после её изменения."""
+    if not other_path or not os.path.exists(other_path):
+        return 0
+    if os.path.abspath(other_path) == os.path.abspath(db_path):
+        return 0
+    mtime = int(os.path.getmtime(other_path))
+
+    conn = _connect(db_path)
+    try:
+        row = conn.execute("SELECT mtime FROM imported_memories WHERE path = ?", (other_path,)).fetchone()
+        if row and row[0] == mtime:
+            return 0
+    finally:
+        conn.close()
+
+    # Старая база при открытии сама переходит на нормализованные ключи
+    other = _connect(other_path)
+    try:
+        rows = other.execute("SELECT source_hash, src, dest, source_text, translated_text FROM translations").fetchall()
+    finally:
+        other.close()
+
+    conn = _connect(db_path)
+    try:
+        with conn:
+            # Уже известные переводы общей памяти не перезаписываем
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO translations(source_hash, src, dest, source_text, translated_text)
+                VALUES(?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO imported_memories(path, mtime) VALUES(?, ?)",
+                (other_path, int(os.path.getmtime(other_path))),
+            )
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def lookup_translation(db_path, text, src="en", dest="ru"):
+    conn = _connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT translated_text FROM translations WHERE source_hash = ? AND src = ? AND dest = ?",
+            (source_hash(text), src, dest),
+        ).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def lookup_translations(db_path, texts, src="en", dest="ru"):
+    # После нормализации разные строки могут давать один ключ
+    hashes = {}
+    for text in texts:
+        hashes.setdefault(source_hash(text), []).append(text)
+    found = {}
+    conn = _connect(db_path)
+    try:
+        hash_list = list(hashes)
+        for start in range(0, len(hash_list), 500):
+            chunk = hash_list[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = conn.execute(
+                f"""
+                SELECT source_hash, translated_text
+                FROM translations
+                WHERE src = ? AND dest = ? AND source_hash IN ({placeholders})
+                """,
+                [src, dest] + chunk,
+            ).fetchall()
+            for hash_value, translated_text in rows:
+                for text in hashes[hash_value]:
+                    found[text] = translated_text
+        return found
+    finally:
+        conn.close()
+
+
+def store_translations(db_path, pairs, src="en", dest="ru"):
+    rows = [
+        (source_hash(source_text), src, dest, source_text, translated_text)
+        for source_text, translated_text in pairs
+        if translated_text and translated_text != source_text
+    ]
+    if not rows:
+        return 0
+
+    conn = _connect(db_path)
+    try:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO translations(source_hash, src, dest, source_text, translated_text)
+            VALUES(?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def store_translation(db_path, source_text, translated_text, src="en", dest="ru"):
+    return store_translations(db_path, [(source_text, translated_text)], src, dest)
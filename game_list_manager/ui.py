@@ -1,30 +1,71 @@
 import json
 import os
+import queue
+import shutil
 import threading
 import tkinter as tk
+from collections import OrderedDict
 from tkinter import Text, filedialog, messagebox, ttk
 
 from PIL import Image, ImageTk
 
 from checked_items import CheckedItemsManager
+from compression_engine import compression_params, current_system_load, encoder_layout
+from export_engine import (
+    ARCHIVE_FORMATS,
+    DEDUP_MODES,
+    DEFAULT_EXPORT_STRATEGY,
+    DEFAULT_EXPORT_WORKERS,
+    EXPORT_STRATEGIES,
+    format_bytes,
+    format_duration,
+)
 from db_cache import (
+    MEDIA_TREE_FIELDS,
     ensure_cache,
     get_field_label,
     get_game_details,
     get_groupable_fields,
     get_version_candidates,
+    load_group_disk_usage,
+    load_media_presence,
     load_tree_rows,
     rebuild_cache,
+    refresh_media_inventory,
+)
+from image_engine import (
+    DEFAULT_IMAGE_QUALITY,
+    DEFAULT_MAX_DIMENSION,
+    IMAGE_FORMATS,
+    image_params,
+    run_image_optimization,
 )
-from translation import needs_translation, translate_text
-from video_handler import compress_video
+from media_index import index_key, normalize_reference
+from translation import PreviewTranslationWorker, needs_translation
+from video_handler import PreviewProxyBuilder, compress_video, make_export_transcoder
 from video_player import play_video, stop_video
-from xml_handler import export_curated_collection
+from xml_handler import (
+    FILE_REFERENCE_TAGS,
+    estimate_curated_export,
+    export_curated_collection,
+    flush_pending_descriptions,
+)
 
 
 CHECK_OFF = "☐"
 CHECK_ON = "☑"
 CHECK_PARTIAL = "▣"
+EXPORT_TARGET_FOLDER = "папка"
+DEDUP_MODE_LABELS = {
+    "off": "не искать",
+    "link": "жёсткие ссылки",
+    "reference": "одна копия, ссылки в XML",
+}
+
+RESIZE_SETTLE_DELAY_MS = 150
+TRANSLATION_POLL_MS = 100
+MEDIA_INVENTORY_POLL_MS = 200
+SCALED_IMAGE_CACHE_LIMIT = 8
 
 
 class GameAppUI:
@@ -41,8 +82,25 @@ class GameAppUI:
         self.curated_xml_path = workspace["curated_xml_path"]
         self.project_state_path = workspace["project_state_path"]
         self.cache_db_path = workspace["cache_db_path"]
+        self.translation_memory_path = workspace["translation_memory_path"]
+        self.proxy_dir = workspace["proxy_dir"]
         self.support_root = workspace["support_root"]
         self.export_dir = None
+        self.use_preview_proxies = False
+        self.export_workers = DEFAULT_EXPORT_WORKERS
+        self.export_prune = True
+        self.export_verify_hash = False
+        self.export_strategy = DEFAULT_EXPORT_STRATEGY
+        self.export_archive_format = ""
+        self.export_part_size_mb = 0
+        self.export_dedup = "off"
+        self.export_compress_video = False
+        self.export_video_scale = 0.75
+        self.export_video_crf = 27
+        self.export_video_max_duration = 10
+        self.image_max_dimension = DEFAULT_MAX_DIMENSION
+        self.image_format = "keep"
+        self.image_quality = DEFAULT_IMAGE_QUALITY
 
         self.app_dir = os.path.dirname(os.path.abspath(__file__))
         self.project_root = os.path.dirname(self.app_dir)
@@ -67,11 +125,25 @@ class GameAppUI:
         self.original_image = None
         self.video_player = None
         self.video_label = None
-        self.video_timer = None
+        self.video_job = None
         self.video_delay = 2.0
         self.pending_video_path = None
         self._last_media_size = (0, 0)
+        self._image_area_size = (1, 1)
+        self._draft_render_job = None
+        self._final_render_job = None
+        self._scaled_images = OrderedDict()
         self.current_video_aspect = None
+        self.preview_translator = PreviewTranslationWorker(self.translation_memory_path)
+        self._pending_translation_key = None
+        self._translation_poll_job = None
+        self.proxy_builder = PreviewProxyBuilder(self.proxy_dir)
+        self._preview_proxies_queued = False
+        self.media_inventory_ready = False
+        self.media_presence = None
+        self._media_inventory_thread = None
+        self._media_inventory_results = queue.Queue()
+        self._media_inventory_rerun = False
 
         self.load_project_state()
         self.initialize_cache(force_rebuild=False)
@@ -89,6 +161,11 @@ class GameAppUI:
         self.root.destroy()
 
     def initialize_cache(self, force_rebuild=False):
+        # Переводы, прерванные до записи в XML, иначе потерялись бы при пересборке кэша
+        try:
+            flush_pending_descriptions(self.curated_xml_path, self.cache_db_path)
+        except Exception as e:
+            print(f"Error writing pending descriptions: {e}")
         if force_rebuild:
             rebuild_cache(self.curated_xml_path, self.cache_db_path, self.support_root)
         else:
@@ -207,6 +284,27 @@ class GameAppUI:
             if isinstance(grouping_fields, list):
                 fields = grouping_fields[:3] + ["", "", ""]
                 self.grouping_fields = fields[:3]
+            self.use_preview_proxies = bool(data.get("use_preview_proxies", False))
+            self.export_workers = int(data.get("export_workers", DEFAULT_EXPORT_WORKERS))
+            self.export_prune = bool(data.get("export_prune", True))
+            self.export_verify_hash = bool(data.get("export_verify_hash", False))
+            export_strategy = data.get("export_strategy")
+            if export_strategy in EXPORT_STRATEGIES:
+                self.export_strategy = export_strategy
+            archive_format = data.get("export_archive_format") or ""
+            if archive_format in ARCHIVE_FORMATS:
+                self.export_archive_format = archive_format
+            self.export_part_size_mb = int(data.get("export_part_size_mb", 0))
+            if data.get("export_dedup") in DEDUP_MODES:
+                self.export_dedup = data["export_dedup"]
+            self.export_compress_video = bool(data.get("export_compress_video", False))
+            self.export_video_scale = float(data.get("export_video_scale", 0.75))
+            self.export_video_crf = int(data.get("export_video_crf", 27))
+            self.export_video_max_duration = int(data.get("export_video_max_duration", 10))
+            self.image_max_dimension = int(data.get("image_max_dimension", DEFAULT_MAX_DIMENSION))
+            if data.get("image_format") in IMAGE_FORMATS:
+                self.image_format = data["image_format"]
+            self.image_quality = int(data.get("image_quality", DEFAULT_IMAGE_QUALITY))
         except Exception as e:
             print(f"Error loading project state: {e}")
 
@@ -216,6 +314,21 @@ class GameAppUI:
                 "export_dir": self.export_dir,
                 "curated_xml_path": self.curated_xml_path,
                 "grouping_fields": self.grouping_fields,
+                "use_preview_proxies": self.use_preview_proxies,
+                "export_workers": self.export_workers,
+                "export_prune": self.export_prune,
+                "export_verify_hash": self.export_verify_hash,
+                "export_strategy": self.export_strategy,
+                "export_archive_format": self.export_archive_format,
+                "export_part_size_mb": self.export_part_size_mb,
+                "export_dedup": self.export_dedup,
+                "export_compress_video": self.export_compress_video,
+                "export_video_scale": self.export_video_scale,
+                "export_video_crf": self.export_video_crf,
+                "export_video_max_duration": self.export_video_max_duration,
+                "image_max_dimension": self.image_max_dimension,
+                "image_format": self.image_format,
+                "image_quality": self.image_quality,
             }
             with open(self.project_state_path, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=True, indent=2)
@@ -234,11 +347,12 @@ class GameAppUI:
         image_height, video_height = self.calculate_media_heights(width, height)
         video_width, video_x = self.calculate_video_width(width, video_height)
 
+        self._image_area_size = (width, image_height)
         self.image_frame.place(x=0, y=0, width=width, height=image_height)
         self.video_frame.place(x=video_x, y=image_height + 10, width=video_width, height=video_height)
 
         if self.original_image:
-            self.render_current_image()
+            self.schedule_image_render()
 
     def calculate_media_heights(self, width, height):
         gap = 10
@@ -275,21 +389,59 @@ class GameAppUI:
         self.current_video_aspect = video_width / video_height
         self.root.after(0, self.update_media_layout)
 
-    def render_current_image(self):
+    def schedule_image_render(self):
+        # Configure events arrive in bursts while the pane splitter is dragged:
+        # draw one cheap frame per idle cycle and the LANCZOS frame once the size settles.
+        if self._draft_render_job is None:
+            self._draft_render_job = self.root.after_idle(self.render_draft_image)
+        if self._final_render_job is not None:
+            self.root.after_cancel(self._final_render_job)
+        self._final_render_job = self.root.after(RESIZE_SETTLE_DELAY_MS, self.render_final_image)
+
+    def cancel_image_render(self):
+        if self._draft_render_job is not None:
+            self.root.after_cancel(self._draft_render_job)
+            self._draft_render_job = None
+        if self._final_render_job is not None:
+            self.root.after_cancel(self._final_render_job)
+            self._final_render_job = None
+
+    def render_draft_image(self):
+        self._draft_render_job = None
+        self.render_current_image(draft=True)
+
+    def render_final_image(self):
+        self._final_render_job = None
+        self.render_current_image()
+
+    def reset_scaled_images(self):
+        self.cancel_image_render()
+        self._scaled_images.clear()
+
+    def target_image_size(self):
+        available_width, available_height = self._image_area_size
+        orig_w, orig_h = self.original_image.size
+        ratio = min(available_width / orig_w, available_height / orig_h)
+        return max(int(orig_w * ratio), 1), max(int(orig_h * ratio), 1)
+
+    def render_current_image(self, draft=False):
         if not self.original_image:
             return
 
-        self.root.update_idletasks()
-        available_width = max(self.image_frame.winfo_width(), 1)
-        available_height = max(self.image_frame.winfo_height(), 1)
-
-        orig_w, orig_h = self.original_image.size
-        ratio = min(available_width / orig_w, available_height / orig_h)
-        new_w = max(int(orig_w * ratio), 1)
-        new_h = max(int(orig_h * ratio), 1)
+        target_size = self.target_image_size()
+        photo = self._scaled_images.get(target_size)
+        if photo is not None:
+            self._scaled_images.move_to_end(target_size)
+        elif draft:
+            photo = ImageTk.PhotoImage(self.original_image.resize(target_size, Image.NEAREST))
+        else:
+            photo = ImageTk.PhotoImage(self.original_image.resize(target_size, Image.LANCZOS))
+            self._scaled_images[target_size] = photo
+            while len(self._scaled_images) > SCALED_IMAGE_CACHE_LIMIT:
+                self._scaled_images.popitem(last=False)
 
-        resized = self.original_image.resize((new_w, new_h), Image.LANCZOS)
-        photo = ImageTk.PhotoImage(resized)
+        if self.image_label.image is photo:
+            return
         self.image_label.config(image=photo, text="")
         self.image_label.image = photo
 
@@ -361,6 +513,7 @@ class GameAppUI:
         self.image_frame = ttk.Frame(self.media_frame, height=320)
         self.image_frame.place(x=0, y=0, width=1, height=320)
         self.image_label = tk.Label(self.image_frame)
+        self.image_label.image = None
         self.image_label.pack(fill=tk.BOTH, expand=True)
 
         self.video_frame = ttk.Frame(self.media_frame, height=320)
@@ -379,9 +532,17 @@ class GameAppUI:
         curation_row = ttk.Frame(controls_frame)
         curation_row.pack(fill=tk.X, pady=(0, 5))
         ttk.Button(curation_row, text="Исключить отмеченные", command=self.checked_manager.exclude_checked).pack(side=tk.LEFT, padx=5)
-        ttk.Button(curation_row, text="Перевести всё", command=self.translate_all).pack(side=tk.LEFT, padx=5)
+        self.translate_button = ttk.Button(curation_row, text="Перевести всё", command=self.translate_all)
+        self.translate_button.pack(side=tk.LEFT, padx=5)
         ttk.Button(curation_row, text="Сохранить отметки", command=self.checked_manager.save_checked).pack(side=tk.LEFT, padx=5)
         ttk.Button(curation_row, text="Загрузить отметки", command=self.checked_manager.load_checked).pack(side=tk.LEFT, padx=5)
+        self.proxy_previews_var = tk.BooleanVar(value=self.use_preview_proxies)
+        ttk.Checkbutton(
+            curation_row,
+            text="Лёгкие прокси-видео для превью",
+            variable=self.proxy_previews_var,
+            command=self.toggle_preview_proxies,
+        ).pack(side=tk.LEFT, padx=5)
 
         export_row = ttk.Frame(controls_frame)
         export_row.pack(fill=tk.X)
@@ -392,6 +553,9 @@ class GameAppUI:
             text="Сжать видео в экспорте",
             command=lambda: compress_video(self, self.export_dir, "экспортированной коллекции")
         ).pack(side=tk.LEFT, padx=5)
+        ttk.Button(
+            export_row, text="Оптимизировать изображения", command=self.optimize_export_images
+        ).pack(side=tk.LEFT, padx=5)
 
         self.progress = ttk.Progressbar(self.root, mode="determinate")
         self.progress.pack(fill=tk.X, padx=10, pady=5)
@@ -437,30 +601,113 @@ class GameAppUI:
                 var.set(self.field_name_to_display.get(field, "Нет"))
 
         self.rebuild_tree()
+        # Массовая очередь ставится один раз за сессию: свежие прокси фоновый поток
+        # пропускает сам, а после исключения игр лишние задачи безвредны
+        if self.use_preview_proxies and not self._preview_proxies_queued:
+            self.queue_preview_proxies()
+
+        self.start_media_inventory_refresh()
+
+    def start_media_inventory_refresh(self):
+        if self._media_inventory_thread is not None:
+            self._media_inventory_rerun = True
+            return
+
+        def worker():
+            try:
+                result = refresh_media_inventory(self.cache_db_path, self.rom_dir, FILE_REFERENCE_TAGS)
+                result["presence"] = load_media_presence(self.cache_db_path)
+                self._media_inventory_results.put(("done", result))
+            except Exception as e:
+                self._media_inventory_results.put(("error", e))
+
+        self._media_inventory_rerun = False
+        self._media_inventory_thread = threading.Thread(target=worker, daemon=True)
+        self._media_inventory_thread.start()
+        self.root.after(MEDIA_INVENTORY_POLL_MS, self.poll_media_inventory)
+
+    def poll_media_inventory(self):
+        try:
+            status, payload = self._media_inventory_results.get_nowait()
+        except queue.Empty:
+            self.root.after(MEDIA_INVENTORY_POLL_MS, self.poll_media_inventory)
+            return
+
+        self._media_inventory_thread = None
+        if status == "error":
+            print(f"Error refreshing media inventory: {payload}")
+        else:
+            print(
+                f"Media inventory refreshed: {payload['rescanned_dirs']} dirs rescanned, "
+                f"{payload['media_files']} media references"
+            )
+            self.media_presence = payload["presence"]
+            self.media_inventory_ready = True
+            if any(field in MEDIA_TREE_FIELDS for field in self.current_grouping_fields()):
+                self.reload_tree_rows()
+            else:
+                self.refresh_group_disk_usage()
+
+        if self._media_inventory_rerun:
+            self.start_media_inventory_refresh()
+
+    def reload_tree_rows(self):
+        self.tree_rows = load_tree_rows(self.cache_db_path, self.current_grouping_fields())
+        self.rebuild_tree()
+
+    def preview_video_rel(self, game):
+        return game.get("video") or f"media/mp4/{game.get('rom_stem', '')}.mp4"
+
+    def queue_preview_proxies(self):
+        self._preview_proxies_queued = True
+        self.proxy_builder.cancel_bulk()
+        self.proxy_builder.request_many(
+            (os.path.join(self.rom_dir, video_rel), video_rel)
+            for video_rel in (self.preview_video_rel(row) for row in self.all_rows)
+        )
+
+    def toggle_preview_proxies(self):
+        self.use_preview_proxies = self.proxy_previews_var.get()
+        self.save_project_state()
+        if self.use_preview_proxies:
+            self.queue_preview_proxies()
+        else:
+            self._preview_proxies_queued = False
+            self.proxy_builder.cancel_pending()
 
     def clear_preview(self):
         self.current_game = None
         self._current_preview_key = None
         self.original_image = None
+        self.reset_scaled_images()
         self.pending_video_path = None
         self._preview_generation += 1
 
-        if self.video_timer:
-            self.video_timer.cancel()
-            self.video_timer = None
+        self.cancel_video_job()
 
         self.desc_text.delete(1.0, tk.END)
         self.image_label.config(image=None, text="")
         self.image_label.image = None
         stop_video(self)
         self.current_video_aspect = None
-        for widget in self.video_frame.winfo_children():
-            widget.destroy()
+        self.clear_video_message()
         self.update_media_layout()
 
     def reload_games_from_active_xml(self):
         self.reload_all_data(rebuild_cache=True)
 
+    def apply_description_updates(self, descriptions):
+        """Новые описания {path: desc} уже в кэше: обновляем только загруженные строки, без перестроения."""
+        if not descriptions:
+            return
+        for rows in (self.all_rows, self.tree_rows):
+            for row in rows:
+                if row["path"] in descriptions:
+                    row["desc"] = descriptions[row["path"]]
+        if self.current_game and self.current_game.get("path") in descriptions:
+            self.current_game["desc"] = descriptions[self.current_game["path"]]
+            self.show_description(self.current_game["desc"])
+
     def rebuild_tree(self):
         self.clear_preview()
         self.tree.delete(*self.tree.get_children())
@@ -495,6 +742,7 @@ class GameAppUI:
                 version_names[version_key] = row.get("name") or row.get("path")
                 version_preview_ids[version_key] = row["db_id"]
 
+        group_bytes = self.load_group_bytes(grouping_fields)
         created_groups = {}
         created_versions = {}
 
@@ -507,7 +755,7 @@ class GameAppUI:
                 prefix.append((field, value))
                 key = tuple(prefix)
                 if key not in created_groups:
-                    label = f"{value} ({group_counts[key]})"
+                    label = self.format_group_label(value, group_counts[key], group_bytes.get(key))
                     iid = self.tree.insert(parent, "end", text=f"{CHECK_OFF} {label}", open=False)
                     created_groups[key] = iid
                     self.node_meta[iid] = {
@@ -515,6 +763,7 @@ class GameAppUI:
                         "base_label": label,
                         "paths": set(),
                         "group_key": key,
+                        "count": group_counts[key],
                     }
                 parent = created_groups[key]
                 ancestor_ids.append(parent)
@@ -553,9 +802,38 @@ class GameAppUI:
 
         self.checked_manager.update_checked_visuals()
 
+    def load_group_bytes(self, grouping_fields):
+        if not grouping_fields or not self.media_inventory_ready:
+            return {}
+        # Разные сырые значения (NULL и "", пробелы) сливаются в одну группу дерева
+        group_bytes = {}
+        for raw_key, size in load_group_disk_usage(self.cache_db_path, grouping_fields).items():
+            key = tuple(
+                (field, self.format_group_value(field, value))
+                for field, value in zip(grouping_fields, raw_key)
+            )
+            group_bytes[key] = group_bytes.get(key, 0) + size
+        return group_bytes
+
+    def format_group_label(self, value, count, size):
+        if size is None:
+            return f"{value} ({count})"
+        return f"{value} ({count}, {format_bytes(size)})"
+
+    def refresh_group_disk_usage(self):
+        group_bytes = self.load_group_bytes(self.current_grouping_fields())
+        for meta in self.node_meta.values():
+            if meta["type"] != "group":
+                continue
+            key = meta["group_key"]
+            meta["base_label"] = self.format_group_label(key[-1][1], meta["count"], group_bytes.get(key, 0))
+        self.refresh_tree_checkmarks()
+
     def format_group_value(self, field, value):
         if field == "mature_flag":
             return "Mature" if str(value) in {"1", "true", "True"} else "Not Mature"
+        if field == "media_missing" and not value:
+            return "Все медиа на месте"
         value = (value or "").strip() if isinstance(value, str) else value
         return str(value) if value not in (None, "") else "(пусто)"
 
@@ -602,25 +880,419 @@ class GameAppUI:
             messagebox.showinfo("Информация", "Сначала выберите каталог экспорта")
             return
 
-        try:
-            result = export_curated_collection(self.curated_xml_path, self.rom_dir, self.export_dir)
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Экспорт коллекции")
+        dialog.transient(self.root)
+        dialog.geometry(self.geometry_over_widget(self.root, 580, 700))
+
+        ttk.Label(dialog, text="Экспорт коллекции", font=("Arial", 12, "bold")).pack(pady=10)
+        ttk.Label(dialog, text=f"Каталог: {self.export_dir}", wraplength=480, justify=tk.LEFT).pack(padx=20, anchor=tk.W)
+
+        settings_frame = ttk.Frame(dialog)
+        settings_frame.pack(fill=tk.X, padx=20, pady=5)
+        workers_var = tk.IntVar(value=self.export_workers)
+        ttk.Label(settings_frame, text="Потоков копирования:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=1, to=16, textvariable=workers_var, width=10).grid(
+            row=0, column=1, sticky=tk.W, padx=5, pady=5
+        )
+        prune_var = tk.BooleanVar(value=self.export_prune)
+        ttk.Checkbutton(
+            settings_frame, text="Удалять из экспорта файлы исключённых игр", variable=prune_var
+        ).grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=2)
+        verify_hash_var = tk.BooleanVar(value=self.export_verify_hash)
+        ttk.Checkbutton(
+            settings_frame, text="Сверять по хэшу файлы с изменённой датой", variable=verify_hash_var
+        ).grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=2)
+        strategy_var = tk.StringVar(value=self.export_strategy)
+        ttk.Label(settings_frame, text="Способ копирования:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame, textvariable=strategy_var, values=EXPORT_STRATEGIES, state="readonly", width=16
+        ).grid(row=3, column=1, sticky=tk.W, padx=5, pady=5)
+        strategy_warning_var = tk.StringVar()
+        ttk.Label(settings_frame, textvariable=strategy_warning_var, foreground="red", wraplength=520).grid(
+            row=4, column=0, columnspan=2, sticky=tk.W
+        )
+
+        def update_strategy_warning(*args):
+            if strategy_var.get() == "hardlink":
+                strategy_warning_var.set(
+                    "Файлы экспорта будут общими с коллекцией: их правка изменит оригиналы"
+                )
+            else:
+                strategy_warning_var.set("")
+
+        strategy_var.trace_add("write", update_strategy_warning)
+        update_strategy_warning()
+        target_var = tk.StringVar(value=self.export_archive_format or EXPORT_TARGET_FOLDER)
+        ttk.Label(settings_frame, text="Куда экспортировать:").grid(row=5, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame,
+            textvariable=target_var,
+            values=(EXPORT_TARGET_FOLDER,) + ARCHIVE_FORMATS,
+            state="readonly",
+            width=16,
+        ).grid(row=5, column=1, sticky=tk.W, padx=5, pady=5)
+        part_size_var = tk.IntVar(value=self.export_part_size_mb)
+        ttk.Label(settings_frame, text="Размер части архива, МБ (0 - одним файлом):").grid(row=6, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=0, to=1000000, increment=1024, textvariable=part_size_var, width=10).grid(
+            row=6, column=1, sticky=tk.W, padx=5, pady=5
+        )
+        dedup_labels_to_mode = {label: mode for mode, label in DEDUP_MODE_LABELS.items()}
+        dedup_var = tk.StringVar(value=DEDUP_MODE_LABELS[self.export_dedup])
+        ttk.Label(settings_frame, text="Одинаковые медиафайлы:").grid(row=7, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame,
+            textvariable=dedup_var,
+            values=list(dedup_labels_to_mode),
+            state="readonly",
+            width=24,
+        ).grid(row=7, column=1, sticky=tk.W, padx=5, pady=5)
+        compress_video_var = tk.BooleanVar(value=self.export_compress_video)
+        ttk.Checkbutton(
+            settings_frame,
+            text="Сжимать .mp4 при экспорте (в папку, без копирования оригиналов)",
+            variable=compress_video_var,
+        ).grid(row=8, column=0, columnspan=2, sticky=tk.W, pady=2)
+        video_frame = ttk.Frame(settings_frame)
+        video_frame.grid(row=9, column=0, columnspan=2, sticky=tk.W, pady=2)
+        video_scale_var = tk.DoubleVar(value=self.export_video_scale)
+        video_crf_var = tk.IntVar(value=self.export_video_crf)
+        video_duration_var = tk.IntVar(value=self.export_video_max_duration)
+        ttk.Label(video_frame, text="Масштаб:").pack(side=tk.LEFT)
+        ttk.Spinbox(video_frame, from_=0.1, to=1.0, increment=0.05, textvariable=video_scale_var, width=5).pack(
+            side=tk.LEFT, padx=(2, 8)
+        )
+        ttk.Label(video_frame, text="CRF:").pack(side=tk.LEFT)
+        ttk.Spinbox(video_frame, from_=0, to=51, textvariable=video_crf_var, width=5).pack(side=tk.LEFT, padx=(2, 8))
+        ttk.Label(video_frame, text="Макс. сек:").pack(side=tk.LEFT)
+        ttk.Spinbox(video_frame, from_=5, to=60, textvariable=video_duration_var, width=5).pack(
+            side=tk.LEFT, padx=2
+        )
+
+        estimate_var = tk.StringVar(value="Оценка размера экспорта...")
+        ttk.Label(dialog, textvariable=estimate_var, wraplength=520, justify=tk.LEFT).pack(padx=20, anchor=tk.W)
+        estimate_list = tk.Listbox(dialog, height=6)
+        estimate_list.pack(fill=tk.X, padx=20, pady=5)
+
+        status_var = tk.StringVar(value="Готов к экспорту")
+        ttk.Label(dialog, textvariable=status_var).pack(padx=20, anchor=tk.W)
+        speed_var = tk.StringVar(value="")
+        ttk.Label(dialog, textvariable=speed_var).pack(padx=20, anchor=tk.W)
+        progress = ttk.Progressbar(dialog, mode="determinate", maximum=1)
+        progress.pack(fill=tk.X, padx=20, pady=5)
+
+        updates = queue.Queue()
+        estimates = queue.Queue()
+        state = {"cancel_event": None}
+
+        def estimate_worker():
+            try:
+                estimates.put(estimate_curated_export(self.curated_xml_path, self.rom_dir, self.cache_db_path))
+            except Exception as e:
+                estimates.put(e)
+
+        def poll_estimate():
+            if not dialog.winfo_exists():
+                return
+            try:
+                estimate = estimates.get_nowait()
+            except queue.Empty:
+                dialog.after(200, poll_estimate)
+                return
+
+            if isinstance(estimate, Exception):
+                estimate_var.set(f"Не удалось оценить размер экспорта: {estimate}")
+                return
+
+            text = (
+                f"Будет экспортировано: {estimate['games_count']} игр, "
+                f"{estimate['files_count']} файлов, {format_bytes(estimate['total_bytes'])}"
+            )
+            free_bytes = self.free_space_at(self.export_dir)
+            if free_bytes is not None:
+                text += f"\nСвободно в каталоге экспорта: {format_bytes(free_bytes)}"
+            if estimate["missing_files"]:
+                text += f"\nОтсутствующих файлов: {len(estimate['missing_files'])}"
+            estimate_var.set(text)
+            for system, size in sorted(estimate["system_bytes"].items(), key=lambda item: -item[1]):
+                estimate_list.insert(tk.END, f"{system}: {format_bytes(size)}")
+
+        threading.Thread(target=estimate_worker, daemon=True).start()
+        dialog.after(200, poll_estimate)
+
+        def on_progress(snapshot):
+            progress["maximum"] = max(snapshot["total_bytes"], 1)
+            progress["value"] = snapshot["done_bytes"]
+            status_var.set(
+                f"Файлов: {snapshot['done_files']}/{snapshot['total_files']}, "
+                f"{format_bytes(snapshot['done_bytes'])} из {format_bytes(snapshot['total_bytes'])}"
+            )
+            speed_text = (
+                f"Скорость: {format_bytes(snapshot['bytes_per_second'])}/с, "
+                f"ETA: {format_duration(snapshot['eta_seconds'])}"
+            )
+            if snapshot["linked_bytes"]:
+                speed_text += f", связано без копирования: {format_bytes(snapshot['linked_bytes'])}"
+            speed_var.set(speed_text)
+
+        def poll_updates():
+            if not dialog.winfo_exists():
+                return
+            while True:
+                try:
+                    kind, payload = updates.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "progress":
+                    on_progress(payload)
+                elif kind == "done":
+                    finish(payload)
+                    return
+                elif kind == "error":
+                    state["cancel_event"] = None
+                    status_var.set("Ошибка экспорта")
+                    messagebox.showerror("Ошибка", f"Не удалось экспортировать коллекцию: {payload}", parent=dialog)
+                    print(f"Error exporting collection: {payload}")
+                    return
+            dialog.after(200, poll_updates)
+
+        def finish(result):
+            state["cancel_event"] = None
             self.save_project_state()
             self.refresh_project_status()
+            if result["cancelled"]:
+                status_var.set("Экспорт остановлен, его можно продолжить позже")
+                return
 
             missing_count = len(result["missing_files"])
             message = (
                 f"Экспорт завершён\n"
                 f"Игр: {result['games_count']}\n"
-                f"Скопировано файлов: {result['copied_files']}\n"
-                f"gamelist.xml: {result['export_xml_path']}"
+                f"Скопировано файлов: {result['copied_files']} ({format_bytes(result['copied_bytes'])})\n"
+                f"Сжато видео при экспорте: {result['transcoded_files']}\n"
+                f"Уже было в экспорте: {result['skipped_files']}\n"
+                f"Удалено устаревших файлов: {result['removed_files']} ({format_bytes(result['removed_bytes'])})\n"
+                f"Время: {format_duration(result['elapsed_seconds'])}"
             )
+            if result.get("archive_paths"):
+                message += f"\nАрхив: {', '.join(result['archive_paths'])}"
+            else:
+                message += f"\ngamelist.xml: {result['export_xml_path']}"
+            if result["transfer_methods"]:
+                methods = ", ".join(f"{name}: {count}" for name, count in sorted(result["transfer_methods"].items()))
+                message += f"\nСпособы копирования: {methods}"
+            if result["dedup_files"]:
+                message += (
+                    f"\nДубликатов медиа: {result['dedup_files']}, "
+                    f"сэкономлено {format_bytes(result['dedup_saved_bytes'])}"
+                )
             if missing_count:
                 message += f"\nОтсутствующих файлов: {missing_count}"
+            if result["failed_files"]:
+                message += f"\nОшибок копирования: {len(result['failed_files'])}"
 
-            messagebox.showinfo("Готово", message)
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось экспортировать коллекцию: {e}")
-            print(f"Error exporting collection: {e}")
+            status_var.set("Экспорт завершён")
+            messagebox.showinfo("Готово", message, parent=dialog)
+
+        def start_export():
+            if state["cancel_event"] is not None:
+                return
+            self.export_workers = max(workers_var.get(), 1)
+            self.export_prune = prune_var.get()
+            self.export_verify_hash = verify_hash_var.get()
+            self.export_strategy = strategy_var.get()
+            target = target_var.get()
+            self.export_archive_format = target if target in ARCHIVE_FORMATS else ""
+            self.export_part_size_mb = max(part_size_var.get(), 0)
+            self.export_dedup = dedup_labels_to_mode.get(dedup_var.get(), "off")
+            self.export_compress_video = compress_video_var.get()
+            self.export_video_scale = min(max(video_scale_var.get(), 0.1), 1.0)
+            self.export_video_crf = min(max(video_crf_var.get(), 0), 51)
+            self.export_video_max_duration = max(video_duration_var.get(), 1)
+            self.save_project_state()
+            transcoder, transcode_params, transcode_jobs = None, None, 1
+            # В архив видео пишутся как есть: конвейер со сжатием только для экспорта в папку
+            if self.export_compress_video and not self.export_archive_format:
+                transcode_params = compression_params(
+                    self.export_video_scale, self.export_video_crf, self.export_video_max_duration
+                )
+                transcode_jobs, threads = encoder_layout(external_load=current_system_load() or 0.0)
+                transcoder = make_export_transcoder(transcode_params, threads, self.cache_db_path)
+            cancel_event = threading.Event()
+            state["cancel_event"] = cancel_event
+            status_var.set("Подготовка плана копирования...")
+
+            def worker():
+                try:
+                    result = export_curated_collection(
+                        self.curated_xml_path,
+                        self.rom_dir,
+                        self.export_dir,
+                        workers=self.export_workers,
+                        progress_callback=lambda snapshot: updates.put(("progress", snapshot)),
+                        cancel_event=cancel_event,
+                        prune=self.export_prune,
+                        verify_hash=self.export_verify_hash,
+                        strategy=self.export_strategy,
+                        archive_format=self.export_archive_format or None,
+                        part_size=self.export_part_size_mb * 1024 * 1024,
+                        dedup=self.export_dedup,
+                        cache_db_path=self.cache_db_path,
+                        transcoder=transcoder,
+                        transcode_params=transcode_params,
+                        transcode_jobs=transcode_jobs,
+                    )
+                    updates.put(("done", result))
+                except Exception as e:
+                    updates.put(("error", e))
+
+            threading.Thread(target=worker, daemon=True).start()
+            dialog.after(200, poll_updates)
+
+        def cancel_export():
+            if state["cancel_event"] is not None:
+                state["cancel_event"].set()
+                status_var.set("Остановка...")
+            else:
+                dialog.destroy()
+
+        dialog.protocol("WM_DELETE_WINDOW", cancel_export)
+        btn_frame = ttk.Frame(dialog)
+        btn_frame.pack(pady=10)
+        ttk.Button(btn_frame, text="Начать экспорт", command=start_export).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=cancel_export).pack(side=tk.LEFT, padx=5)
+
+    def optimize_export_images(self):
+        if not self.export_dir or not os.path.isdir(self.export_dir):
+            messagebox.showinfo("Информация", "Сначала экспортируйте коллекцию")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Оптимизация изображений")
+        dialog.transient(self.root)
+        dialog.geometry(self.geometry_over_widget(self.root, 520, 340))
+
+        ttk.Label(dialog, text="Оптимизация изображений", font=("Arial", 12, "bold")).pack(pady=10)
+        ttk.Label(dialog, text=f"Каталог: {self.export_dir}", wraplength=460, justify=tk.LEFT).pack(padx=20, anchor=tk.W)
+
+        settings_frame = ttk.Frame(dialog)
+        settings_frame.pack(fill=tk.X, padx=20, pady=5)
+        max_dimension_var = tk.IntVar(value=self.image_max_dimension)
+        ttk.Label(settings_frame, text="Макс. сторона, px:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=64, to=4096, increment=64, textvariable=max_dimension_var, width=10).grid(
+            row=0, column=1, sticky=tk.W, padx=5, pady=5
+        )
+        format_labels = {"keep": "Как есть", "png": "PNG", "jpeg": "JPEG", "webp": "WebP"}
+        format_labels_to_value = {label: value for value, label in format_labels.items()}
+        format_var = tk.StringVar(value=format_labels[self.image_format])
+        ttk.Label(settings_frame, text="Формат:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(
+            settings_frame, textvariable=format_var, values=list(format_labels_to_value), state="readonly", width=12
+        ).grid(row=1, column=1, sticky=tk.W, padx=5, pady=5)
+        quality_var = tk.IntVar(value=self.image_quality)
+        ttk.Label(settings_frame, text="Качество JPEG/WebP:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(settings_frame, from_=30, to=100, textvariable=quality_var, width=10).grid(
+            row=2, column=1, sticky=tk.W, padx=5, pady=5
+        )
+
+        status_var = tk.StringVar(value="Готов к обработке")
+        ttk.Label(dialog, textvariable=status_var).pack(padx=20, anchor=tk.W)
+        progress = ttk.Progressbar(dialog, mode="determinate", maximum=1)
+        progress.pack(fill=tk.X, padx=20, pady=5)
+
+        updates = queue.Queue()
+        state = {"cancel_event": None}
+
+        def poll_updates():
+            if not dialog.winfo_exists():
+                return
+            while True:
+                try:
+                    kind, payload = updates.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "progress":
+                    progress["maximum"] = max(payload["total_files"], 1)
+                    progress["value"] = payload["done_files"] + payload["failed_files"]
+                    status_var.set(
+                        f"Файлов: {payload['done_files']}/{payload['total_files']}, "
+                        f"{format_bytes(payload['input_bytes'])} -> {format_bytes(payload['output_bytes'])}"
+                    )
+                elif kind == "done":
+                    state["cancel_event"] = None
+                    if payload["cancelled"]:
+                        status_var.set("Оптимизация остановлена, её можно продолжить позже")
+                        return
+                    status_var.set("Оптимизация завершена")
+                    message = (
+                        f"Обработано: {payload['done_files']}\n"
+                        f"Уже были оптимизированы: {payload['skipped_files']}\n"
+                        f"Размер: {format_bytes(payload['input_bytes'])} -> {format_bytes(payload['output_bytes'])}\n"
+                        f"Обновлено ссылок в gamelist.xml: {payload['renamed_references']}\n"
+                        f"Время: {format_duration(payload['elapsed_seconds'])}"
+                    )
+                    if payload["failed_files"]:
+                        message += f"\nОшибок: {len(payload['failed_files'])}"
+                    messagebox.showinfo("Готово", message, parent=dialog)
+                    return
+                elif kind == "error":
+                    state["cancel_event"] = None
+                    status_var.set("Ошибка оптимизации")
+                    messagebox.showerror("Ошибка", f"Не удалось оптимизировать изображения: {payload}", parent=dialog)
+                    print(f"Error optimizing images: {payload}")
+                    return
+            dialog.after(200, poll_updates)
+
+        def start_optimization():
+            if state["cancel_event"] is not None:
+                return
+            self.image_max_dimension = max(max_dimension_var.get(), 16)
+            self.image_format = format_labels_to_value.get(format_var.get(), "keep")
+            self.image_quality = min(max(quality_var.get(), 1), 100)
+            self.save_project_state()
+            params = image_params(self.image_max_dimension, self.image_format, self.image_quality)
+            cancel_event = threading.Event()
+            state["cancel_event"] = cancel_event
+            status_var.set("Поиск изображений...")
+
+            def worker():
+                try:
+                    result = run_image_optimization(
+                        self.export_dir,
+                        params,
+                        progress_callback=lambda snapshot: updates.put(("progress", snapshot)),
+                        cancel_event=cancel_event,
+                    )
+                    updates.put(("done", result))
+                except Exception as e:
+                    updates.put(("error", e))
+
+            threading.Thread(target=worker, daemon=True).start()
+            dialog.after(200, poll_updates)
+
+        def cancel_optimization():
+            if state["cancel_event"] is not None:
+                state["cancel_event"].set()
+                status_var.set("Остановка...")
+            else:
+                dialog.destroy()
+
+        dialog.protocol("WM_DELETE_WINDOW", cancel_optimization)
+        btn_frame = ttk.Frame(dialog)
+        btn_frame.pack(pady=10)
+        ttk.Button(btn_frame, text="Начать", command=start_optimization).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Отмена", command=cancel_optimization).pack(side=tk.LEFT, padx=5)
+
+    def free_space_at(self, directory):
+        while directory and not os.path.exists(directory):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
+        try:
+            return shutil.disk_usage(directory).free
+        except OSError:
+            return None
 
     def load_game_preview(self, game):
         self._preview_generation += 1
@@ -628,18 +1300,18 @@ class GameAppUI:
         self._current_preview_key = game.get("db_id") or game.get("path")
 
         desc = game.get("desc", "")
-        self.desc_text.delete(1.0, tk.END)
+        self._pending_translation_key = None
+        # Память переводов проверяет фоновый поток: выбор строки не ждёт SQLite
         if desc and needs_translation(desc):
-            translated = translate_text(desc)
-            self.desc_text.insert(tk.END, translated)
-        else:
-            self.desc_text.insert(tk.END, desc if desc else "Нет описания")
+            self.request_preview_translation(preview_generation, desc)
+        self.show_description(desc)
 
         image_rel = game.get("image") or f"media/png/{game.get('rom_stem', '')}.png"
         if image_rel:
             img_path = os.path.join(self.rom_dir, image_rel)
             print(f"Loading image: {img_path}")
-            if os.path.exists(img_path):
+            self.reset_scaled_images()
+            if self.media_file_exists(image_rel):
                 try:
                     self.original_image = Image.open(img_path)
                     self.render_current_image()
@@ -653,30 +1325,63 @@ class GameAppUI:
             self.original_image = None
             self.image_label.config(image=None, text="No image")
 
-        if self.video_timer:
-            self.video_timer.cancel()
-            self.video_timer = None
+        self.cancel_video_job()
 
         stop_video(self)
         self.current_video_aspect = None
+        self.clear_video_message()
         self.update_media_layout()
 
-        video_rel = game.get("video") or f"media/mp4/{game.get('rom_stem', '')}.mp4"
+        video_rel = self.preview_video_rel(game)
+        if video_rel and not self.media_file_exists(video_rel):
+            print(f"Video not in collection: {video_rel}")
+            video_rel = None
         if video_rel:
             video_path = os.path.join(self.rom_dir, video_rel)
+            if self.use_preview_proxies:
+                proxy_path = self.proxy_builder.fresh_proxy(video_path, video_rel)
+                if proxy_path:
+                    video_path = proxy_path
+                else:
+                    self.proxy_builder.request(video_path, video_rel)
             print(f"Scheduling video load after {self.video_delay} seconds: {video_path}")
             self.pending_video_path = video_path
-            self.video_timer = threading.Timer(
-                self.video_delay,
+            self.video_job = self.root.after(
+                int(self.video_delay * 1000),
                 self.load_video_delayed,
-                args=(preview_generation, video_path),
+                preview_generation,
+                video_path,
             )
-            self.video_timer.daemon = True
-            self.video_timer.start()
         else:
             self.pending_video_path = None
-            for widget in self.video_frame.winfo_children():
-                widget.destroy()
+
+    def media_file_exists(self, relative_path):
+        # Выбор строки не открывает базу: наличие файла берём из индекса в памяти,
+        # который загружает фоновый поток инвентаря; до первой загрузки - с диска
+        if self.media_presence is None:
+            return os.path.exists(os.path.join(self.rom_dir, relative_path))
+        reference = normalize_reference(relative_path)
+        return reference is not None and index_key(reference) in self.media_presence
+
+    def show_description(self, desc):
+        self.desc_text.delete(1.0, tk.END)
+        self.desc_text.insert(tk.END, desc if desc else "Нет описания")
+
+    def request_preview_translation(self, preview_generation, desc):
+        self._pending_translation_key = preview_generation
+        self.preview_translator.submit(preview_generation, desc)
+        if self._translation_poll_job is None:
+            self._translation_poll_job = self.root.after(TRANSLATION_POLL_MS, self.poll_preview_translation)
+
+    def poll_preview_translation(self):
+        self._translation_poll_job = None
+        for key, _source_text, translated in self.preview_translator.poll():
+            if key == self._pending_translation_key and key == self._preview_generation:
+                self._pending_translation_key = None
+                self.show_description(translated)
+
+        if self._pending_translation_key == self._preview_generation:
+            self._translation_poll_job = self.root.after(TRANSLATION_POLL_MS, self.poll_preview_translation)
 
     def on_select(self, event):
         item = self.tree.focus()
@@ -708,19 +1413,35 @@ class GameAppUI:
         self.current_game = game
         self.load_game_preview(game)
 
+    def cancel_video_job(self):
+        if self.video_job is not None:
+            self.root.after_cancel(self.video_job)
+            self.video_job = None
+
+    def show_video_message(self, message):
+        self.clear_video_message()
+        self.video_label = tk.Label(self.video_frame, text=message, fg='red', wraplength=300)
+        self.video_label.pack(fill=tk.BOTH, expand=True)
+
+    def clear_video_message(self):
+        if self.video_label is not None:
+            self.video_label.destroy()
+            self.video_label = None
+
     def load_video_delayed(self, preview_generation, expected_path):
+        self.video_job = None
         if preview_generation != self._preview_generation:
             print(f"Video load skipped for stale preview: {expected_path}")
             return
 
-        if self.pending_video_path == expected_path and os.path.exists(self.pending_video_path):
+        # Наличие файла уже проверено по индексу при выборе игры
+        if self.pending_video_path == expected_path:
             print(f"Loading delayed video: {self.pending_video_path}")
             try:
                 play_video(self, self.pending_video_path)
             except Exception as e:
                 print(f"Error playing video: {e}")
-                for widget in self.video_frame.winfo_children():
-                    widget.destroy()
+                stop_video(self)
         else:
             print(f"Video not found or cancelled: {expected_path}")
 
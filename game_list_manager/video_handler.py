@@ -4,11 +4,44 @@ import os
 import subprocess
 import json
 from pathlib import Path
-import concurrent.futures
 import queue
 import uuid
-import shutil
 import threading
+import itertools
+import concurrent.futures
+import time
+import tempfile
+from collections import deque
+
+from export_engine import format_bytes, format_duration
+from compression_engine import (
+    CompressionJournal,
+    EncodeScheduler,
+    SAMPLE_SECONDS,
+    SizeModel,
+    SwapJournal,
+    collection_bytes,
+    compression_params,
+    decide_compression,
+    file_signature,
+    is_compressed_output,
+    load_compress_manifest,
+    plan_budget,
+    plan_compression,
+    recover_interrupted_swaps,
+    relative_key,
+    sample_params,
+    select_samples,
+    target_dimensions,
+)
+from db_cache import load_video_probes, store_video_probes
+
+
+PROXY_HEIGHT = 240
+PROXY_CRF = 32
+PROXY_MAX_DURATION = 15
+# Сколько секунд ffmpeg может не продвигаться, прежде чем задачу снимут
+STALL_TIMEOUT = 60
 
 
 def resolve_ffmpeg_binaries():
@@ -22,127 +55,579 @@ def resolve_ffmpeg_binaries():
 
     return "ffmpeg", "ffprobe"
 
-def compress_video_file(input_path, scale_factor, crf_value, max_duration):
+class FFmpegStalled(Exception):
+    pass
+
+
+class FFmpegCancelled(Exception):
+    pass
+
+
+def run_ffmpeg_with_progress(cmd, expected_duration, progress_callback=None, cancel_event=None,
+                             stall_timeout=STALL_TIMEOUT):
+    """Запуск ffmpeg с разбором -progress pipe:1 по мере поступления строк.
+
+    Вместо общего таймаута процесс снимается, если out_time и размер
+    результата не меняются stall_timeout секунд.
+    """
+    cmd = cmd[:1] + ["-v", "error", "-nostats", "-progress", "pipe:1"] + cmd[1:]
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+    lines = queue.Queue()
+    stderr_tail = deque(maxlen=40)
+
+    def read_stdout():
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line)
+
+    threading.Thread(target=read_stdout, daemon=True).start()
+    stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+    stderr_thread.start()
+
+    fields = {}
+    last_marker = None
+    last_advance = time.monotonic()
     try:
-        input_path = os.path.normpath(input_path)
-        ffmpeg_bin, ffprobe_bin = resolve_ffmpeg_binaries()
-        
-        if 'backup' in input_path.split(os.sep):
-            raise Exception("Попытка обработки файла в папке backup")
-        
-        if not os.path.exists(input_path):
-            raise FileNotFoundError(f"Файл не существует: {input_path}")
-        
-        print(f"Сжатие: {os.path.basename(input_path)}")
-        
-        file_dir = os.path.dirname(input_path)
-        backup_dir = os.path.join(file_dir, "backup")
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        filename = os.path.basename(input_path)
-        backup_path = os.path.join(backup_dir, filename)
-        
-        if not os.path.exists(backup_path):
-            shutil.copy2(input_path, backup_path)
-            print(f"Создан backup: {backup_path}")
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise FFmpegCancelled("Сжатие отменено")
+            try:
+                line = lines.get(timeout=1.0)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+
+            key, _, value = line.strip().partition("=")
+            if key:
+                fields[key] = value
+            if key == "progress":
+                marker = (fields.get("out_time_us") or fields.get("out_time_ms"), fields.get("total_size"))
+                if marker != last_marker:
+                    last_marker = marker
+                    last_advance = time.monotonic()
+                if progress_callback:
+                    progress_callback(parse_ffmpeg_progress(fields, expected_duration))
+
+            if time.monotonic() - last_advance > stall_timeout:
+                raise FFmpegStalled(f"FFmpeg не продвигается {stall_timeout} с")
+
+        returncode = process.wait()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        stderr_thread.join(timeout=5)
+
+    if returncode != 0:
+        raise Exception(f"Ошибка FFmpeg: {''.join(stderr_tail)}")
+
+
+def parse_ffmpeg_progress(fields, expected_duration):
+    try:
+        # out_time_ms у ffmpeg исторически тоже в микросекундах
+        out_time = int(fields.get("out_time_us") or fields.get("out_time_ms") or 0) / 1000000
+    except ValueError:
+        out_time = 0.0
+    try:
+        total_size = int(fields.get("total_size") or 0)
+    except ValueError:
+        total_size = 0
+    speed_text = (fields.get("speed") or "").rstrip("x").strip()
+    try:
+        speed = float(speed_text)
+    except ValueError:
+        speed = 0.0
+
+    percent = 100.0 if fields.get("progress") == "end" else 0.0
+    if expected_duration and fields.get("progress") != "end":
+        percent = min(max(out_time / expected_duration * 100, 0.0), 99.9)
+    return {
+        "percent": percent,
+        "speed": speed,
+        "out_time": out_time,
+        "total_size": total_size,
+    }
+
+
+def proxy_relative_path(video_rel):
+    normalized = os.path.normpath(video_rel or "")
+    if not normalized or normalized == "." or os.path.isabs(normalized):
+        return None
+    if normalized == ".." or normalized.startswith(".." + os.sep):
+        return None
+    return normalized
+
+
+def is_proxy_fresh(source_path, proxy_path):
+    try:
+        proxy_stat = os.stat(proxy_path)
+        source_stat = os.stat(source_path)
+    except OSError:
+        return False
+    return proxy_stat.st_size > 0 and proxy_stat.st_mtime >= source_stat.st_mtime
+
+
+def generate_preview_proxy(source_path, proxy_path, max_duration=PROXY_MAX_DURATION, height=PROXY_HEIGHT):
+    ffmpeg_bin, _ = resolve_ffmpeg_binaries()
+    os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+    temp_path = f"{proxy_path}.{uuid.uuid4().hex[:8]}.temp.mp4"
+
+    cmd = [
+        ffmpeg_bin,
+        "-v", "error",
+        "-i", source_path,
+        "-y",
+        "-t", str(max_duration),
+        "-vf", f"scale=-2:'min({height},ih)'",
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-tune", "fastdecode",
+        "-crf", str(PROXY_CRF),
+        "-pix_fmt", "yuv420p",
+        "-g", "30",
+        "-c:a", "aac",
+        "-b:a", "48k",
+        "-ac", "2",
+        "-movflags", "+faststart",
+        "-threads", "1",
+        temp_path
+    ]
+
+    try:
+        process = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        if process.returncode != 0:
+            raise Exception(f"Ошибка FFmpeg: {process.stderr}")
+        if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
+            raise Exception("Прокси-файл не создан")
+        os.replace(temp_path, proxy_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class PreviewProxyBuilder:
+    """Фоновое создание лёгких прокси-видео для превью в кэше рабочей папки.
+
+    Выбранная игра получает приоритет 0, массовая очередь - приоритет 1.
+    """
+
+    def __init__(self, proxy_dir):
+        self.proxy_dir = proxy_dir
+        self.tasks = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._generation = 0
+        self._bulk_generation = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def proxy_path(self, video_rel):
+        relative_path = proxy_relative_path(video_rel)
+        if relative_path is None:
+            return None
+        return os.path.join(self.proxy_dir, relative_path)
+
+    def fresh_proxy(self, source_path, video_rel):
+        proxy_path = self.proxy_path(video_rel)
+        if proxy_path and is_proxy_fresh(source_path, proxy_path):
+            return proxy_path
+        return None
+
+    def request(self, source_path, video_rel, priority=0):
+        proxy_path = self.proxy_path(video_rel)
+        if proxy_path is None:
+            return
+        # Запрос выбранной игры не привязан к массовой очереди и переживает её отмену
+        bulk_generation = self._bulk_generation if priority else None
+        with self._lock:
+            self.tasks.put((priority, next(self._order), (self._generation, bulk_generation), source_path, proxy_path))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def request_many(self, items):
+        for source_path, video_rel in items:
+            self.request(source_path, video_rel, priority=1)
+
+    def cancel_pending(self):
+        self._generation += 1
+
+    def cancel_bulk(self):
+        self._bulk_generation += 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                try:
+                    _, _, (generation, bulk_generation), source_path, proxy_path = self.tasks.get_nowait()
+                except queue.Empty:
+                    self._thread = None
+                    return
+
+            if generation != self._generation:
+                continue
+            if bulk_generation is not None and bulk_generation != self._bulk_generation:
+                continue
+            if not os.path.exists(source_path) or is_proxy_fresh(source_path, proxy_path):
+                continue
+
+            try:
+                generate_preview_proxy(source_path, proxy_path)
+                print(f"Created preview proxy: {proxy_path}")
+            except Exception as e:
+                print(f"Error creating preview proxy for {source_path}: {e}")
+
+
+def parse_frame_rate(value):
+    try:
+        numerator, _, denominator = (value or "").partition("/")
+        rate = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+    return rate if rate > 0 else 0.0
+
+
+def probe_video(path):
+    """Параметры видео через ffprobe или None, если ffprobe не смог прочитать файл."""
+    _, ffprobe_bin = resolve_ffmpeg_binaries()
+    cmd_info = [
+        ffprobe_bin, "-v", "quiet", "-print_format", "json",
+        "-show_format", "-show_streams", path
+    ]
+    result = subprocess.run(cmd_info, capture_output=True, text=True, timeout=60)
+    if result.returncode != 0:
+        return None
+
+    info = json.loads(result.stdout)
+    streams = info.get('streams', [])
+    video_stream = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    if not video_stream:
+        raise Exception("Видео поток не найден")
+    audio_stream = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    format_info = info.get('format', {})
+
+    duration = float(format_info.get('duration') or video_stream.get('duration') or 0)
+    audio_bitrate = int(audio_stream.get('bit_rate') or 0) if audio_stream else 0
+    video_bitrate = int(video_stream.get('bit_rate') or 0)
+    if not video_bitrate:
+        # У части контейнеров битрейт есть только у всего файла
+        video_bitrate = max(int(format_info.get('bit_rate') or 0) - audio_bitrate, 0)
+
+    return {
+        "duration": duration,
+        "width": int(video_stream.get('width') or 0),
+        "height": int(video_stream.get('height') or 0),
+        "frame_rate": (
+            parse_frame_rate(video_stream.get('avg_frame_rate'))
+            or parse_frame_rate(video_stream.get('r_frame_rate'))
+            or 30.0
+        ),
+        "video_codec": video_stream.get('codec_name') or "",
+        "video_bitrate": video_bitrate,
+        "audio_bitrate": audio_bitrate,
+    }
+
+
+def probe_videos(paths, cache_db_path=None, workers=None, progress_callback=None):
+    """Пакетный параллельный ffprobe с кэшем в SQLite по пути, размеру и дате.
+
+    Возвращает {путь: probe или None}.
+    """
+    signatures = {}
+    for path in paths:
+        try:
+            signatures[path] = file_signature(path)
+        except OSError:
+            continue
+
+    cached = load_video_probes(cache_db_path, signatures) if cache_db_path else {}
+    probes = {}
+    missing = []
+    for path, signature in signatures.items():
+        record = cached.get(path)
+        if record and record["size"] == signature["size"] and record["mtime"] == signature["mtime"]:
+            probes[path] = record
         else:
-            print(f"Используем существующий backup")
-        
-        temp_id = uuid.uuid4().hex[:8]
-        output_path = f"{input_path}.{temp_id}.temp.mp4"
-        output_path = os.path.normpath(output_path)
-        
-        cmd_info = [
-            ffprobe_bin, "-v", "quiet", "-print_format", "json",
-            "-show_format", "-show_streams", input_path
-        ]
-        
-        result = subprocess.run(cmd_info, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            duration = 10.0
-            width, height = 640, 480
-            print("Используем значения по умолчанию")
+            missing.append(path)
+
+    def probe_one(path):
+        try:
+            return probe_video(path)
+        except Exception as e:
+            print(f"Ошибка ffprobe для {path}: {e}")
+            return None
+
+    fresh = {}
+    workers = workers or min(32, (os.cpu_count() or 2) * 2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, (path, probe) in enumerate(zip(missing, executor.map(probe_one, missing)), start=1):
+            probes[path] = probe
+            if probe is not None:
+                fresh[path] = dict(probe, **signatures[path])
+            if progress_callback:
+                progress_callback(len(probes), len(signatures))
+
+    if cache_db_path and fresh:
+        store_video_probes(cache_db_path, fresh)
+    print(f"ffprobe: из кэша {len(signatures) - len(missing)}, новых {len(missing)}")
+    return probes
+
+
+def x264_encode_args(crf_value, width, height, threads):
+    return [
+        "-c:v", "libx264",
+        "-preset", "slow",
+        "-crf", str(crf_value),
+        "-pix_fmt", "yuv420p",
+        "-vf", f"scale={width}:{height}:flags=lanczos",
+        "-profile:v", "high",
+        "-level", "4.0",
+        "-tune", "film",
+        "-x264opts", "merange=24:b-adapt=2",
+        "-c:a", "aac",
+        "-b:a", "64k",
+        "-ac", "2",
+        "-ar", "48000",
+        "-profile:a", "aac_low",
+        "-movflags", "+faststart",
+        "-threads", str(threads),
+    ]
+
+
+def sample_encode(input_path, probe, params, seconds=SAMPLE_SECONDS, threads=2, cancel_event=None):
+    """Пробное кодирование нескольких секунд из середины ролика: (размер, длительность)."""
+    ffmpeg_bin, _ = resolve_ffmpeg_binaries()
+    seconds = min(seconds, probe["duration"], params["max_duration"])
+    start_time = max(0, (probe["duration"] - seconds) / 2)
+    new_width, new_height = target_dimensions(probe["width"], probe["height"], params["scale"])
+    output_path = os.path.join(tempfile.gettempdir(), f"gcm_sample_{uuid.uuid4().hex}.mp4")
+    cmd = [
+        ffmpeg_bin,
+        "-ss", str(start_time), "-t", str(seconds),
+        "-i", input_path,
+        "-y",
+    ] + x264_encode_args(params["crf"], new_width, new_height, threads) + [output_path]
+    try:
+        run_ffmpeg_with_progress(cmd, seconds, None, cancel_event)
+        return os.path.getsize(output_path), seconds
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def verify_compressed_video(path, expected_duration):
+    try:
+        probe = probe_video(path)
+    except Exception:
+        return False
+    # Нечитаемый или заметно укороченный результат не принимается
+    return probe is not None and probe["duration"] >= expected_duration * 0.8
+
+
+def transcode_video(source_path, output_path, scale_factor, crf_value, max_duration, threads=2,
+                    progress_callback=None, cancel_event=None, probe=None, stream_copy=False):
+    """Кодирует source_path в output_path; при неудачной обрезке без перекодирования - обычное сжатие."""
+    ffmpeg_bin, _ = resolve_ffmpeg_binaries()
+    filename = os.path.basename(source_path)
+    
+    if probe is None:
+        probe = probe_video(source_path)
+    
+    if probe is None:
+        duration = 10.0
+        width, height = 640, 480
+        frame_rate = 30.0
+        print("Используем значения по умолчанию")
+    else:
+        duration = probe["duration"]
+        width = probe["width"]
+        height = probe["height"]
+        frame_rate = probe["frame_rate"]
+    
+    new_width, new_height = target_dimensions(width, height, scale_factor)
+    expected_duration = min(duration, max_duration)
+    
+    def build_cmd(copy_streams):
+        if copy_streams:
+            # Без перекодирования: -ss перед -i режет по ближайшему ключевому кадру
+            cmd = [
+                ffmpeg_bin,
+                "-i", source_path,
+                "-y",
+                "-c", "copy",
+                "-avoid_negative_ts", "make_zero",
+                "-movflags", "+faststart",
+                output_path
+            ]
         else:
-            info = json.loads(result.stdout)
-            video_stream = next((s for s in info['streams'] if s['codec_type'] == 'video'), None)
-            if not video_stream:
-                raise Exception("Видео поток не найден")
-            
-            duration = float(info['format']['duration'])
-            width = int(video_stream['width'])
-            height = int(video_stream['height'])
-        
-        new_width = int(width * scale_factor)
-        new_height = int(height * scale_factor)
-        
-        min_height = 240
-        if new_height < min_height:
-            new_width = width
-            new_height = height
-       
-        new_width = new_width // 2 * 2
-        new_height = new_height // 2 * 2
-        
-        cmd = [
-            ffmpeg_bin,
-            "-i", input_path, 
-            "-y",
-            "-c:v", "libx264",
-            "-preset", "slow",
-            "-crf", str(crf_value),
-            "-pix_fmt", "yuv420p",
-            "-vf", f"scale={new_width}:{new_height}:flags=lanczos",
-            "-profile:v", "high",
-            "-level", "4.0",
-            "-tune", "film",
-            "-x264opts", "merange=24:b-adapt=2",
-            "-c:a", "aac",
-            "-b:a", "64k",
-            "-ac", "2",
-            "-ar", "48000",
-            "-profile:a", "aac_low",
-            "-movflags", "+faststart",
-            "-threads", "2",
-            output_path
-        ]
+            cmd = [
+                ffmpeg_bin,
+                "-i", source_path,
+                "-y",
+            ] + x264_encode_args(crf_value, new_width, new_height, threads) + [output_path]
         
         if duration > max_duration:
             start_time = max(0, (duration - max_duration) / 2)
             cmd = cmd[:1] + ["-ss", str(start_time), "-t", str(max_duration)] + cmd[1:]
+        return cmd
+    
+    if stream_copy:
+        try:
+            run_ffmpeg_with_progress(build_cmd(True), expected_duration, progress_callback, cancel_event)
+            if not verify_compressed_video(output_path, expected_duration):
+                raise Exception("результат обрезки не прошёл проверку")
+        except (FFmpegCancelled, FFmpegStalled):
+            raise
+        except Exception as e:
+            # Например, в ролике слишком редкие ключевые кадры: перекодируем как обычно
+            print(f"Обрезка без перекодирования не удалась ({e}), перекодируем: {filename}")
+            stream_copy = False
+    
+    if not stream_copy:
+        run_ffmpeg_with_progress(build_cmd(False), expected_duration, progress_callback, cancel_event)
+    
+    if not os.path.exists(output_path):
+        raise Exception("Выходной файл не создан после сжатия")
+    
+    output_bytes = os.path.getsize(output_path)
+    if output_bytes == 0:
+        raise Exception("Выходной файл пустой")
+    
+    return {
+        "frames": int(expected_duration * frame_rate),
+        "output_bytes": output_bytes,
+        "expected_duration": expected_duration,
+        "stream_copy": stream_copy,
+    }
+
+
+def compress_video_file(input_path, scale_factor, crf_value, max_duration, threads=2,
+                        progress_callback=None, cancel_event=None, probe=None, stream_copy=False,
+                        swap_journal=None, discard_backup=False, own_output=False):
+    """Сжимает файл на месте, оригинал остаётся в backup.
+
+    own_output - на месте файла лежит наш прошлый результат (по манифесту сжатия
+    или журналу замен): тогда кодируем из уже существующего backup.
+    """
+    input_path = os.path.normpath(input_path)
+    
+    if 'backup' in input_path.split(os.sep):
+        raise Exception("Попытка обработки файла в папке backup")
+    
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Файл не существует: {input_path}")
+    
+    print(f"Сжатие: {os.path.basename(input_path)}")
+    
+    file_dir = os.path.dirname(input_path)
+    backup_dir = os.path.join(file_dir, "backup")
+    os.makedirs(backup_dir, exist_ok=True)
+    
+    filename = os.path.basename(input_path)
+    backup_path = os.path.join(backup_dir, filename)
+    
+    temp_id = uuid.uuid4().hex[:8]
+    output_path = os.path.normpath(f"{input_path}.{temp_id}.temp.mp4")
+    input_bytes = os.path.getsize(input_path)
+    
+    # Оригинал переносится в backup переименованием, без копирования данных,
+    # и кодируется прямо оттуда: на диск пишется только результат
+    backup_exists = os.path.exists(backup_path)
+    renamed = not (own_output and backup_exists)
+    source_path = backup_path
+    if swap_journal is not None:
+        swap_journal.begin(input_path, backup_path, output_path, renamed)
+    if renamed:
+        # Backup от старого запуска, а файл с тех пор заменили: новым оригиналом
+        # считается текущий файл
+        os.replace(input_path, backup_path)
+        if backup_exists:
+            print(f"Устаревший backup заменён текущим файлом: {backup_path}")
+        else:
+            print(f"Оригинал перенесён в backup: {backup_path}")
+    else:
+        # В backup лежит оригинал от прошлого запуска, а на месте файла - уже сжатый результат:
+        # кодируем из оригинала, анализ и решение об обрезке относились к сжатому файлу
+        probe = None
+        stream_copy = False
+        print("Используем существующий backup как исходник")
+    
+    try:
+        stats = transcode_video(
+            source_path, output_path, scale_factor, crf_value, max_duration, threads=threads,
+            progress_callback=progress_callback, cancel_event=cancel_event, probe=probe, stream_copy=stream_copy,
+        )
+        os.replace(output_path, input_path)
         
-        process = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-        
-        if process.returncode != 0:
-            raise Exception(f"Ошибка FFmpeg: {process.stderr}")
-        
-        if not os.path.exists(output_path):
-            raise Exception("Выходной файл не создан после сжатия")
-        
-        if os.path.getsize(output_path) == 0:
-            raise Exception("Выходной файл пустой")
-        
-        shutil.move(output_path, input_path)
-        
-        print(f"Успешно сжато: {os.path.basename(input_path)}")
-        return True
-        
-    except Exception as e:
+    except BaseException as e:
         print(f"Ошибка при сжатии {input_path}: {e}")
         
-        if 'backup_path' in locals() and os.path.exists(backup_path):
-            try:
-                shutil.copy2(backup_path, input_path)
-                print(f"Восстановлен оригинал из backup")
-            except Exception as restore_error:
-                print(f"Ошибка восстановления: {restore_error}")
-        
-        if 'output_path' in locals() and output_path and os.path.exists(output_path):
+        if os.path.exists(output_path):
             try:
                 os.remove(output_path)
-            except:
+            except OSError:
                 pass
+        
+        if renamed and not os.path.exists(input_path):
+            try:
+                os.rename(backup_path, input_path)
+                print("Восстановлен оригинал из backup")
+            except OSError as restore_error:
+                print(f"Ошибка восстановления: {restore_error}")
+        
+        if swap_journal is not None:
+            swap_journal.end(input_path, "rollback")
         raise
+    
+    if swap_journal is not None:
+        swap_journal.end(input_path, "commit")
+    
+    if discard_backup and verify_compressed_video(input_path, stats["expected_duration"]):
+        try:
+            os.remove(backup_path)
+            if not os.listdir(backup_dir):
+                os.rmdir(backup_dir)
+        except OSError as e:
+            print(f"Не удалось удалить backup {backup_path}: {e}")
+    
+    print(f"Успешно сжато: {os.path.basename(input_path)}")
+    return {
+        "frames": stats["frames"],
+        "input_bytes": input_bytes,
+        "output_bytes": stats["output_bytes"],
+        "stream_copy": stats["stream_copy"],
+    }
+
+
+def make_export_transcoder(params, threads=2, cache_db_path=None):
+    """Функция для конвейерного экспорта: кодирует видео из исходной коллекции сразу в экспорт.
+
+    Возвращает статистику или None, если сжатие не уменьшит файл и его нужно просто скопировать.
+    """
+    def transcode(source_path, output_path, cancel_event):
+        probe = probe_videos([source_path], cache_db_path, workers=1).get(source_path)
+        decision = decide_compression(probe, os.path.getsize(source_path), params)
+        if decision["action"] == "skip":
+            return None
+        return transcode_video(
+            source_path, output_path, params["scale"], params["crf"], params["max_duration"],
+            threads=threads, cancel_event=cancel_event, probe=probe, stream_copy=decision["action"] == "copy",
+        )
+
+    return transcode
+
 
 def compress_video(app, collection_dir, collection_label):
     if not collection_dir:
@@ -155,7 +640,7 @@ def compress_video(app, collection_dir, collection_label):
 
     compression_dialog = tk.Toplevel(app.root)
     compression_dialog.title(f"Сжатие видео: {collection_label}")
-    compression_dialog.geometry("500x450")
+    compression_dialog.geometry("560x710")
     
     ttk.Label(
         compression_dialog,
@@ -166,7 +651,8 @@ def compress_video(app, collection_dir, collection_label):
     scale_var = tk.DoubleVar(value=0.75)
     crf_var = tk.IntVar(value=27)
     max_duration_var = tk.IntVar(value=10)
-    parallel_var = tk.IntVar(value=6)
+    parallel_var = tk.IntVar(value=0)
+    budget_var = tk.IntVar(value=0)
     
     settings_frame = ttk.Frame(compression_dialog)
     settings_frame.pack(pady=10, padx=20, fill=tk.X)
@@ -202,10 +688,28 @@ def compress_video(app, collection_dir, collection_label):
     duration_spin = ttk.Spinbox(settings_frame, from_=5, to=60, textvariable=max_duration_var, width=10)
     duration_spin.grid(row=3, column=1, sticky=tk.W, pady=5, padx=5)
     
-    ttk.Label(settings_frame, text="Параллельных задач:").grid(row=4, column=0, sticky=tk.W, pady=5)
-    parallel_spin = ttk.Spinbox(settings_frame, from_=1, to=12, textvariable=parallel_var, width=10)
+    ttk.Label(settings_frame, text="Параллельных задач (0 - авто):").grid(row=4, column=0, sticky=tk.W, pady=5)
+    parallel_spin = ttk.Spinbox(settings_frame, from_=0, to=32, textvariable=parallel_var, width=10)
     parallel_spin.grid(row=4, column=1, sticky=tk.W, pady=5, padx=5)
     
+    discard_backup_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(
+        settings_frame,
+        text="Удалять backup после проверки результата",
+        variable=discard_backup_var
+    ).grid(row=5, column=0, columnspan=3, sticky=tk.W, pady=5)
+    
+    trim_only_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(
+        settings_frame,
+        text="Только обрезка (перекодировать лишь неподходящие по кодеку/битрейту)",
+        variable=trim_only_var
+    ).grid(row=6, column=0, columnspan=3, sticky=tk.W, pady=5)
+    
+    ttk.Label(settings_frame, text="Бюджет коллекции (МБ, 0 - нет):").grid(row=7, column=0, sticky=tk.W, pady=5)
+    budget_spin = ttk.Spinbox(settings_frame, from_=0, to=10000000, increment=100, textvariable=budget_var, width=10)
+    budget_spin.grid(row=7, column=1, sticky=tk.W, pady=5, padx=5)
+    
     settings_frame.columnconfigure(1, weight=1)
     
     status_var = tk.StringVar(value="Готов к обработке")
@@ -229,8 +733,19 @@ def compress_video(app, collection_dir, collection_label):
     active_tasks_var = tk.StringVar(value="0/0")
     active_label = ttk.Label(parallel_frame, textvariable=active_tasks_var)
     active_label.pack(anchor=tk.W)
+    jobs_listbox = tk.Listbox(parallel_frame, height=6)
+    jobs_listbox.pack(fill=tk.X, pady=2)
+    throughput_var = tk.StringVar(value="")
+    ttk.Label(parallel_frame, textvariable=throughput_var).pack(anchor=tk.W)
+    eta_var = tk.StringVar(value="")
+    ttk.Label(parallel_frame, textvariable=eta_var).pack(anchor=tk.W)
     
-    def start_compression():
+    cancel_event = threading.Event()
+    events = queue.Queue()
+    
+    state = {}
+    
+    def scan_videos():
         video_files = []
         media_dir = os.path.join(collection_dir, "media")
         
@@ -240,87 +755,335 @@ def compress_video(app, collection_dir, collection_label):
             for file in files:
                 if file.lower().endswith('.mp4'):
                     full_path = os.path.join(root, file)
-                    video_files.append((file, full_path))
-        
-        if not video_files:
-            status_var.set("MP4 файлы не найдены в media/")
+                    video_files.append({"name": file, "path": full_path, "size": os.path.getsize(full_path)})
+        return video_files
+    
+    def start_compression():
+        if state.get("busy"):
             return
+        state["busy"] = True
+        # Переменные Tk читаются только здесь, в потоке интерфейса
+        params = compression_params(
+            scale_var.get(), crf_var.get(), max_duration_var.get(),
+            trim_only=trim_only_var.get(), budget_bytes=budget_var.get() * 1024 * 1024
+        )
         
-        total_files = len(video_files)
-        progress["maximum"] = total_files
-        progress["value"] = 0
-        
-        max_workers = parallel_var.get()
+        # Восстановление, обход media/ и сверка с манифестом (с SHA1 файлов) идут в фоне:
+        # на большой коллекции они надолго заморозили бы диалог
+        def analyze_worker():
+            try:
+                events.put(("status", "Проверка прерванных замен..."))
+                restored, swapped_paths = recover_interrupted_swaps(collection_dir)
+                if restored:
+                    print(f"Восстановлено оригиналов после прерванного сжатия: {restored}")
+                
+                events.put(("status", "Поиск видео в media/..."))
+                video_files = scan_videos()
+                if not video_files:
+                    events.put(("idle", "MP4 файлы не найдены в media/"))
+                    return
+                
+                events.put(("status", f"Сверка с манифестом сжатия: {len(video_files)} видео..."))
+                manifest_files = load_compress_manifest(collection_dir)
+                pending_paths, skipped_paths = plan_compression(
+                    collection_dir, [video_file["path"] for video_file in video_files], params, manifest_files
+                )
+                pending_set = set(pending_paths)
+                skipped_count = len(skipped_paths)
+                video_files = [video_file for video_file in video_files if video_file["path"] in pending_set]
+                print(f"Уже сжаты с этими настройками: {skipped_count}, к обработке: {len(video_files)}")
+                
+                total_files = len(video_files) + skipped_count
+                if not video_files:
+                    events.put(("idle", f"Все видео уже сжаты с этими настройками ({skipped_count})"))
+                    return
+                
+                state.update(
+                    params=params,
+                    manifest_files=manifest_files,
+                    swapped_paths=swapped_paths,
+                    skipped_count=skipped_count,
+                    total_files=total_files,
+                    telemetry=None,
+                    predicted_total=None,
+                )
+                events.put(("planned", total_files, skipped_count))
+                
+                events.put(("status", "Анализ видео (ffprobe)..."))
+                probes = probe_videos(
+                    [video_file["path"] for video_file in video_files],
+                    app.cache_db_path,
+                    progress_callback=lambda done, total: events.put(("probe", done, total)),
+                )
+                for video_file in video_files:
+                    video_file["probe"] = probes.get(video_file["path"])
+                    video_file["decision"] = decide_compression(video_file["probe"], video_file["size"], params)
+                if params.get("budget"):
+                    plan_to_budget(video_files, params)
+                events.put(("analysis", video_files))
+            except Exception as e:
+                events.put(("analysis_error", str(e)))
         
-        def compress_worker():
-            completed_count = 0
-            task_queue = queue.Queue()
-            
-            for video_file in video_files:
-                task_queue.put(video_file)
-            
-            def worker_task(file_info):
-                filename, full_path = file_info
+        def plan_to_budget(video_files, params):
+            # Всё, что не будет сжиматься сейчас, занимает бюджет как есть
+            fixed_bytes = collection_bytes(collection_dir) - sum(video_file["size"] for video_file in video_files)
+            size_model = SizeModel()
+            samples = [
+                (video_file, sample) for video_file in select_samples(video_files) for sample in sample_params(params)
+            ]
+            for index, (video_file, sample) in enumerate(samples, start=1):
+                events.put(("sample", index, len(samples)))
                 try:
-                    status_var.set(f"Обработка: {filename}")
-                    result = compress_video_file(
-                        full_path, 
-                        scale_var.get(),
-                        crf_var.get(),
-                        max_duration_var.get()
+                    output_bytes, seconds = sample_encode(
+                        video_file["path"], video_file["probe"], sample,
+                        threads=os.cpu_count() or 2, cancel_event=cancel_event,
                     )
-                    return (filename, result, None)
+                except (FFmpegCancelled, FFmpegStalled):
+                    raise
                 except Exception as e:
-                    return (filename, False, str(e))
+                    print(f"Пробное кодирование не удалось: {video_file['name']}: {e}")
+                    continue
+                size_model.add_sample(video_file["probe"], video_file["size"], sample, output_bytes, seconds)
+            size_model.fit()
             
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {}
-                active_tasks = 0
-                
-                def update_status():
-                    active_tasks_var.set(f"{active_tasks}/{max_workers}")
-                    compression_dialog.update_idletasks()
-                
-                for _ in range(min(max_workers, task_queue.qsize())):
-                    if not task_queue.empty():
-                        file_info = task_queue.get()
-                        future = executor.submit(worker_task, file_info)
-                        futures[future] = file_info
-                        active_tasks += 1
-                        update_status()
-                
-                while futures:
-                    done, _ = concurrent.futures.wait(futures.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
-                    
-                    for future in done:
-                        file_info = futures.pop(future)
-                        filename, success, error = future.result()
-                        
-                        completed_count += 1
-                        progress["value"] = completed_count
-                        
-                        if error:
-                            print(f"Ошибка сжатия {filename}: {error}")
-                        else:
-                            print(f"Успешно: {filename}")
-                        
-                        if not task_queue.empty():
-                            new_file_info = task_queue.get()
-                            new_future = executor.submit(worker_task, new_file_info)
-                            futures[new_future] = new_file_info
-                        else:
-                            active_tasks -= 1
-                        
-                        update_status()
-                        compression_dialog.update_idletasks()
+            assignments, predicted_bytes = plan_budget(
+                video_files, params["budget"] - fixed_bytes, params, size_model
+            )
+            for video_file, (file_params, decision) in zip(video_files, assignments):
+                video_file["params"] = file_params
+                video_file["decision"] = decision
+            state["predicted_total"] = fixed_bytes + predicted_bytes
+        
+        status_var.set("Подготовка...")
+        threading.Thread(target=analyze_worker, daemon=True).start()
+        compression_dialog.after(200, poll_events)
+    
+    def confirm_analysis(video_files):
+        counts = {"encode": 0, "copy": 0, "skip": 0}
+        for video_file in video_files:
+            counts[video_file["decision"]["action"]] += 1
+        current_bytes = sum(video_file["size"] for video_file in video_files)
+        expected_bytes = sum(video_file["decision"]["expected_bytes"] for video_file in video_files)
+        message = (
+            f"Перекодировать: {counts['encode']}\n"
+            f"Обрезать без перекодирования: {counts['copy']}\n"
+            f"Не уменьшатся, пропустить: {counts['skip']}\n"
+            f"Уже сжаты ранее: {state['skipped_count']}\n\n"
+            f"Сейчас: {format_bytes(current_bytes)}\n"
+            f"Ожидается: ~{format_bytes(expected_bytes)} "
+            f"(экономия ~{format_bytes(max(current_bytes - expected_bytes, 0))})\n\n"
+        )
+        if state["predicted_total"] is not None:
+            budget = state["params"]["budget"]
+            fits = "укладывается" if state["predicted_total"] <= budget else "НЕ укладывается даже на минимальных настройках"
+            message += (
+                f"Коллекция после сжатия: ~{format_bytes(state['predicted_total'])} "
+                f"из бюджета {format_bytes(budget)} ({fits})\n\n"
+            )
+        message += "Начать сжатие?"
+        if not messagebox.askyesno("Анализ видео", message, parent=compression_dialog):
+            status_var.set("Готов к обработке")
+            state["busy"] = False
+            return False
+        start_encoding(video_files)
+        return True
+    
+    def start_encoding(video_files):
+        params = state["params"]
+        max_jobs = parallel_var.get()
+        discard_backup = discard_backup_var.get()
+        journal = CompressionJournal(collection_dir, state["manifest_files"])
+        swap_journal = SwapJournal(collection_dir)
+        skip_files = [video_file for video_file in video_files if video_file["decision"]["action"] == "skip"]
+        work_files = [video_file for video_file in video_files if video_file["decision"]["action"] != "skip"]
+        
+        def worker_task(video_file, threads):
+            full_path = video_file["path"]
+            action = video_file["decision"]["action"]
+            # В режиме бюджета у каждого файла свои масштаб и CRF
+            file_params = video_file.get("params", params)
+            input_signature = file_signature(full_path, with_hash=True)
+            own_output = os.path.normpath(full_path) in state["swapped_paths"] or is_compressed_output(
+                full_path, state["manifest_files"].get(relative_key(collection_dir, full_path))
+            )
+            stats = compress_video_file(
+                full_path,
+                file_params["scale"],
+                file_params["crf"],
+                file_params["max_duration"],
+                threads=threads,
+                progress_callback=lambda snapshot: events.put(("progress", video_file, snapshot)),
+                cancel_event=cancel_event,
+                probe=video_file.get("probe"),
+                stream_copy=action == "copy",
+                swap_journal=swap_journal,
+                discard_backup=discard_backup,
+                own_output=own_output,
+            )
+            # Запись в журнал сразу после файла: прерванный пакет продолжится с этого места
+            # Обрезка без перекодирования могла откатиться на обычное сжатие
+            extra = {"action": "copy" if stats["stream_copy"] else "encode"}
+            if "params" in video_file:
+                extra.update(scale=file_params["scale"], crf=file_params["crf"])
+            journal.record(full_path, input_signature, params, extra)
+            return stats
+        
+        def compress_worker():
+            scheduler = None
+            try:
+                # Файлы, которые не уменьшатся, тоже попадают в манифест и в следующий раз не анализируются
+                for video_file in skip_files:
+                    if cancel_event.is_set():
+                        break
+                    signature = file_signature(video_file["path"], with_hash=True)
+                    journal.record(video_file["path"], signature, params, {"action": "skip"})
+                    events.put(("skipped", video_file))
                 
-            status_var.set("Обработка завершена!")
-            messagebox.showinfo("Готово", f"Сжатие видео завершено\nОбработано: {completed_count}/{total_files}")
+                scheduler = EncodeScheduler(
+                    work_files,
+                    worker_task,
+                    weight=lambda video_file: (video_file.get("probe") or {}).get("duration") or video_file["size"],
+                    max_jobs=max_jobs,
+                    cancel_event=cancel_event,
+                    event_callback=events.put,
+                )
+                scheduler.run()
+            except Exception as e:
+                print(f"Error compressing videos: {e}")
+                events.put(("error", str(e)))
+            finally:
+                swap_journal.close()
+                journal.close()
+                # Диалог ждёт "finished" в любом случае, иначе он зависнет на прогрессе
+                scheduler = scheduler or EncodeScheduler([], None)
+                events.put(("finished", scheduler.throughput(), scheduler.failed))
         
+        state["telemetry"] = {
+            "started_at": time.monotonic(),
+            "total_bytes": sum(video_file["size"] for video_file in work_files),
+            "done_bytes": 0,
+            "saved_bytes": 0,
+            "active": {},
+        }
         threading.Thread(target=compress_worker, daemon=True).start()
     
+    def refresh_telemetry(telemetry):
+        active = telemetry["active"]
+        jobs_listbox.delete(0, tk.END)
+        for video_file, snapshot in active.values():
+            jobs_listbox.insert(
+                tk.END,
+                f"{video_file['name']}: {snapshot['percent']:.0f}%, {snapshot['speed']:.1f}x, "
+                f"{format_bytes(snapshot['total_size'])}"
+            )
+        
+        # Оценка по байтам исходников: завершённые файлы плюс доля уже закодированных
+        processed = telemetry["done_bytes"] + sum(
+            video_file["size"] * snapshot["percent"] / 100 for video_file, snapshot in active.values()
+        )
+        elapsed = time.monotonic() - telemetry["started_at"]
+        parts = [f"Сэкономлено: {format_bytes(telemetry['saved_bytes'])}"]
+        if processed > 0 and elapsed > 0:
+            remaining = max(telemetry["total_bytes"] - processed, 0)
+            parts.append(f"осталось ~{format_duration(remaining / (processed / elapsed))}")
+        eta_var.set(", ".join(parts))
+    
+    def poll_events():
+        if not compression_dialog.winfo_exists():
+            return
+        
+        telemetry = state.get("telemetry")
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+            
+            kind = event[0]
+            if kind == "status":
+                status_var.set(event[1])
+            elif kind == "idle":
+                status_var.set(event[1])
+                state["busy"] = False
+                return
+            elif kind == "planned":
+                _, total_files, skipped_count = event
+                progress["maximum"] = max(total_files, 1)
+                progress["value"] = skipped_count
+            elif kind == "probe":
+                status_var.set(f"Анализ видео (ffprobe): {event[1]}/{event[2]}")
+            elif kind == "sample":
+                status_var.set(f"Пробное кодирование для бюджета: {event[1]}/{event[2]}")
+            elif kind == "analysis_error":
+                status_var.set("Ошибка анализа видео")
+                state["busy"] = False
+                messagebox.showerror("Ошибка", event[1], parent=compression_dialog)
+                return
+            elif kind == "analysis":
+                if not confirm_analysis(event[1]):
+                    return
+                telemetry = state["telemetry"]
+            elif kind == "skipped":
+                progress["value"] = progress["value"] + 1
+            elif kind == "start":
+                _, video_file, running, jobs, threads = event
+                status_var.set(f"Обработка: {video_file['name']}")
+                active_tasks_var.set(f"{running}/{jobs} (потоков на задачу: {threads})")
+                telemetry["active"][video_file["path"]] = (
+                    video_file, {"percent": 0.0, "speed": 0.0, "total_size": 0}
+                )
+            elif kind == "progress":
+                _, video_file, snapshot = event
+                if video_file["path"] in telemetry["active"]:
+                    telemetry["active"][video_file["path"]] = (video_file, snapshot)
+            elif kind in ("done", "failed"):
+                video_file = event[1]
+                telemetry["active"].pop(video_file["path"], None)
+                telemetry["done_bytes"] += video_file["size"]
+                progress["value"] = progress["value"] + 1
+                if kind == "failed":
+                    print(f"Ошибка сжатия {video_file['name']}: {event[2]}")
+                else:
+                    print(f"Успешно: {video_file['name']}")
+                    stats, throughput = event[2], event[3]
+                    telemetry["saved_bytes"] += stats["input_bytes"] - stats["output_bytes"]
+                    throughput_var.set(
+                        f"{throughput['frames_per_second']:.0f} кадр/с, {throughput['mb_per_second']:.1f} МБ/с"
+                    )
+            elif kind == "error":
+                messagebox.showerror("Ошибка", f"Сжатие прервано: {event[1]}", parent=compression_dialog)
+            elif kind == "finished":
+                _, summary, failed = event
+                state["busy"] = False
+                status_var.set("Обработка завершена!")
+                active_tasks_var.set("0/0")
+                telemetry["active"].clear()
+                refresh_telemetry(telemetry)
+                messagebox.showinfo(
+                    "Готово",
+                    f"Сжатие видео завершено\n"
+                    f"Обработано: {int(progress['value'])}/{state['total_files']}\n"
+                    f"Пропущено (уже сжаты): {state['skipped_count']}\n"
+                    f"Ошибок: {len(failed)}\n"
+                    f"Сэкономлено: {format_bytes(telemetry['saved_bytes'])}\n"
+                    f"Скорость: {summary['frames_per_second']:.0f} кадр/с, "
+                    f"{summary['mb_per_second']:.1f} МБ/с",
+                    parent=compression_dialog,
+                )
+                return
+        
+        if telemetry is not None:
+            refresh_telemetry(telemetry)
+        compression_dialog.after(200, poll_events)
+    
+    def cancel_compression():
+        # Запущенные ffmpeg останавливаются, их исходники восстанавливаются из backup
+        cancel_event.set()
+        compression_dialog.destroy()
+    
     btn_frame = ttk.Frame(compression_dialog)
     btn_frame.pack(pady=10)
     
     ttk.Button(btn_frame, text="Начать сжатие", command=start_compression).pack(side=tk.LEFT, padx=5)
-    ttk.Button(btn_frame, text="Отмена", command=compression_dialog.destroy).pack(side=tk.LEFT, padx=5)
+    ttk.Button(btn_frame, text="Отмена", command=cancel_compression).pack(side=tk.LEFT, padx=5)
+    compression_dialog.protocol("WM_DELETE_WINDOW", cancel_compression)
@@ -1,4 +1,3 @@
-import tkinter as tk
 import os
 
 # Импортируем VLC плеер
@@ -58,12 +57,7 @@ class VideoPlayerManager:
     
     def show_error(self, app, message):
         """Показать сообщение об ошибке"""
-        for widget in app.video_frame.winfo_children():
-            widget.destroy()
-        
-        error_label = tk.Label(app.video_frame, text=message, fg='red', wraplength=300)
-        error_label.pack(fill=tk.BOTH, expand=True)
-        app.video_label = error_label
+        app.show_video_message(message)
 
 # Глобальный менеджер видео-плееров
 video_manager = VideoPlayerManager()
@@ -1,8 +1,10 @@
 import tkinter as tk
 import vlc
 import os
-import threading
-import time
+import queue
+
+EVENT_POLL_MS = 100
+
 
 class VLCVideoPlayer:
     def __init__(self):
@@ -11,121 +13,142 @@ class VLCVideoPlayer:
         self.current_path = None
         self.is_playing = False
         self.video_frame = None
+        self._poll_job = None
 
-    def detect_video_size(self, app, retries=20):
-        if not self.is_playing:
-            return
+        # Колбэки libvlc приходят из его собственных потоков, поэтому
+        # они только кладут событие в очередь, а Tk разбирает её через after()
+        self.events = queue.Queue()
+        event_manager = self.player.event_manager()
+        event_manager.event_attach(vlc.EventType.MediaPlayerVout, self._queue_event, "vout")
+        event_manager.event_attach(vlc.EventType.MediaPlayerEndReached, self._queue_event, "end")
+        event_manager.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._queue_event, "error")
 
-        video_size = self.player.video_get_size(0)
-        if video_size and video_size[0] > 0 and video_size[1] > 0:
-            if hasattr(app, "on_video_size_detected"):
-                app.on_video_size_detected(video_size[0], video_size[1])
-            return
+    def _queue_event(self, event, name):
+        self.events.put((name, self.current_path))
+
+    def ensure_video_frame(self, app):
+        """Один встроенный фрейм на всё время работы приложения"""
+        if self.video_frame is not None and self.video_frame.winfo_exists():
+            return self.video_frame
+
+        self.video_frame = tk.Frame(app.video_frame, bg='black')
+        window_id = self.video_frame.winfo_id()
+        if os.name == 'nt':  # Windows
+            self.player.set_hwnd(window_id)
+        else:  # Linux/Mac
+            self.player.set_xwindow(window_id)
+        return self.video_frame
 
-        if retries > 0:
-            app.root.after(100, self.detect_video_size, app, retries - 1)
-        
     def play_video(self, app, path):
         """Воспроизведение видео с помощью VLC"""
         print(f"Attempting to play video with VLC: {path}")
-        
+
         try:
             self.stop_video(app)
-            
+
             if not os.path.exists(path):
                 raise FileNotFoundError(f"Видео файл не найден: {path}")
-            
-            # Создаем фрейм для видео
-            self.video_frame = tk.Frame(app.video_frame, bg='black')
-            self.video_frame.pack(fill=tk.BOTH, expand=True)
-            
-            # Получаем ID окна для встраивания
-            window_id = self.video_frame.winfo_id()
-            
-            # Устанавливаем окно для воспроизведения
-            if os.name == 'nt':  # Windows
-                self.player.set_hwnd(window_id)
-            else:  # Linux/Mac
-                self.player.set_xwindow(window_id)
-            
-            # Создаем медиа объект
+
+            video_frame = self.ensure_video_frame(app)
+            video_frame.pack(fill=tk.BOTH, expand=True)
+
             media = self.instance.media_new(path)
             self.player.set_media(media)
-            
-            # Настраиваем параметры воспроизведения
+            media.release()
+
             self.player.set_rate(1.0)  # Нормальная скорость
             self.player.video_set_scale(0)  # Автомасштабирование
             self.player.audio_set_volume(100)  # Максимальная громкость
-            
-            # Запускаем воспроизведение
-            self.player.play()
+
             self.current_path = path
             self.is_playing = True
-            app.root.after(200, self.detect_video_size, app)
-            
-            # Мониторим состояние воспроизведения
-            self.monitor_playback(app)
-            
+            self.player.play()
+            self.schedule_event_poll(app)
+
             app.video_player = {
                 'player': self,
                 'running': True,
                 'frame': self.video_frame,
                 'path': path
             }
-            
+
             print(f"VLC video playback started: {path}")
-            
+
         except Exception as e:
             print(f"Error in VLC play_video: {e}")
             self.stop_video(app)
             self.show_error(app, f"Ошибка VLC: {e}")
-    
-    def monitor_playback(self, app):
-        """Мониторинг состояния воспроизведения"""
-        def monitor():
-            while self.is_playing and self.player.is_playing():
-                time.sleep(0.1)
-            
-            if self.is_playing:
-                # Видео завершилось или произошла ошибка
-                app.root.after(0, self.on_playback_end, app)
-        
-        thread = threading.Thread(target=monitor, daemon=True)
-        thread.start()
-    
+
+    def schedule_event_poll(self, app):
+        if self._poll_job is None:
+            self._poll_job = app.root.after(EVENT_POLL_MS, self.process_events, app)
+
+    def cancel_event_poll(self, app):
+        if self._poll_job is not None:
+            app.root.after_cancel(self._poll_job)
+            self._poll_job = None
+
+    def process_events(self, app):
+        """Обработка событий libvlc в потоке Tk"""
+        self._poll_job = None
+        while True:
+            try:
+                name, path = self.events.get_nowait()
+            except queue.Empty:
+                break
+
+            if not self.is_playing or path != self.current_path:
+                continue
+
+            if name == "vout":
+                self.on_video_output(app)
+            elif name == "end":
+                self.on_playback_end(app)
+            elif name == "error":
+                print(f"VLC reported an error for: {path}")
+                self.stop_video(app)
+                self.show_error(app, "Не удалось воспроизвести видео")
+
+        if self.is_playing:
+            self.schedule_event_poll(app)
+
+    def on_video_output(self, app):
+        video_size = self.player.video_get_size(0)
+        if video_size and video_size[0] > 0 and video_size[1] > 0:
+            if hasattr(app, "on_video_size_detected"):
+                app.on_video_size_detected(video_size[0], video_size[1])
+
     def on_playback_end(self, app):
         """Обработка завершения воспроизведения"""
         print("Video playback ended")
+        self.is_playing = False
         # Можно реализовать автоповтор или следующее видео
-    
+
     def stop_video(self, app):
-        """Остановка воспроизведения"""
+        """Остановка воспроизведения без пересоздания фрейма"""
+        was_active = self.current_path is not None
         self.is_playing = False
         self.current_path = None
-        
-        if self.player.is_playing():
+        self.cancel_event_poll(app)
+
+        if was_active:
             self.player.stop()
-        
-        if self.video_frame:
+
+        if self.video_frame is not None:
             try:
-                self.video_frame.destroy()
-            except:
-                pass
-            self.video_frame = None
-        
+                self.video_frame.pack_forget()
+            except tk.TclError:
+                self.video_frame = None
+
         if hasattr(app, 'video_player'):
             app.video_player = None
-        
-        print("VLC video playback stopped")
-    
+
+        if was_active:
+            print("VLC video playback stopped")
+
     def show_error(self, app, message):
         """Показать сообщение об ошибке"""
-        for widget in app.video_frame.winfo_children():
-            widget.destroy()
-        
-        error_label = tk.Label(app.video_frame, text=message, fg='red', wraplength=300)
-        error_label.pack(fill=tk.BOTH, expand=True)
-        app.video_label = error_label
+        app.show_video_message(message)
 
 # Глобальный экземпляр VLC плеера
 vlc_player = VLCVideoPlayer()
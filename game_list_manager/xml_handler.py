@@ -1,12 +1,39 @@
+import html
 import os
+import posixpath
+import re
 import shutil
+import threading
 import xml.etree.ElementTree as ET
 from pathlib import Path
+from xml.sax.saxutils import escape
+
+from db_cache import clear_pending_descriptions, load_media_index, load_pending_descriptions, refresh_media_inventory
+from export_engine import (
+    DEFAULT_EXPORT_STRATEGY,
+    DEFAULT_EXPORT_WORKERS,
+    build_copy_plan,
+    find_duplicate_files,
+    run_archive_plan,
+    run_copy_plan,
+)
+from media_index import (
+    index_key,
+    normalize_reference,
+    scan_collection,
+    stat_collection_file,
+    stat_skipped_reference,
+)
+from translation_memory import import_translation_memory
 
 
 CURATED_XML_FILENAME = "curated_gamelist.xml"
 PROJECT_STATE_FILENAME = "project_state.json"
 CACHE_DB_FILENAME = "curated_cache.sqlite"
+TRANSLATION_MEMORY_FILENAME = "translation_memory.sqlite"
+PREVIEW_PROXY_DIRNAME = "preview_proxies"
+# curated XML переписывают и поток перевода, и исключение отмеченных в потоке Tk
+curated_xml_lock = threading.RLock()
 FILE_REFERENCE_TAGS = {
     'path',
     'image',
@@ -21,6 +48,13 @@ FILE_REFERENCE_TAGS = {
     'pdf',
     'music',
 }
+FILE_REFERENCE_EXTENSIONS = {
+    '.zip', '.7z', '.chd', '.cue', '.bin', '.iso',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp',
+    '.mp4', '.avi', '.mkv', '.webm', '.flv',
+    '.mp3', '.ogg', '.wav', '.flac',
+    '.pdf',
+}
 
 
 def prepare_collection_workspace(rom_dir):
@@ -30,7 +64,13 @@ def prepare_collection_workspace(rom_dir):
     curated_xml_path = os.path.join(checked_dir, CURATED_XML_FILENAME)
     project_state_path = os.path.join(checked_dir, PROJECT_STATE_FILENAME)
     cache_db_path = os.path.join(checked_dir, CACHE_DB_FILENAME)
-    support_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pS_CatVer_287")
+    proxy_dir = os.path.join(checked_dir, PREVIEW_PROXY_DIRNAME)
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    support_root = os.path.join(app_dir, "pS_CatVer_287")
+    # Память переводов общая для всех коллекций: клоны и те же системы в другой папке
+    # переводятся из неё без обращения к сети
+    translation_memory_path = os.path.join(os.path.dirname(app_dir), TRANSLATION_MEMORY_FILENAME)
+    collection_translation_memory_path = os.path.join(checked_dir, TRANSLATION_MEMORY_FILENAME)
 
     os.makedirs(checked_dir, exist_ok=True)
 
@@ -38,12 +78,21 @@ def prepare_collection_workspace(rom_dir):
         shutil.copy2(source_xml_path, curated_xml_path)
         print(f"Created curated XML: {curated_xml_path}")
 
+    try:
+        imported = import_translation_memory(translation_memory_path, collection_translation_memory_path)
+        if imported:
+            print(f"Imported {imported} translations from {collection_translation_memory_path}")
+    except Exception as e:
+        print(f"Error importing translation memory: {e}")
+
     return {
         "source_xml_path": source_xml_path,
         "checked_dir": checked_dir,
         "curated_xml_path": curated_xml_path,
         "project_state_path": project_state_path,
         "cache_db_path": cache_db_path,
+        "translation_memory_path": translation_memory_path,
+        "proxy_dir": proxy_dir,
         "support_root": support_root,
     }
 
@@ -122,34 +171,15 @@ def looks_like_file_reference(tag_name, value):
     if lowered_value.startswith(('http://', 'https://')):
         return False
 
-    suffix = Path(lowered_value).suffix
-    if suffix in {
-        '.zip', '.7z', '.chd', '.cue', '.bin', '.iso',
-        '.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp',
-        '.mp4', '.avi', '.mkv', '.webm', '.flv',
-        '.mp3', '.ogg', '.wav', '.flac',
-        '.pdf',
-    }:
+    suffix = posixpath.splitext(lowered_value.replace('\\', '/'))[1]
+    if suffix in FILE_REFERENCE_EXTENSIONS:
         return True
 
     return ('/' in value) or ('\\' in value)
 
 
-def resolve_collection_path(collection_root, relative_path):
-    collection_root = Path(collection_root).resolve()
-    candidate = (collection_root / relative_path).resolve()
-
-    try:
-        candidate.relative_to(collection_root)
-    except ValueError:
-        print(f"Skipped path outside collection: {candidate}")
-        return None
-
-    return candidate
-
-
-def collect_game_file_paths(game_elem, collection_root):
-    file_paths = set()
+def collect_game_file_references(game_elem):
+    references = []
     for child in game_elem:
         child_text = (child.text or '').strip()
         if not child_text:
@@ -158,45 +188,327 @@ def collect_game_file_paths(game_elem, collection_root):
         if not looks_like_file_reference(child.tag, child_text):
             continue
 
-        resolved_path = resolve_collection_path(collection_root, child_text)
-        if resolved_path is not None:
-            file_paths.add(resolved_path)
+        reference = normalize_reference(child_text)
+        if reference is None:
+            print(f"Skipped path outside collection: {child_text}")
+            continue
+        references.append((child, reference))
+
+    return references
+
+
+def rewrite_file_references(xml_path, renames):
+    """Заменяет ссылки на файлы в gamelist.xml по словарю {index_key(старый путь): новый путь}."""
+    tree = ET.parse(xml_path)
+    changed = 0
+    for game_elem in tree.getroot().findall('game'):
+        for child, reference in collect_game_file_references(game_elem):
+            new_reference = renames.get(index_key(reference))
+            if new_reference is not None:
+                child.text = "./" + new_reference
+                changed += 1
+
+    if changed:
+        temp_path = xml_path + ".tmp"
+        tree.write(temp_path, encoding='utf-8', xml_declaration=True)
+        os.replace(temp_path, xml_path)
+    return changed
+
+
+# Комментарии и CDATA пропускаются целиком, чтобы не принять закомментированную игру за настоящую
+GAME_BLOCK_PATTERN = re.compile(r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<game\b[^>]*(?<!/)>.*?</game\s*>", re.S)
+PATH_PATTERN = re.compile(r"<path\b[^>]*>(.*?)</path\s*>", re.S)
+DESC_PATTERN = re.compile(r"<desc\b[^>]*?(?:/>|>.*?</desc\s*>)", re.S)
+
+
+def _element_text(raw):
+    if raw.startswith("<![CDATA[") and raw.endswith("]]>"):
+        return raw[9:-3]
+    return html.unescape(raw)
+
+
+def _replace_game_description(block, description):
+    desc_xml = f"<desc>{escape(description)}</desc>"
+    desc_match = DESC_PATTERN.search(block)
+    if desc_match:
+        return block[:desc_match.start()] + desc_xml + block[desc_match.end():]
+    # Нового <desc> не было: ставим после <path> с тем же отступом
+    path_match = PATH_PATTERN.search(block)
+    indent_match = re.search(r"(\r?\n[ \t]*)<path\b", block)
+    indent = indent_match.group(1) if indent_match else ""
+    return block[:path_match.end()] + indent + desc_xml + block[path_match.end():]
+
+
+def write_game_descriptions(xml_path, descriptions):
+    """Записывает описания {path: desc} в gamelist.xml, возвращает число изменённых игр.
+
+    Меняется только содержимое <desc> нужных игр: отступы, комментарии, DOCTYPE и
+    остальная разметка файла остаются байт в байт.
+    """
+    if not descriptions:
+        return 0
+    with open(xml_path, "r", encoding="utf-8", newline="") as f:
+        content = f.read()
+
+    changed = 0
+    parts = []
+    position = 0
+    for match in GAME_BLOCK_PATTERN.finditer(content):
+        block = match.group(0)
+        if not block.startswith("<game"):
+            continue
+        path_match = PATH_PATTERN.search(block)
+        if path_match is None:
+            continue
+        description = descriptions.get(_element_text(path_match.group(1)))
+        if description is None:
+            continue
+        parts.append(content[position:match.start()])
+        parts.append(_replace_game_description(block, description))
+        position = match.end()
+        changed += 1
+
+    if not changed:
+        return 0
+    parts.append(content[position:])
+    temp_path = xml_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="") as f:
+        f.write("".join(parts))
+    os.replace(temp_path, xml_path)
+    return changed
+
+
+def flush_pending_descriptions(xml_path, cache_db_path):
+    """Переносит в curated XML описания, уже записанные в кэш; после сбоя доводит запись при запуске."""
+    with curated_xml_lock:
+        descriptions = load_pending_descriptions(cache_db_path)
+        if not descriptions:
+            return 0
+        changed = write_game_descriptions(xml_path, descriptions)
+        clear_pending_descriptions(cache_db_path, descriptions)
+    print(f"Flushed {changed} descriptions to {xml_path}")
+    return changed
+
+
+def load_collection_index(source_root, cache_db_path=None):
+    # С кэшем индекс берётся из инвентаря медиа: пересканируются только изменившиеся каталоги
+    if cache_db_path:
+        refresh_media_inventory(cache_db_path, source_root, FILE_REFERENCE_TAGS)
+        return load_media_index(cache_db_path)
+    return scan_collection(source_root)
+
+
+def plan_curated_export(curated_xml_path, source_root, media_index=None, cache_db_path=None):
+    source_root = os.path.abspath(source_root)
+    # Инвентарь пересканирует каталог только при смене его mtime, а перезапись файла
+    # на месте её не меняет: размер и mtime для решений о копировании берём с диска
+    restat = media_index is not None or bool(cache_db_path)
+    if media_index is None:
+        media_index = load_collection_index(source_root, cache_db_path)
 
-    return file_paths
+    tree = ET.parse(curated_xml_path)
+    root = tree.getroot()
 
+    references = []
+    files = {}
+    missing_files = []
+    system_bytes = {}
+    restated = {}
+    for game_elem in root.findall('game'):
+        system = (game_elem.findtext('system') or '').strip() or 'Unknown'
+        for child, reference in collect_game_file_references(game_elem):
+            record = media_index.get(index_key(reference))
+            if record is not None and restat:
+                record = restated.get(record[0]) or stat_collection_file(source_root, record[0])
+                if record is not None:
+                    restated[record[0]] = record
+            record = record or stat_skipped_reference(source_root, reference)
+            if record is None:
+                missing_files.append(os.path.join(source_root, reference.replace('/', os.sep)))
+                continue
+
+            relative_path, size, mtime = record
+            references.append((child, relative_path))
+            if relative_path not in files:
+                files[relative_path] = (size, mtime)
+                system_bytes[system] = system_bytes.get(system, 0) + size
 
-def export_curated_collection(curated_xml_path, source_root, export_root):
+    return {
+        "tree": tree,
+        "references": references,
+        "files": files,
+        "missing_files": missing_files,
+        "system_bytes": system_bytes,
+        "total_bytes": sum(size for size, _ in files.values()),
+    }
+
+
+def estimate_curated_export(curated_xml_path, source_root, cache_db_path=None):
+    plan = plan_curated_export(curated_xml_path, source_root, cache_db_path=cache_db_path)
+    return {
+        "games_count": len(plan["tree"].getroot().findall('game')),
+        "files_count": len(plan["files"]),
+        "total_bytes": plan["total_bytes"],
+        "system_bytes": plan["system_bytes"],
+        "missing_files": plan["missing_files"],
+    }
+
+
+def apply_media_dedup(references, files, source_root, workers, cache_db_path):
+    # ROM-файлы не трогаем: дедупликация только для медиа-ссылок
+    rom_files = {relative_path for child, relative_path in references if child.tag.lower() == 'path'}
+    media_files = {relative_path for child, relative_path in references if child.tag.lower() != 'path'} - rom_files
+    absolute_paths = {
+        os.path.join(source_root, relative_path.replace('/', os.sep)): relative_path
+        for relative_path in media_files
+    }
+    duplicates, saved_bytes = find_duplicate_files(
+        {path: files[relative_path] for path, relative_path in absolute_paths.items()},
+        workers,
+        cache_db_path,
+    )
+    return {
+        absolute_paths[duplicate]: absolute_paths[canonical]
+        for duplicate, canonical in duplicates.items()
+    }, saved_bytes
+
+
+def export_curated_collection(
+    curated_xml_path,
+    source_root,
+    export_root,
+    workers=DEFAULT_EXPORT_WORKERS,
+    progress_callback=None,
+    cancel_event=None,
+    prune=False,
+    verify_hash=False,
+    strategy=DEFAULT_EXPORT_STRATEGY,
+    archive_format=None,
+    part_size=0,
+    dedup="off",
+    cache_db_path=None,
+    transcoder=None,
+    transcode_params=None,
+    transcode_jobs=1,
+):
     source_root = Path(source_root).resolve()
     export_root = Path(export_root).resolve()
 
-    tree = ET.parse(curated_xml_path)
+    export_plan = plan_curated_export(curated_xml_path, source_root, cache_db_path=cache_db_path)
+    tree = export_plan["tree"]
     root = tree.getroot()
+    references = export_plan["references"]
+    files = dict(export_plan["files"])
+    missing_files = export_plan["missing_files"]
 
     export_root.mkdir(parents=True, exist_ok=True)
 
-    files_to_copy = set()
-    missing_files = []
-    for game_elem in root.findall('game'):
-        for file_path in collect_game_file_paths(game_elem, source_root):
-            if file_path.exists() and file_path.is_file():
-                files_to_copy.add(file_path)
-            else:
-                missing_files.append(str(file_path))
-
-    copied_files = 0
-    for source_path in sorted(files_to_copy):
-        relative_path = source_path.relative_to(source_root)
-        destination_path = export_root / relative_path
-        destination_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(source_path, destination_path)
-        copied_files += 1
+    duplicates, dedup_saved_bytes = {}, 0
+    if dedup != "off":
+        duplicates, dedup_saved_bytes = apply_media_dedup(
+            references, files, str(source_root), workers, cache_db_path
+        )
+
+    # В архив ссылки положить нельзя, поэтому там дубликаты всегда заменяются ссылкой в XML
+    if duplicates and (dedup == "reference" or archive_format):
+        for child, relative_path in references:
+            canonical = duplicates.get(relative_path)
+            if canonical is not None:
+                child.text = "./" + canonical
+        for relative_path in duplicates:
+            files.pop(relative_path, None)
+
+    plan = build_copy_plan(source_root, export_root, files)
+    if archive_format:
+        result = export_curated_archive(
+            tree, plan, source_root, export_root, archive_format, part_size,
+            missing_files, progress_callback, cancel_event,
+        )
+        result["dedup_files"] = len(duplicates)
+        result["dedup_saved_bytes"] = dedup_saved_bytes
+        return result
+
+    for entry in plan["entries"]:
+        canonical = duplicates.get(entry["relative"])
+        if canonical is not None:
+            entry["link_to"] = os.path.join(str(export_root), canonical.replace('/', os.sep))
+        elif transcoder and entry["relative"].lower().endswith(".mp4"):
+            # Видео кодируется из исходной коллекции прямо в экспорт, оригинал туда не пишется
+            entry["transcode"] = transcode_params
+
+    copy_result = run_copy_plan(
+        plan,
+        export_root,
+        workers,
+        progress_callback,
+        cancel_event,
+        prune=prune,
+        verify_hash=verify_hash,
+        strategy=strategy,
+        transcoder=transcoder,
+        transcode_jobs=transcode_jobs,
+    )
 
     export_xml_path = export_root / 'gamelist.xml'
-    tree.write(export_xml_path, encoding='utf-8', xml_declaration=True)
+    if not copy_result["cancelled"]:
+        tree.write(export_xml_path, encoding='utf-8', xml_declaration=True)
 
     return {
         "games_count": len(root.findall('game')),
-        "copied_files": copied_files,
+        "copied_files": copy_result["copied_files"],
+        "transcoded_files": copy_result["transcoded_files"],
+        "skipped_files": copy_result["skipped_files"],
+        "linked_files": copy_result["linked_files"],
+        "removed_files": copy_result["removed_files"],
+        "removed_bytes": copy_result["removed_bytes"],
+        "failed_files": copy_result["failed_files"],
+        "transfer_methods": copy_result["transfer_methods"],
+        "copied_bytes": copy_result["copied_bytes"],
+        "elapsed_seconds": copy_result["elapsed_seconds"],
+        "cancelled": copy_result["cancelled"],
         "missing_files": missing_files,
+        "dedup_files": len(duplicates),
+        "dedup_saved_bytes": dedup_saved_bytes,
         "export_xml_path": str(export_xml_path),
     }
+
+
+def export_curated_archive(
+    tree,
+    plan,
+    source_root,
+    export_root,
+    archive_format,
+    part_size,
+    missing_files,
+    progress_callback=None,
+    cancel_event=None,
+):
+    xml_data = ET.tostring(tree.getroot(), encoding='utf-8', xml_declaration=True)
+    archive_result = run_archive_plan(
+        plan,
+        str(export_root / source_root.name),
+        archive_format,
+        part_size,
+        extra_files=[('gamelist.xml', xml_data)],
+        progress_callback=progress_callback,
+        cancel_event=cancel_event,
+    )
+
+    return {
+        "games_count": len(tree.getroot().findall('game')),
+        "copied_files": archive_result["archived_files"],
+        "transcoded_files": 0,
+        "skipped_files": 0,
+        "linked_files": 0,
+        "removed_files": 0,
+        "removed_bytes": 0,
+        "failed_files": [],
+        "transfer_methods": {archive_format: archive_result["archived_files"]},
+        "copied_bytes": archive_result["copied_bytes"],
+        "elapsed_seconds": archive_result["elapsed_seconds"],
+        "cancelled": archive_result["cancelled"],
+        "missing_files": missing_files,
+        "archive_paths": archive_result["archive_paths"],
+        "export_xml_path": ", ".join(archive_result["archive_paths"]),
+    }
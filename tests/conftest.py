@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули приложения лежат плоско в game_list_manager и импортируют друг друга по имени
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "game_list_manager"))
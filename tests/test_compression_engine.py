@@ -0,0 +1,276 @@
+import os
+import threading
+import time
+
+import pytest
+
+import compression_engine
+from compression_engine import (
+    EncodeScheduler,
+    SwapJournal,
+    compression_params,
+    decide_compression,
+    encoder_layout,
+    recover_interrupted_swaps,
+)
+
+
+def test_encoder_layout_uses_free_cores():
+    assert encoder_layout(0, 8, 0.0) == (4, 2)
+    assert encoder_layout(0, 8, 6.0) == (2, 1)
+    assert encoder_layout(1, 8, 0.0) == (1, 4)
+
+
+def test_scheduler_runs_jobs_in_parallel(monkeypatch):
+    monkeypatch.setattr(compression_engine, "current_system_load", lambda: 2.0)
+    monkeypatch.setattr(compression_engine, "LOAD_CHECK_INTERVAL", 0.01)
+    lock = threading.Lock()
+    active = []
+    peak = [0]
+
+    def run_task(item, threads):
+        with lock:
+            active.append(item)
+            peak[0] = max(peak[0], len(active))
+        time.sleep(item * 0.01)
+        with lock:
+            active.remove(item)
+        if item == 3:
+            raise RuntimeError("ffmpeg failed")
+        return {"frames": item, "input_bytes": 10, "output_bytes": 5}
+
+    events = []
+    scheduler = EncodeScheduler(
+        [1, 5, 2, 8, 3, 4], run_task, weight=lambda item: item, event_callback=events.append,
+    )
+    scheduler.cpu_count = 8
+    stats = scheduler.run()
+
+    assert peak[0] > 1
+    assert stats["completed"] == 5
+    assert scheduler.failed == [(3, "ffmpeg failed")]
+    assert scheduler.frames == 1 + 5 + 2 + 8 + 4
+    assert stats["output_bytes"] == 25
+    # Длинные задачи стартуют первыми
+    assert [event[1] for event in events if event[0] == "start"][:2] == [8, 5]
+
+
+def test_scheduler_stops_starting_jobs_after_cancel(monkeypatch):
+    monkeypatch.setattr(compression_engine, "current_system_load", lambda: None)
+    cancel_event = threading.Event()
+    started = []
+
+    def run_task(item, threads):
+        started.append(item)
+        cancel_event.set()
+        return {}
+
+    scheduler = EncodeScheduler(range(20), run_task, max_jobs=1, cancel_event=cancel_event)
+    scheduler.cpu_count = 8
+    scheduler.run()
+    assert started == [0]
+
+
+def start_swap(tmp_path):
+    target = tmp_path / "game.mp4"
+    backup = tmp_path / "backup" / "game.mp4"
+    temp = tmp_path / "game.mp4.1234.temp.mp4"
+    backup.parent.mkdir()
+    target.write_bytes(b"original")
+    journal = SwapJournal(str(tmp_path))
+    journal.begin(str(target), str(backup), str(temp), True)
+    os.rename(target, backup)
+    return journal, target, backup, temp
+
+
+def journal_path(tmp_path):
+    return tmp_path / compression_engine.COMPRESS_SWAP_JOURNAL_FILENAME
+
+
+def test_recover_restores_original_before_replace(tmp_path):
+    journal, target, backup, temp = start_swap(tmp_path)
+    temp.write_bytes(b"half-encoded")
+    journal._file.close()
+
+    assert recover_interrupted_swaps(str(tmp_path)) == (1, set())
+    assert target.read_bytes() == b"original"
+    assert not backup.exists()
+    assert not temp.exists()
+    assert not journal_path(tmp_path).exists()
+
+
+def test_recover_keeps_result_after_replace(tmp_path):
+    journal, target, backup, temp = start_swap(tmp_path)
+    temp.write_bytes(b"compressed")
+    os.replace(temp, target)
+    journal._file.close()
+
+    assert recover_interrupted_swaps(str(tmp_path)) == (0, {str(target)})
+    assert target.read_bytes() == b"compressed"
+    assert backup.read_bytes() == b"original"
+    assert not journal_path(tmp_path).exists()
+
+
+def test_recover_reports_committed_swaps(tmp_path):
+    journal, target, backup, temp = start_swap(tmp_path)
+    temp.write_bytes(b"compressed")
+    os.replace(temp, target)
+    journal.end(str(target), "commit")
+    journal._file.close()
+
+    assert recover_interrupted_swaps(str(tmp_path)) == (0, {str(target)})
+    assert target.read_bytes() == b"compressed"
+
+
+def test_recover_ignores_rolled_back_swaps(tmp_path):
+    journal, target, backup, temp = start_swap(tmp_path)
+    os.rename(backup, target)
+    journal.end(str(target), "rollback")
+    journal._file.close()
+
+    assert recover_interrupted_swaps(str(tmp_path)) == (0, set())
+    assert target.read_bytes() == b"original"
+    assert not journal_path(tmp_path).exists()
+
+
+def test_closed_journal_leaves_nothing_to_recover(tmp_path):
+    journal, target, backup, temp = start_swap(tmp_path)
+    os.rename(backup, target)
+    journal.end(str(target), "rollback")
+    journal.close()
+
+    assert not journal_path(tmp_path).exists()
+    assert recover_interrupted_swaps(str(tmp_path)) == (0, set())
+
+
+def make_probe(duration=20.0, width=640, height=480, codec="h264", video_bitrate=4_000_000):
+    return {
+        "duration": duration,
+        "width": width,
+        "height": height,
+        "frame_rate": 30.0,
+        "video_codec": codec,
+        "video_bitrate": video_bitrate,
+        "audio_bitrate": 128_000,
+    }
+
+
+def budget_videos():
+    return [
+        {"name": f"{index}.mp4", "size": size, "probe": make_probe(duration=duration)}
+        for index, (size, duration) in enumerate([(10_000_000, 20.0), (5_000_000, 8.0), (30_000_000, 60.0)])
+    ] + [{"name": "broken.mp4", "size": 1_000_000, "probe": None}]
+
+
+def test_budget_ladder_starts_from_requested_settings():
+    params = compression_params(0.75, 27, 10)
+    ladder = compression_engine.budget_ladder(params)
+    assert ladder[0] == params
+    weights = [candidate["scale"] ** 2 * 2 ** (-candidate["crf"] / 6) for candidate in ladder]
+    assert weights == sorted(weights, reverse=True)
+    assert all(27 <= candidate["crf"] <= compression_engine.MAX_BUDGET_CRF for candidate in ladder)
+
+
+def test_plan_budget_keeps_settings_when_budget_is_met():
+    params = compression_params(0.75, 27, 10)
+    videos = budget_videos()
+    baseline = sum(decide_compression(video["probe"], video["size"], params)["expected_bytes"] for video in videos)
+
+    assignments, total = compression_engine.plan_budget(videos, baseline, params)
+
+    assert total == baseline
+    assert [file_params for file_params, _ in assignments] == [params] * len(videos)
+
+
+def test_plan_budget_greedy_plan_fits_budget():
+    params = compression_params(0.75, 23, 10)
+    videos = budget_videos()
+    baseline = compression_engine.plan_budget(videos, float("inf"), params)[1]
+    smallest = compression_engine.plan_budget(videos, 0, params)[1]
+    budget = (baseline + smallest) // 2
+
+    assignments, total = compression_engine.plan_budget(videos, budget, params)
+
+    assert smallest < total <= budget
+    assert total == sum(decision["expected_bytes"] for _, decision in assignments)
+    # Файл без ffprobe нечем пересчитать: он остаётся как есть
+    assert assignments[-1] == (params, {"action": "encode", "expected_bytes": 1_000_000})
+
+
+def test_plan_budget_stops_at_smallest_settings():
+    params = compression_params(0.75, 23, 10)
+    videos = budget_videos()[:1]
+    assignments, total = compression_engine.plan_budget(videos, 1, params)
+    ladder_end = compression_engine.budget_ladder(params)[-1]
+    assert total > 1
+    assert assignments[0][0]["crf"] == ladder_end["crf"]
+
+
+def test_size_model_falls_back_without_enough_samples():
+    probe = make_probe()
+    params = compression_params(1.0, 23, 10)
+    # Без проб - грубая модель x264
+    assert compression_engine.SizeModel().fit().bits_per_pixel(probe, 10_000_000, 29) == (
+        compression_engine.bits_per_pixel(29)
+    )
+
+    # Одна проба: уровень из неё, наклон по умолчанию (вдвое меньше на каждые +6 CRF)
+    size_model = compression_engine.SizeModel()
+    size_model.add_sample(probe, 10_000_000, params, output_bytes=300_000, seconds=3)
+    size_model.fit()
+    at_23 = size_model.bits_per_pixel(probe, 10_000_000, 23)
+    assert at_23 != compression_engine.bits_per_pixel(23)
+    assert size_model.bits_per_pixel(probe, 10_000_000, 29) == pytest.approx(at_23 / 2)
+
+
+@pytest.mark.parametrize("probe, size, action, expected_bytes", [
+    # ffprobe не смог прочитать файл: кодируем, размер неизвестен
+    (None, 5_000_000, "encode", 5_000_000),
+    (make_probe(duration=0.0), 5_000_000, "encode", 5_000_000),
+    # Уже маленький и короткий: перекодирование не сэкономит
+    (make_probe(duration=8.0, video_bitrate=None), 100_000, "skip", 100_000),
+    # Маленький, но длинный: режем без перекодирования, если кодек позволяет
+    (make_probe(duration=30.0, video_bitrate=None), 300_000, "copy", 100_000),
+    (make_probe(duration=30.0, codec="mpeg4", video_bitrate=None), 300_000, "encode", 100_000),
+    (make_probe(duration=8.0), 10_000_000, "encode", None),
+])
+def test_decide_compression(probe, size, action, expected_bytes):
+    params = compression_params(0.75, 27, 10)
+    decision = decide_compression(probe, size, params)
+    assert decision["action"] == action
+    if expected_bytes is None:
+        expected_bytes = compression_engine.estimate_encoded_bytes(probe, params)
+    assert decision["expected_bytes"] == expected_bytes
+
+
+@pytest.mark.parametrize("probe, max_duration, action, expected_bytes", [
+    # Подходящий h264: короче лимита - не трогаем, длиннее - только обрезаем
+    (make_probe(duration=8.0, video_bitrate=500_000), 10, "skip", 1_000_000),
+    (make_probe(duration=40.0, video_bitrate=500_000), 10, "copy", 250_000),
+    (make_probe(duration=40.0, video_bitrate=500_000), 60, "skip", 1_000_000),
+    # Неподходящий кодек или завышенный битрейт перекодируются даже в этом режиме
+    (make_probe(duration=40.0, codec="hevc", video_bitrate=500_000), 10, "encode", None),
+    (make_probe(duration=8.0, video_bitrate=5_000_000), 10, "encode", None),
+])
+def test_decide_compression_trim_only(probe, max_duration, action, expected_bytes):
+    params = compression_params(0.75, 27, max_duration, trim_only=True)
+    decision = decide_compression(probe, 1_000_000, params)
+    assert decision["action"] == action
+    if expected_bytes is not None:
+        assert decision["expected_bytes"] == expected_bytes
+    else:
+        kept_bytes = int(1_000_000 * min(1.0, max_duration / probe["duration"]))
+        assert decision["expected_bytes"] == min(compression_engine.estimate_encoded_bytes(probe, params), kept_bytes)
+
+
+@pytest.mark.parametrize("codec, video_bitrate, acceptable", [
+    ("h264", 900_000, True),
+    ("h264", 1_000_000, False),
+    ("hevc", 100_000, False),
+    # Битрейт потока не указан: оценивается по размеру файла за вычетом звука
+    ("h264", None, True),
+])
+def test_is_acceptable_source(codec, video_bitrate, acceptable):
+    probe = make_probe(duration=8.0, codec=codec, video_bitrate=video_bitrate)
+    params = compression_params(0.75, 27, 10)
+    assert compression_engine.is_acceptable_source(probe, 800_000, params) is acceptable
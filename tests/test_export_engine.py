@@ -0,0 +1,320 @@
+import errno
+import json
+import os
+import threading
+
+import pytest
+
+import export_engine
+from export_engine import CopyProgress, FileTransfer
+
+
+def make_source(tmp_path, name="game.zip", size=4096):
+    source = tmp_path / "src" / name
+    source.parent.mkdir(exist_ok=True)
+    source.write_bytes(os.urandom(size))
+    destination_dir = tmp_path / "dst"
+    destination_dir.mkdir(exist_ok=True)
+    return str(source), str(destination_dir / name)
+
+
+def fake_methods(monkeypatch, failures):
+    calls = []
+
+    def make(method):
+        def transfer(source_path, destination_path, progress, cancel_event):
+            calls.append(method)
+            if method in failures:
+                raise OSError(failures[method], f"{method} failed")
+            export_engine.copy_file_chunked(source_path, destination_path, progress, cancel_event)
+        return transfer
+
+    monkeypatch.setattr(
+        export_engine, "TRANSFER_METHODS",
+        {method: make(method) for method in ("reflink", "hardlink", "copy_file_range", "copy")},
+    )
+    return calls
+
+
+def test_unsupported_methods_fall_back_and_are_remembered(tmp_path, monkeypatch):
+    calls = fake_methods(monkeypatch, {"reflink": errno.EOPNOTSUPP})
+    file_transfer = FileTransfer("auto")
+    progress = CopyProgress(2, 8192)
+
+    source, destination = make_source(tmp_path, "a.zip")
+    assert file_transfer.transfer(source, destination, progress, threading.Event()) == "copy_file_range"
+    source, destination = make_source(tmp_path, "b.zip")
+    assert file_transfer.transfer(source, destination, progress, threading.Event()) == "copy_file_range"
+
+    # Неподдерживаемые способы пробуются только для первого файла пары устройств
+    assert calls == ["reflink", "copy_file_range", "copy_file_range"]
+    assert file_transfer.method_counts == {"copy_file_range": 2}
+    assert progress.snapshot()["done_bytes"] == 8192
+
+
+def test_auto_strategy_never_hardlinks():
+    # Жёсткая ссылка связала бы экспорт с оригиналами коллекции
+    assert FileTransfer("auto").candidate_methods(True) == ["reflink", "copy_file_range", "copy"]
+    assert FileTransfer("auto").candidate_methods(False) == ["copy_file_range", "copy"]
+    assert FileTransfer("hardlink").candidate_methods(True) == ["hardlink", "copy"]
+
+
+def test_real_errors_are_not_hidden_by_fallback(tmp_path, monkeypatch):
+    calls = fake_methods(monkeypatch, {"copy_file_range": errno.ENOSPC})
+    source, destination = make_source(tmp_path)
+    with pytest.raises(OSError) as error:
+        FileTransfer("copy_file_range").transfer(source, destination, CopyProgress(1, 4096), threading.Event())
+    assert error.value.errno == errno.ENOSPC
+    assert calls == ["copy_file_range"]
+
+
+def test_explicit_strategy_falls_back_to_copy(tmp_path, monkeypatch):
+    calls = fake_methods(monkeypatch, {"reflink": errno.ENOTTY})
+    source, destination = make_source(tmp_path)
+    method = FileTransfer("reflink").transfer(source, destination, CopyProgress(1, 4096), threading.Event())
+    assert method == "copy"
+    assert calls == ["reflink", "copy"]
+    with open(source, "rb") as src, open(destination, "rb") as dst:
+        assert src.read() == dst.read()
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        FileTransfer("teleport")
+
+
+def test_hardlinked_bytes_do_not_count_as_throughput(tmp_path):
+    source, destination = make_source(tmp_path)
+    progress = CopyProgress(1, 4096)
+    export_engine.hardlink_file(source, destination, progress, threading.Event())
+
+    snapshot = progress.snapshot()
+    assert os.path.samefile(source, destination)
+    assert snapshot["done_bytes"] == 4096
+    assert snapshot["linked_bytes"] == 4096
+    assert snapshot["bytes_per_second"] == 0
+
+
+def archive_entries(*sizes):
+    return [{"relative": f"roms/{index}.zip", "size": size} for index, size in enumerate(sizes)]
+
+
+def test_split_archive_parts_without_limit_is_one_part():
+    entries = archive_entries(10, 20, 30)
+    assert export_engine.split_archive_parts(entries, 0) == [entries]
+
+
+def test_split_archive_parts_respects_part_size():
+    overhead = export_engine.ARCHIVE_ENTRY_OVERHEAD
+    part_size = 100 + 2 * overhead
+    entries = archive_entries(60, 40, 30, 70, 10)
+    parts = export_engine.split_archive_parts(entries, part_size)
+
+    assert [[entry["size"] for entry in part] for part in parts] == [[60, 40], [30, 70], [10]]
+    assert [entry for part in parts for entry in part] == entries
+    for part in parts:
+        assert sum(entry["size"] + overhead for entry in part) <= part_size
+
+
+def test_split_archive_parts_keeps_oversized_file_alone():
+    parts = export_engine.split_archive_parts(archive_entries(10, 500, 10), 100)
+    assert [[entry["size"] for entry in part] for part in parts] == [[10], [500], [10]]
+
+
+def plan_entry(tmp_path, relative, size=100, mtime=1_600_000_000):
+    source = tmp_path / "src" / relative
+    destination = tmp_path / "dst" / relative
+    source.parent.mkdir(parents=True, exist_ok=True)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    source.write_bytes(b"s" * size)
+    os.utime(source, (mtime, mtime))
+    return {
+        "source": str(source),
+        "destination": str(destination),
+        "relative": relative,
+        "size": size,
+        "mtime": mtime,
+    }
+
+
+def write_destination(entry, size, mtime):
+    with open(entry["destination"], "wb") as f:
+        f.write(b"d" * size)
+    os.utime(entry["destination"], (mtime, mtime))
+
+
+@pytest.mark.parametrize("destination, manifest, verify_hash, action", [
+    (None, {}, False, "copy"),
+    ((100, 1_600_000_000), {}, False, "skip"),
+    ((100, 1_500_000_000), {}, False, "copy"),
+    ((100, 1_500_000_000), {}, True, "verify"),
+    ((50, 1_600_000_000), {}, True, "copy"),
+    # Записан в манифест из того же исходника, а в экспорте потом пережат
+    ((50, 1_500_000_000), {"size": 100, "mtime": 1_600_000_000}, False, "skip"),
+    ((50, 1_500_000_000), {"size": 100, "mtime": 1_599_999_999}, False, "copy"),
+    ((50, 1_500_000_000), {"size": 100, "mtime": 1_600_000_000, "transcode": {"crf": 27}}, False, "copy"),
+])
+def test_classify_entry(tmp_path, destination, manifest, verify_hash, action):
+    entry = plan_entry(tmp_path, "roms/game.zip")
+    if destination is not None:
+        write_destination(entry, *destination)
+    manifest_files = {"roms/game.zip": manifest} if manifest else {}
+    assert export_engine.classify_entry(entry, manifest_files, verify_hash) == action
+
+
+def test_prune_removes_only_manifest_orphans(tmp_path):
+    export_root = tmp_path / "export"
+    (export_root / "roms" / "old").mkdir(parents=True)
+    (export_root / "roms" / "old" / "gone.zip").write_bytes(b"x" * 10)
+    (export_root / "roms" / "kept.zip").write_bytes(b"k")
+    (export_root / "roms" / "foreign.zip").write_bytes(b"f")
+    (tmp_path / "outside.zip").write_bytes(b"o")
+    manifest_files = {
+        "roms/old/gone.zip": {"size": 10, "mtime": 1},
+        "roms/kept.zip": {"size": 1, "mtime": 1},
+        "roms/missing.zip": {"size": 5, "mtime": 1},
+        "../outside.zip": {"size": 1, "mtime": 1},
+        str(tmp_path / "outside.zip"): {"size": 1, "mtime": 1},
+    }
+
+    removed = export_engine.prune_orphaned_files(str(export_root), manifest_files, {"roms/kept.zip"})
+
+    assert removed == (1, 10)
+    assert not (export_root / "roms" / "old").exists()
+    assert (export_root / "roms" / "kept.zip").exists()
+    assert (export_root / "roms" / "foreign.zip").exists()
+    assert (tmp_path / "outside.zip").exists()
+    assert set(manifest_files) == {"roms/kept.zip"}
+
+
+def test_interrupted_export_resumes_from_journal(tmp_path):
+    done = plan_entry(tmp_path, "roms/done.zip", size=300)
+    todo = plan_entry(tmp_path, "roms/todo.zip", size=200)
+    export_root = tmp_path / "dst"
+    # Прошлый запуск успел скопировать один файл и оборвался посреди следующей записи
+    write_destination(done, 300, 1_500_000_000)
+    with open(export_root / export_engine.EXPORT_JOURNAL_FILENAME, "w", encoding="utf-8") as journal:
+        journal.write(json.dumps({"relative": "roms/done.zip", "size": 300, "mtime": 1_600_000_000}) + "\n")
+        journal.write('{"relative": "roms/todo.zip", "si')
+
+    plan = {"entries": [done, todo], "total_bytes": 500}
+    result = export_engine.run_copy_plan(plan, str(export_root), workers=2, strategy="copy")
+
+    assert result["skipped_files"] == 1
+    assert result["copied_files"] == 1
+    assert result["copied_bytes"] == 200
+    assert not (export_root / export_engine.EXPORT_JOURNAL_FILENAME).exists()
+    manifest = export_engine.load_export_manifest(str(export_root))
+    assert manifest == {
+        "roms/done.zip": {"size": 300, "mtime": 1_600_000_000},
+        "roms/todo.zip": {"size": 200, "mtime": 1_600_000_000},
+    }
+
+
+def write_files(tmp_path, contents, mtime=1_600_000_000):
+    files = {}
+    for name, data in contents.items():
+        path = tmp_path / name
+        path.write_bytes(data)
+        os.utime(path, (mtime, mtime))
+        files[str(path)] = (len(data), mtime)
+    return files
+
+
+def test_same_size_files_with_different_content_are_not_merged(tmp_path):
+    files = write_files(tmp_path, {"a.png": b"aaaa", "b.png": b"bbbb", "c.png": b"aaaa", "d.png": b"xyz"})
+
+    duplicates, saved_bytes = export_engine.find_duplicate_files(files, workers=2)
+
+    assert duplicates == {str(tmp_path / "c.png"): str(tmp_path / "a.png")}
+    assert saved_bytes == 4
+
+
+def test_hash_cache_is_invalidated_by_mtime(tmp_path, monkeypatch):
+    cache_db_path = str(tmp_path / "cache.sqlite")
+    hashed = []
+    file_digest = export_engine.file_digest
+    monkeypatch.setattr(export_engine, "file_digest", lambda path: hashed.append(path) or file_digest(path))
+    files = write_files(tmp_path, {"a.png": b"aaaa", "b.png": b"aaaa"})
+
+    assert len(export_engine.find_duplicate_files(files, 2, cache_db_path)[0]) == 1
+    assert len(hashed) == 2
+    hashed.clear()
+    assert len(export_engine.find_duplicate_files(files, 2, cache_db_path)[0]) == 1
+    assert hashed == []
+
+    # Тот же размер, другое содержимое: по новому mtime хэш считается заново
+    files.update(write_files(tmp_path, {"b.png": b"bbbb"}, mtime=1_600_000_100))
+    assert export_engine.find_duplicate_files(files, 2, cache_db_path)[0] == {}
+    assert hashed == [str(tmp_path / "b.png")]
+
+
+def archive_plan(tmp_path, count=4, size=1000):
+    entries = []
+    for index in range(count):
+        source = tmp_path / "src" / f"{index}.zip"
+        source.parent.mkdir(exist_ok=True)
+        source.write_bytes(os.urandom(size))
+        entries.append({"source": str(source), "relative": f"roms/{index}.zip", "size": size})
+    return {"entries": entries, "total_bytes": count * size}
+
+
+def test_cancelled_archive_removes_finished_parts(tmp_path, monkeypatch):
+    plan = archive_plan(tmp_path)
+    cancel_event = threading.Event()
+    finish_file = export_engine.CopyProgress.finish_file
+
+    def cancel_after_second_file(progress):
+        finish_file(progress)
+        # Две части уже готовы, отмена приходит на третьей
+        if progress.done_files == 2:
+            cancel_event.set()
+
+    monkeypatch.setattr(export_engine.CopyProgress, "finish_file", cancel_after_second_file)
+    result = export_engine.run_archive_plan(
+        plan, str(tmp_path / "out" / "arcade"), "zip", part_size=1600, cancel_event=cancel_event
+    )
+
+    assert result["cancelled"]
+    assert result["archive_paths"] == []
+    assert os.listdir(tmp_path / "out") == []
+
+
+def test_archive_parts_are_written_in_full(tmp_path):
+    plan = archive_plan(tmp_path)
+    result = export_engine.run_archive_plan(
+        plan, str(tmp_path / "out" / "arcade"), "tar", part_size=1600, extra_files=[("gamelist.xml", b"<gameList/>")]
+    )
+
+    assert not result["cancelled"]
+    assert [os.path.basename(path) for path in result["archive_paths"]] == [
+        f"arcade.part{index:02d}.tar" for index in range(1, 5)
+    ]
+    assert result["archived_files"] == 4
+    assert sorted(os.listdir(tmp_path / "out")) == [os.path.basename(path) for path in result["archive_paths"]]
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="copy_file_range is not available")
+def test_partial_copy_file_range_is_not_counted_twice(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_engine, "COPY_FILE_RANGE_CHUNK", 1024)
+    copy_file_range = os.copy_file_range
+    calls = [0]
+
+    def failing_copy_file_range(*args):
+        calls[0] += 1
+        if calls[0] == 3:
+            raise OSError(errno.EXDEV, "cross-device copy")
+        return copy_file_range(*args)
+
+    monkeypatch.setattr(export_engine.os, "copy_file_range", failing_copy_file_range)
+    source, destination = make_source(tmp_path, size=4096)
+    progress = CopyProgress(1, 4096)
+
+    method = FileTransfer("copy_file_range").transfer(source, destination, progress, threading.Event())
+
+    assert method == "copy"
+    snapshot = progress.snapshot()
+    assert snapshot["done_bytes"] == 4096
+    assert progress.copied_bytes == 4096
+    with open(source, "rb") as src, open(destination, "rb") as dst:
+        assert src.read() == dst.read()
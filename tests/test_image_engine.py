@@ -0,0 +1,82 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import image_engine
+from image_engine import image_params, optimize_image, run_image_optimization
+
+
+def write_image(path, size=(800, 600), mode="RGB", color=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if color is None:
+        image = Image.new(mode, size)
+        image.putdata([(x * 7 % 256, y * 5 % 256, (x + y) % 256) + ((255,) if mode == "RGBA" else ())
+                       for y in range(size[1]) for x in range(size[0])])
+    else:
+        image = Image.new(mode, size, color)
+    image.save(path)
+    return path
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".tmp")]
+
+
+def test_resized_image_is_written_via_temp_file(tmp_path, monkeypatch):
+    source = write_image(tmp_path / "a.png")
+    replaced = []
+    replace = os.replace
+    monkeypatch.setattr(image_engine.os, "replace", lambda src, dst: replaced.append((src, dst)) or replace(src, dst))
+
+    stats = optimize_image(str(source), image_params(320, "keep", 85))
+
+    assert stats["output"] == str(source)
+    assert len(replaced) == 1
+    assert replaced[0][0].startswith(str(source) + ".") and replaced[0][0].endswith(".tmp")
+    assert replaced[0][1] == str(source)
+    assert leftovers(tmp_path) == []
+    with Image.open(source) as image:
+        assert max(image.size) == 320
+
+
+def test_image_that_does_not_shrink_is_left_alone(tmp_path):
+    source = write_image(tmp_path / "a.png", size=(16, 16), color=(10, 20, 30))
+    Image.open(source).save(source, optimize=True)
+    original = source.read_bytes()
+
+    stats = optimize_image(str(source), image_params(640, "keep", 85))
+
+    assert stats == {"output": str(source), "input_bytes": len(original), "output_bytes": len(original)}
+    assert source.read_bytes() == original
+    assert leftovers(tmp_path) == []
+
+
+def test_converted_png_renames_xml_references(tmp_path):
+    images = tmp_path / "media" / "images"
+    write_image(images / "a.png")
+    write_image(images / "alpha.png", size=(64, 64), mode="RGBA")
+    (tmp_path / "gamelist.xml").write_text(
+        "<gameList>"
+        "<game><path>./a.zip</path><image>./media/images/a.png</image></game>"
+        "<game><path>./b.zip</path><image>./media/images/alpha.png</image></game>"
+        "</gameList>",
+        encoding="utf-8",
+    )
+
+    result = run_image_optimization(str(tmp_path), image_params(320, "jpeg", 80), workers=1)
+
+    assert result["done_files"] == 2
+    assert result["renamed_references"] == 1
+    assert (images / "a.jpg").exists() and not (images / "a.png").exists()
+    # Прозрачность в JPEG не сохранить: такой файл остаётся PNG
+    assert (images / "alpha.png").exists()
+    references = [game.findtext("image") for game in ET.parse(tmp_path / "gamelist.xml").getroot()]
+    assert references == ["./media/images/a.jpg", "./media/images/alpha.png"]
+
+    # Повторный запуск с теми же настройками ничего не пережимает
+    again = run_image_optimization(str(tmp_path), image_params(320, "jpeg", 80), workers=1)
+    assert again["done_files"] == 0
+    assert again["skipped_files"] == 2
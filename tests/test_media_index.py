@@ -0,0 +1,65 @@
+import os
+
+import db_cache
+from media_index import scan_collection, stat_skipped_reference
+from xml_handler import FILE_REFERENCE_TAGS, plan_curated_export
+
+
+GAMELIST = """<?xml version="1.0"?>
+<gameList>
+  <game>
+    <path>./game.zip</path>
+    <video>./videos/backup/game.mp4</video>
+    <image>./checked/game.png</image>
+    <marquee>./media/missing.png</marquee>
+  </game>
+</gameList>
+"""
+
+
+def make_collection(tmp_path):
+    for relative, data in {
+        "game.zip": b"rom",
+        "videos/backup/game.mp4": b"video",
+        "checked/game.png": b"image",
+    }.items():
+        path = tmp_path / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    xml_path = tmp_path / "gamelist.xml"
+    xml_path.write_text(GAMELIST, encoding="utf-8")
+    return str(xml_path)
+
+
+def test_scan_skips_backup_and_checked_directories(tmp_path):
+    make_collection(tmp_path)
+    assert {relative for relative, _, _ in scan_collection(str(tmp_path)).values()} == {"game.zip", "gamelist.xml"}
+
+
+def test_referenced_files_in_skipped_directories_are_found(tmp_path):
+    xml_path = make_collection(tmp_path)
+    plan = plan_curated_export(xml_path, str(tmp_path))
+    assert set(plan["files"]) == {"game.zip", "videos/backup/game.mp4", "checked/game.png"}
+    assert plan["missing_files"] == [os.path.join(str(tmp_path), "media", "missing.png")]
+    assert stat_skipped_reference(str(tmp_path), "media/missing.png") is None
+
+
+def test_media_inventory_marks_skipped_references_present(tmp_path):
+    xml_path = make_collection(tmp_path)
+    db_path = str(tmp_path / "cache.sqlite")
+    db_cache.rebuild_cache(xml_path, db_path, os.path.join(os.path.dirname(db_cache.__file__), "pS_CatVer_287"))
+    db_cache.refresh_media_inventory(db_path, str(tmp_path), FILE_REFERENCE_TAGS)
+
+    conn = db_cache.get_connection(db_path)
+    try:
+        media = {row["tag"]: dict(row) for row in conn.execute("SELECT * FROM media_files WHERE db_id = 1")}
+    finally:
+        conn.close()
+    assert media["video"]["exists_flag"] == 1
+    assert media["video"]["size"] == 5
+    assert media["image"]["exists_flag"] == 1
+    assert media["marquee"]["exists_flag"] == 0
+
+    presence = db_cache.load_media_presence(db_path)
+    assert {"game.zip", "videos/backup/game.mp4", "checked/game.png"} <= presence
+    assert "media/missing.png" not in presence
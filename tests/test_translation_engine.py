@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+import translation_engine
+from translation_engine import (
+    TranslationBackend,
+    TranslationEngine,
+    format_batch,
+    pack_batches,
+    parse_batch,
+)
+
+
+class ScriptedBackend(TranslationBackend):
+    """Переводит в верхний регистр; mangle(text) может испортить ответ на пакет."""
+
+    max_chars = 200
+
+    def __init__(self, mangle=None):
+        self.mangle = mangle
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def translate(self, text, src, dest):
+        with self._lock:
+            self.requests.append(text)
+        translated = text.upper()
+        return self.mangle(translated) if self.mangle else translated
+
+
+def make_engine(backend):
+    return TranslationEngine(backend, workers=3, requests_per_second=1000, burst=1000, retries=0)
+
+
+def run(engine, items):
+    results = {}
+    engine.run_batched(items, lambda key, translated, error: results.__setitem__(key, (translated, error)))
+    return results
+
+
+def test_pack_batches_fills_batches_up_to_the_limit():
+    items = [(index, "x" * length) for index, length in enumerate([90, 80, 60, 50, 40, 30, 20, 10, 10, 5])]
+    batches = pack_batches(items, 100, max_items=3)
+
+    marker_cost = len(translation_engine.batch_marker(3)) + 2
+    assert sorted(key for batch in batches for key, _ in batch) == list(range(10))
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or sum(len(text) + marker_cost for _, text in batch) <= 100
+    assert len(batches) == 6
+
+
+def test_pack_batches_sends_oversized_text_alone():
+    batches = pack_batches([("big", "x" * 500), ("small", "y")], 100)
+    assert [("big", "x" * 500)] in batches
+
+
+def test_parse_batch_accepts_only_intact_markers():
+    batch = [("a", "one"), ("b", "two"), ("c", "three")]
+    assert parse_batch(batch, format_batch(batch).upper()) == {"a": "ONE", "b": "TWO", "c": "THREE"}
+    assert parse_batch(batch, "--- 0 ---\nONE\n-- 1 --\nTWO\n---2---\nTHREE") == {"a": "ONE", "b": "TWO", "c": "THREE"}
+    # Пропал маркер 1: его текст слился с нулевым, оба отвергаются
+    assert parse_batch(batch, "---0---\nONE\nTWO\n---2---\nTHREE") == {"c": "THREE"}
+    # Повтор и перестановка
+    assert parse_batch(batch, "---0---\nONE\n---0---\nTWO\n---2---\nTHREE") == {"c": "THREE"}
+    assert parse_batch(batch, "---1---\nTWO\n---0---\nONE\n---2---\nTHREE") == {"b": "TWO", "c": "THREE"}
+    # Чужой номер - разметка не заслуживает доверия
+    assert parse_batch(batch, "---0---\nONE\n---1---\nTWO\n---7---\nTHREE") == {}
+
+
+def test_only_failed_part_of_a_batch_is_resent():
+    def drop_second_marker(translated):
+        return translated.replace("---1---\n", "", 1) if translated.count("---") >= 6 else translated
+
+    backend = ScriptedBackend(drop_second_marker)
+    engine = make_engine(backend)
+    items = [(index, f"text {index}") for index in range(4)]
+    results = run(engine, items)
+
+    assert results == {index: (f"TEXT {index}", None) for index in range(4)}
+    # Первый запрос - весь пакет; повторно уходят только тексты 0 и 1, уже поодиночке
+    assert len(backend.requests) == 3
+    assert sorted(backend.requests[1:]) == ["text 0", "text 1"]
+    assert engine.throughput()["split_batches"] == 1
+
+
+def test_failed_batches_are_split_until_single_texts():
+    def fail_batches(translated):
+        if "---" in translated:
+            raise RuntimeError("429")
+        if translated == "TEXT 5":
+            raise RuntimeError("bad text")
+        return translated
+
+    backend = ScriptedBackend(fail_batches)
+    engine = make_engine(backend)
+    results = run(engine, [(index, f"text {index}") for index in range(8)])
+
+    assert {key for key, (_, error) in results.items() if error is not None} == {5}
+    assert all(results[index] == (f"TEXT {index}", None) for index in range(8) if index != 5)
+    assert sum(1 for text in backend.requests if "---" not in text) == 8
+
+
+def test_cancel_stops_resending(monkeypatch):
+    cancel_event = threading.Event()
+
+    def cancel_on_batch(translated):
+        cancel_event.set()
+        raise RuntimeError("down")
+
+    backend = ScriptedBackend(cancel_on_batch)
+    engine = make_engine(backend)
+    engine.run_batched([(index, f"text {index}") for index in range(4)], lambda *args: None, cancel_event)
+    assert len(backend.requests) == 1
+
+
+@pytest.mark.parametrize("text", ["", "   "])
+def test_empty_single_translation_is_a_failure(text):
+    assert parse_batch([("a", "source")], text) == {}
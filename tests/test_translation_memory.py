@@ -0,0 +1,70 @@
+import hashlib
+import sqlite3
+
+from translation_memory import (
+    MEMORY_SCHEMA_VERSION,
+    import_translation_memory,
+    lookup_translation,
+    lookup_translations,
+    store_translation,
+)
+
+
+def create_legacy_memory(path, pairs):
+    # Схема до нормализации: ключ - sha1 от сырого текста, user_version не задан
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """
+        CREATE TABLE translations (
+            source_hash TEXT NOT NULL,
+            src TEXT NOT NULL,
+            dest TEXT NOT NULL,
+            source_text TEXT NOT NULL,
+            translated_text TEXT NOT NULL,
+            PRIMARY KEY (source_hash, src, dest)
+        )
+        """
+    )
+    conn.executemany(
+        "INSERT INTO translations VALUES(?, 'en', 'ru', ?, ?)",
+        [(hashlib.sha1(text.encode("utf-8")).hexdigest(), text, translated) for text, translated in pairs],
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_memory_is_migrated_to_normalized_keys(tmp_path):
+    db_path = str(tmp_path / "translation_memory.sqlite")
+    create_legacy_memory(db_path, [("Shoot  the\naliens", "Стреляй"), ("Race cars", "Гонки")])
+
+    assert lookup_translation(db_path, "Shoot the aliens") == "Стреляй"
+    assert lookup_translation(db_path, " Race\tcars ") == "Гонки"
+
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == MEMORY_SCHEMA_VERSION
+        assert conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def test_migration_merges_texts_equal_after_normalization(tmp_path):
+    db_path = str(tmp_path / "translation_memory.sqlite")
+    create_legacy_memory(db_path, [("One  game", "Игра"), ("One game", "Игра 2")])
+
+    found = lookup_translations(db_path, ["One game", "One\ngame", "Other"])
+    assert set(found) == {"One game", "One\ngame"}
+    assert found["One game"] == found["One\ngame"]
+
+
+def test_import_keeps_shared_translations_and_runs_once(tmp_path):
+    shared_path = str(tmp_path / "translation_memory.sqlite")
+    collection_path = str(tmp_path / "checked" / "translation_memory.sqlite")
+    (tmp_path / "checked").mkdir()
+    create_legacy_memory(collection_path, [("Puzzle", "Старая головоломка"), ("Platformer", "Платформер")])
+    store_translation(shared_path, "Puzzle", "Головоломка")
+
+    assert import_translation_memory(shared_path, collection_path) == 2
+    assert import_translation_memory(shared_path, collection_path) == 0
+    assert lookup_translation(shared_path, "Puzzle") == "Головоломка"
+    assert lookup_translation(shared_path, "Platformer") == "Платформер"
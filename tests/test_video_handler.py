@@ -0,0 +1,173 @@
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+import video_handler
+from video_handler import (
+    FFmpegStalled,
+    PreviewProxyBuilder,
+    compress_video_file,
+    parse_ffmpeg_progress,
+    run_ffmpeg_with_progress,
+)
+
+
+def fake_transcoder(calls):
+    def transcode(source_path, output_path, *args, probe=None, stream_copy=False, **kwargs):
+        with open(source_path, "rb") as f:
+            source_data = f.read()
+        calls.append((source_data, probe, stream_copy))
+        with open(output_path, "wb") as f:
+            f.write(b"out:" + source_data)
+        return {"frames": 1, "output_bytes": os.path.getsize(output_path), "expected_duration": 1.0,
+                "stream_copy": stream_copy}
+    return transcode
+
+
+def make_video(tmp_path, data, backup_data=None):
+    video_path = tmp_path / "media" / "videos" / "game.mp4"
+    video_path.parent.mkdir(parents=True)
+    video_path.write_bytes(data)
+    if backup_data is not None:
+        (video_path.parent / "backup").mkdir()
+        (video_path.parent / "backup" / "game.mp4").write_bytes(backup_data)
+    return video_path
+
+
+def test_stale_backup_is_replaced_by_current_file(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(video_handler, "transcode_video", fake_transcoder(calls))
+    video_path = make_video(tmp_path, b"new original", backup_data=b"old original")
+    probe = {"duration": 5.0}
+
+    compress_video_file(str(video_path), 0.5, 27, 10, probe=probe, stream_copy=True)
+
+    assert calls == [(b"new original", probe, True)]
+    assert video_path.read_bytes() == b"out:new original"
+    assert (video_path.parent / "backup" / "game.mp4").read_bytes() == b"new original"
+
+
+def test_own_output_is_reencoded_from_backup(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(video_handler, "transcode_video", fake_transcoder(calls))
+    video_path = make_video(tmp_path, b"out:original", backup_data=b"original")
+
+    compress_video_file(str(video_path), 0.5, 27, 10, probe={"duration": 5.0}, stream_copy=True, own_output=True)
+
+    # Анализ относился к сжатому файлу, поэтому из оригинала кодируется заново
+    assert calls == [(b"original", None, False)]
+    assert video_path.read_bytes() == b"out:original"
+    assert (video_path.parent / "backup" / "game.mp4").read_bytes() == b"original"
+
+
+def test_failed_encode_restores_current_file(tmp_path, monkeypatch):
+    def failing_transcode(*args, **kwargs):
+        raise RuntimeError("ffmpeg failed")
+
+    monkeypatch.setattr(video_handler, "transcode_video", failing_transcode)
+    video_path = make_video(tmp_path, b"new original", backup_data=b"old original")
+
+    with pytest.raises(RuntimeError):
+        compress_video_file(str(video_path), 0.5, 27, 10)
+    assert video_path.read_bytes() == b"new original"
+
+
+PROGRESS_BLOCK = {
+    "frame": "150",
+    "fps": "60.0",
+    "total_size": "524288",
+    "out_time_us": "5000000",
+    "out_time_ms": "5000000",
+    "speed": "2.5x",
+    "progress": "continue",
+}
+
+
+@pytest.mark.parametrize("fields, expected", [
+    (PROGRESS_BLOCK, {"percent": 50.0, "speed": 2.5, "out_time": 5.0, "total_size": 524288}),
+    # Старые сборки пишут только out_time_ms, тоже в микросекундах
+    ({"out_time_ms": "2500000", "progress": "continue"}, {"percent": 25.0, "speed": 0.0, "out_time": 2.5, "total_size": 0}),
+    # В начале кодирования ffmpeg выводит N/A
+    ({"out_time_us": "N/A", "total_size": "N/A", "speed": "N/A", "progress": "continue"},
+     {"percent": 0.0, "speed": 0.0, "out_time": 0.0, "total_size": 0}),
+    (dict(PROGRESS_BLOCK, out_time_us="12000000"), {"percent": 99.9, "speed": 2.5, "out_time": 12.0, "total_size": 524288}),
+    (dict(PROGRESS_BLOCK, progress="end"), {"percent": 100.0, "speed": 2.5, "out_time": 5.0, "total_size": 524288}),
+])
+def test_parse_ffmpeg_progress(fields, expected):
+    assert parse_ffmpeg_progress(fields, 10.0) == expected
+
+
+def fake_ffmpeg(tmp_path, script):
+    path = tmp_path / "ffmpeg"
+    path.write_text("#!/bin/sh\n" + script, encoding="utf-8")
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+def progress_lines(**fields):
+    return "".join(f"echo '{key}={value}'\n" for key, value in dict(PROGRESS_BLOCK, **fields).items())
+
+
+posix_only = pytest.mark.skipif(os.name == "nt", reason="fake ffmpeg is a shell script")
+
+
+@posix_only
+def test_run_ffmpeg_streams_progress_until_end(tmp_path):
+    ffmpeg = fake_ffmpeg(tmp_path, progress_lines() + progress_lines(out_time_us="10000000", progress="end"))
+    snapshots = []
+
+    run_ffmpeg_with_progress([ffmpeg, "-i", "in.mp4", "out.mp4"], 10.0, snapshots.append)
+
+    assert [snapshot["percent"] for snapshot in snapshots] == [50.0, 100.0]
+
+
+@posix_only
+def test_run_ffmpeg_reports_stderr_on_failure(tmp_path):
+    ffmpeg = fake_ffmpeg(tmp_path, "echo 'Invalid data found' >&2\nexit 1\n")
+    with pytest.raises(Exception, match="Invalid data found"):
+        run_ffmpeg_with_progress([ffmpeg, "-i", "in.mp4", "out.mp4"], 10.0)
+
+
+@posix_only
+def test_stalled_ffmpeg_is_terminated(tmp_path):
+    pid_path = tmp_path / "ffmpeg.pid"
+    # Один блок прогресса, затем ffmpeg "зависает" без вывода
+    ffmpeg = fake_ffmpeg(tmp_path, f"echo $$ > '{pid_path}'\n" + progress_lines() + "exec sleep 30\n")
+
+    started_at = time.monotonic()
+    with pytest.raises(FFmpegStalled):
+        run_ffmpeg_with_progress([ffmpeg, "-i", "in.mp4", "out.mp4"], 10.0, stall_timeout=1)
+
+    assert time.monotonic() - started_at < 10
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+
+
+def test_cancel_bulk_keeps_selected_game_proxy(tmp_path, monkeypatch):
+    release = threading.Event()
+    started = threading.Event()
+    created = []
+
+    def generate(source_path, proxy_path):
+        started.set()
+        release.wait(5)
+        created.append(os.path.basename(source_path))
+
+    monkeypatch.setattr(video_handler, "generate_preview_proxy", generate)
+    for name in ("a.mp4", "b.mp4", "selected.mp4"):
+        (tmp_path / name).write_bytes(b"video")
+    builder = PreviewProxyBuilder(str(tmp_path / "proxies"))
+
+    builder.request_many([(str(tmp_path / "a.mp4"), "a.mp4"), (str(tmp_path / "b.mp4"), "b.mp4")])
+    assert started.wait(5)
+    builder.request(str(tmp_path / "selected.mp4"), "selected.mp4")
+    builder.cancel_bulk()
+    release.set()
+
+    deadline = time.monotonic() + 5
+    while builder._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert created == ["a.mp4", "selected.mp4"]
@@ -0,0 +1,163 @@
+import os
+import xml.etree.ElementTree as ET
+
+import db_cache
+from xml_handler import export_curated_collection, flush_pending_descriptions, write_game_descriptions
+
+
+SUPPORT_ROOT = os.path.join(os.path.dirname(db_cache.__file__), "pS_CatVer_287")
+
+
+GAMELIST = (
+    "\ufeff<?xml version=\"1.0\" encoding=\"UTF-8\"?>\r\n"
+    "<!DOCTYPE gameList>\r\n"
+    "<?xml-stylesheet type=\"text/xsl\" href=\"style.xsl\"?>\r\n"
+    "<gameList>\r\n"
+    "\t<!-- scraped <game><path>./commented.zip</path><desc>old</desc></game> -->\r\n"
+    "\t<provider><System>Arcade</System></provider>\r\n"
+    "\t<game id='1' source=\"ScreenScraper\">\r\n"
+    "\t\t<path>./A &amp; B.zip</path>\r\n"
+    "\t\t<name>A &#38; B</name>\r\n"
+    "\t\t<desc>First game</desc>\r\n"
+    "\t\t<image />\r\n"
+    "\t</game>\r\n"
+    "\t<game id=\"2\">\r\n"
+    "\t\t<path>./second.zip</path>\r\n"
+    "\t\t<desc/>\r\n"
+    "\t</game>\r\n"
+    "\t<game id=\"3\">\r\n"
+    "\t\t<path>./third.zip</path>\r\n"
+    "\t\t<name>Third</name>\r\n"
+    "\t</game>\r\n"
+    "\t<game id=\"4\"><path>./untouched.zip</path><desc>Keep &apos;me&apos;</desc></game>\r\n"
+    "</gameList>\r\n"
+)
+
+
+def write_gamelist(tmp_path):
+    xml_path = tmp_path / "curated_gamelist.xml"
+    xml_path.write_bytes(GAMELIST.encode("utf-8"))
+    return xml_path
+
+
+def test_unknown_paths_leave_file_untouched(tmp_path):
+    xml_path = write_gamelist(tmp_path)
+    assert write_game_descriptions(str(xml_path), {"./missing.zip": "x", "./commented.zip": "x"}) == 0
+    assert xml_path.read_bytes() == GAMELIST.encode("utf-8")
+
+
+def test_only_descriptions_change(tmp_path):
+    xml_path = write_gamelist(tmp_path)
+    changed = write_game_descriptions(str(xml_path), {
+        "./A & B.zip": "Первая <игра> & co",
+        "./second.zip": "Вторая",
+        "./third.zip": "Третья",
+    })
+
+    expected = (
+        GAMELIST
+        .replace("<desc>First game</desc>", "<desc>Первая &lt;игра&gt; &amp; co</desc>")
+        .replace("<desc/>", "<desc>Вторая</desc>")
+        .replace("<path>./third.zip</path>", "<path>./third.zip</path>\r\n\t\t<desc>Третья</desc>")
+    )
+    assert changed == 3
+    assert xml_path.read_bytes() == expected.encode("utf-8")
+    descriptions = {game.findtext("path"): game.findtext("desc") for game in ET.parse(xml_path).getroot()}
+    assert descriptions["./A & B.zip"] == "Первая <игра> & co"
+    assert descriptions["./untouched.zip"] == "Keep 'me'"
+
+
+def test_flush_pending_descriptions(tmp_path):
+    xml_path = write_gamelist(tmp_path)
+    db_path = str(tmp_path / "curated_cache.sqlite")
+    db_cache.rebuild_cache(str(xml_path), db_path, SUPPORT_ROOT)
+
+    db_cache.store_game_descriptions(db_path, [("./second.zip", "Вторая")])
+    # Пересборка кэша до записи в XML не теряет перевод
+    db_cache.rebuild_cache(str(xml_path), db_path, SUPPORT_ROOT)
+    rows = {row["path"]: row["desc"] for row in db_cache.load_tree_rows(db_path, [])}
+    assert rows["./second.zip"] == "Вторая"
+
+    assert flush_pending_descriptions(str(xml_path), db_path) == 1
+    assert db_cache.load_pending_descriptions(db_path) == {}
+    assert "<desc>Вторая</desc>" in xml_path.read_text(encoding="utf-8")
+    assert flush_pending_descriptions(str(xml_path), db_path) == 0
+
+
+def test_reexport_picks_up_file_overwritten_in_place(tmp_path):
+    collection = tmp_path / "arcade"
+    (collection / "roms").mkdir(parents=True)
+    rom_path = collection / "roms" / "g0.zip"
+    rom_path.write_bytes(b"a" * 1000)
+    xml_path = collection / "gamelist.xml"
+    xml_path.write_text(
+        "<gameList><game><path>./roms/g0.zip</path><name>G0</name></game></gameList>",
+        encoding="utf-8",
+    )
+    db_path = str(tmp_path / "curated_cache.sqlite")
+    export_root = tmp_path / "export"
+
+    export = dict(cache_db_path=db_path, strategy="copy")
+
+    first = export_curated_collection(str(xml_path), str(collection), str(export_root), **export)
+    assert first["copied_files"] == 1
+
+    # Перезапись на месте не меняет mtime каталога, инвентарь в кэше остаётся старым
+    roms_mtime = os.stat(collection / "roms").st_mtime_ns
+    with open(rom_path, "r+b") as f:
+        f.write(b"b" * 2000)
+    stat_result = os.stat(rom_path)
+    os.utime(rom_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 5 * 10**9))
+    os.utime(collection / "roms", ns=(roms_mtime, roms_mtime))
+
+    second = export_curated_collection(str(xml_path), str(collection), str(export_root), **export)
+    assert second["copied_files"] == 1
+    assert (export_root / "roms" / "g0.zip").read_bytes() == b"b" * 2000
+
+
+def make_dedup_collection(tmp_path):
+    collection = tmp_path / "arcade"
+    (collection / "media" / "images").mkdir(parents=True)
+    (collection / "media" / "images" / "a.png").write_bytes(b"same image")
+    (collection / "media" / "images" / "b.png").write_bytes(b"same image")
+    (collection / "a.zip").write_bytes(b"rom a")
+    (collection / "b.zip").write_bytes(b"rom b")
+    xml_path = collection / "gamelist.xml"
+    xml_path.write_text(
+        "<gameList>"
+        "<game><path>./a.zip</path><image>./media/images/a.png</image></game>"
+        "<game><path>./b.zip</path><image>./media/images/b.png</image></game>"
+        "</gameList>",
+        encoding="utf-8",
+    )
+    return collection, xml_path
+
+
+def test_reference_dedup_rewrites_xml_paths(tmp_path):
+    collection, xml_path = make_dedup_collection(tmp_path)
+    export_root = tmp_path / "export"
+
+    result = export_curated_collection(
+        str(xml_path), str(collection), str(export_root), dedup="reference", strategy="copy"
+    )
+
+    assert result["dedup_files"] == 1
+    assert result["dedup_saved_bytes"] == len(b"same image")
+    images = [game.findtext("image") for game in ET.parse(export_root / "gamelist.xml").getroot()]
+    assert images == ["./media/images/a.png", "./media/images/a.png"]
+    assert (export_root / "media" / "images" / "a.png").exists()
+    assert not (export_root / "media" / "images" / "b.png").exists()
+
+
+def test_link_dedup_keeps_xml_paths(tmp_path):
+    collection, xml_path = make_dedup_collection(tmp_path)
+    export_root = tmp_path / "export"
+
+    result = export_curated_collection(
+        str(xml_path), str(collection), str(export_root), dedup="link", strategy="copy"
+    )
+
+    assert result["linked_files"] == 1
+    images = [game.findtext("image") for game in ET.parse(export_root / "gamelist.xml").getroot()]
+    assert images == ["./media/images/a.png", "./media/images/b.png"]
+    assert os.path.samefile(export_root / "media" / "images" / "a.png", export_root / "media" / "images" / "b.png")